@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+# Throughput of the CRC-64/XZ implementation that ZS uses to check every
+# block, versus the original byte-at-a-time pycrc version (kept as
+# zs._zs._crc64xz_reference).
+#
+# Usage: bench-crc64xz.py [FILE]
+# Without FILE, uses random data.
+#
+# On a recent x86-64 machine: slice-by-8 ~1200 MiB/s, pycrc ~310 MiB/s.
+
+import sys
+import os
+import timeit
+
+from zs._zs import crc64xz, _crc64xz_reference
+
+if len(sys.argv) > 1:
+    data = open(sys.argv[1], "rb").read()
+else:
+    data = os.urandom(64 * 2 ** 20)
+
+# Whole buffer, and then typical block sizes
+for size in [len(data), 2 ** 20, 128 * 2 ** 10, 8 * 2 ** 10, 256]:
+    chunks = [data[i:i + size] for i in range(0, len(data) - size + 1, size)]
+    total = size * len(chunks)
+    for fn in [crc64xz, _crc64xz_reference]:
+        def doit():
+            for chunk in chunks:
+                fn(chunk)
+        elapsed = min(timeit.repeat(doit, repeat=3, number=1))
+        print("%9i-byte chunks, %-19s %8.1f MiB/s"
+              % (size, fn.__name__ + ":", total / elapsed / 2 ** 20))
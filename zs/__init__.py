@@ -3,9 +3,11 @@
 # See file LICENSE.txt for license information.
 
 from .common import ZSError, ZSCorrupt
-from .reader import ZS
+from .reader import ZS, set_shared_pool_size, shutdown_shared_pool
+from .packed import PackedRecords
 from .writer import ZSWriter
 
 from .version import __version__
 
-__all__ = ["ZSError", "ZSCorrupt", "ZS", "ZSWriter"]
+__all__ = ["ZSError", "ZSCorrupt", "ZS", "ZSWriter",
+           "set_shared_pool_size", "shutdown_shared_pool", "PackedRecords"]
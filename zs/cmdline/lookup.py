@@ -0,0 +1,109 @@
+# This file is part of ZS
+# Copyright (C) 2013-2014 Nathaniel Smith <njs@pobox.com>
+# See file LICENSE.txt for license information.
+
+import sys
+
+from zs.common import read_length_prefixed, write_length_prefixed
+from .util import open_zs
+
+def command_lookup(opts):
+    """Look up many keys in a .zs file at once.
+
+Usage:
+  zs lookup --keys-from=FILE
+            [--prefixes]
+            [--terminator=TERMINATOR | --length-prefixed=TYPE]
+            [-j PARALLELISM]
+            [-o FILE]
+            [--] <zs_file>
+  zs lookup --help
+
+Arguments:
+  <zs_file>  Path or URL pointing to a .zs file. An argument beginning with
+             the four characters "http" will be treated as a URL.
+
+Selection options:
+  --keys-from=FILE         Read the keys to look up from FILE, or "-" for
+                           stdin. Keys use the same record framing as the
+                           output (see below). The keys do not need to be
+                           sorted.
+  --prefixes               Treat each key as a prefix, and output all
+                           records which begin with it. By default, only
+                           records which are exactly equal to some key are
+                           output.
+
+  Results are output in the same order as the keys. Keys which don't match
+  anything produce no output.
+
+Processing options:
+  -j PARALLELISM           The number of CPUs to use for decompression.
+                           [default: guess]
+
+Output options:
+  -o FILE, --output=FILE   Output to the given file, or "-" for stdout.
+                           [default: -]
+
+Record framing options:
+  --terminator=TERMINATOR  String used to terminate records in the keys file
+                           and in the output. Python string escapes are
+                           allowed (e.g., "\\n", "\\x00"). [default: \\n]
+  --length-prefixed=TYPE   Instead of terminating records with a marker,
+                           prefix each record with its length, encoded as
+                           TYPE. (Options: uleb128, u64le)
+
+  Looking up many keys at once is much faster than looking them up one at a
+  time: each data block in the .zs file is fetched and decompressed at most
+  once, no matter how many keys fall into it.
+
+    """
+
+    length_prefixed = opts["--length-prefixed"]
+    terminator = opts["__terminator__"]
+    if opts["--keys-from"] == "-":
+        keys = _read_keys(sys.stdin, length_prefixed, terminator)
+    else:
+        with open(opts["--keys-from"], "rb") as keys_file:
+            keys = _read_keys(keys_file, length_prefixed, terminator)
+
+    if opts["--output"] == "-":
+        out_file = sys.stdout
+    else:
+        out_file = open(opts["--output"], "wb")
+    try:
+        _write_results(opts, keys, out_file, length_prefixed, terminator)
+    finally:
+        if out_file is not sys.stdout:
+            out_file.close()
+
+    return 0
+
+def _read_keys(keys_file, length_prefixed, terminator):
+    if hasattr(keys_file, "buffer"):
+        keys_file = keys_file.buffer
+    if length_prefixed is None:
+        keys = keys_file.read().split(terminator)
+        # A trailing terminator doesn't create an extra empty key (but
+        # we don't insist on having one, either).
+        if keys[-1] == b"":
+            keys.pop()
+        return keys
+    else:
+        return list(read_length_prefixed(keys_file, length_prefixed))
+
+def _write_results(opts, keys, out_file, length_prefixed, terminator):
+    if hasattr(out_file, "buffer"):
+        out_file = out_file.buffer
+    with open_zs(opts) as z:
+        if opts["--prefixes"]:
+            results = z.search_many([(None, None, key) for key in keys])
+        else:
+            results = [[record] for record in z.get_many(keys)
+                       if record is not None]
+        for records in results:
+            if not records:
+                continue
+            if length_prefixed is None:
+                out_file.write(terminator.join(records + [b""]))
+            else:
+                write_length_prefixed(out_file, records, length_prefixed)
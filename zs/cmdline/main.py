@@ -65,6 +65,9 @@ subcommands["info"] = command_info
 from .make import command_make
 subcommands["make"] = command_make
 
+from .lookup import command_lookup
+subcommands["lookup"] = command_lookup
+
 # args = argv[1:]
 def main(args):
     """ZS: a space-efficient file format format for distributing, archiving,
@@ -77,6 +80,7 @@ Usage:
 
 Available subcommands:
   zs dump      Get contents of a .zs file.
+  zs lookup    Look up many keys in a .zs file at once.
   zs info      Get general metadata about a .zs file.
   zs validate  Check a .zs file for validity.
   zs make      Create a new .zs file with specified contents.
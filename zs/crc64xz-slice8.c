@@ -0,0 +1,83 @@
+/**
+ * This file is part of ZS
+ * Copyright (C) 2013-2014 Nathaniel Smith <njs@pobox.com>
+ * See file LICENSE.txt for license information.
+ *
+ * Slice-by-8 CRC-64/XZ; see crc64xz-slice8.h.
+ */
+#include "crc64xz-slice8.h"
+
+/* The CRC-64/XZ polynomial 0x42f0e1eba9ea3693, bit-reflected. */
+#define ZS_CRC64XZ_POLY_REFLECTED 0xc96c5795d7870f42ULL
+
+/* zs_crc64xz_tables[0] is the ordinary byte-at-a-time table;
+ * zs_crc64xz_tables[k][b] is the CRC contribution of byte b followed by k
+ * zero bytes. */
+static zs_crc64xz_t zs_crc64xz_tables[8][256];
+
+static void zs_crc64xz_init_tables(void)
+{
+    unsigned int i, j, k;
+    zs_crc64xz_t crc;
+
+    for (i = 0; i < 256; i++) {
+        crc = i;
+        for (j = 0; j < 8; j++) {
+            if (crc & 1) {
+                crc = (crc >> 1) ^ ZS_CRC64XZ_POLY_REFLECTED;
+            } else {
+                crc >>= 1;
+            }
+        }
+        zs_crc64xz_tables[0][i] = crc;
+    }
+    for (i = 0; i < 256; i++) {
+        crc = zs_crc64xz_tables[0][i];
+        for (k = 1; k < 8; k++) {
+            crc = zs_crc64xz_tables[0][crc & 0xff] ^ (crc >> 8);
+            zs_crc64xz_tables[k][i] = crc;
+        }
+    }
+}
+
+/* Assembled byte-by-byte so that it works regardless of alignment or host
+ * endianness; compilers turn this into a single load on little-endian
+ * machines. */
+static zs_crc64xz_t zs_crc64xz_load_le64(const unsigned char *p)
+{
+    return ((zs_crc64xz_t) p[0])
+        | ((zs_crc64xz_t) p[1] << 8)
+        | ((zs_crc64xz_t) p[2] << 16)
+        | ((zs_crc64xz_t) p[3] << 24)
+        | ((zs_crc64xz_t) p[4] << 32)
+        | ((zs_crc64xz_t) p[5] << 40)
+        | ((zs_crc64xz_t) p[6] << 48)
+        | ((zs_crc64xz_t) p[7] << 56);
+}
+
+static zs_crc64xz_t zs_crc64xz_update(zs_crc64xz_t crc,
+                                      const unsigned char *data,
+                                      size_t data_len)
+{
+    const zs_crc64xz_t (*t)[256] =
+        (const zs_crc64xz_t (*)[256]) zs_crc64xz_tables;
+
+    while (data_len >= 8) {
+        crc ^= zs_crc64xz_load_le64(data);
+        crc = t[7][crc & 0xff]
+            ^ t[6][(crc >> 8) & 0xff]
+            ^ t[5][(crc >> 16) & 0xff]
+            ^ t[4][(crc >> 24) & 0xff]
+            ^ t[3][(crc >> 32) & 0xff]
+            ^ t[2][(crc >> 40) & 0xff]
+            ^ t[1][(crc >> 48) & 0xff]
+            ^ t[0][crc >> 56];
+        data += 8;
+        data_len -= 8;
+    }
+    while (data_len--) {
+        crc = t[0][(crc ^ *data) & 0xff] ^ (crc >> 8);
+        data++;
+    }
+    return crc;
+}
@@ -0,0 +1,41 @@
+/**
+ * This file is part of ZS
+ * Copyright (C) 2013-2014 Nathaniel Smith <njs@pobox.com>
+ * See file LICENSE.txt for license information.
+ *
+ * CRC-64/XZ (the same CRC as pycrc-crc64xz.h computes, and as used by xz),
+ * using the "slice-by-8" technique: eight 256-entry tables let us fold in
+ * 8 bytes of input per step instead of 1, which is several times faster
+ * than the plain table-driven version. See e.g.
+ *   Kounavis & Berry, "A Systematic Approach to Building High Performance,
+ *   Software-based, CRC Generators", ISCC 2005.
+ *
+ * zs_crc64xz_init_tables() must be called once before anything else. The
+ * other functions touch no global state except the (then read-only) tables,
+ * so they're safe to call without holding the GIL.
+ */
+#ifndef __ZS_CRC64XZ_SLICE8_H__
+#define __ZS_CRC64XZ_SLICE8_H__
+
+#include <stdlib.h>
+#include <stdint.h>
+
+typedef uint64_t zs_crc64xz_t;
+
+static void zs_crc64xz_init_tables(void);
+
+static zs_crc64xz_t zs_crc64xz_init(void)
+{
+    return 0xffffffffffffffffULL;
+}
+
+static zs_crc64xz_t zs_crc64xz_update(zs_crc64xz_t crc,
+                                      const unsigned char *data,
+                                      size_t data_len);
+
+static zs_crc64xz_t zs_crc64xz_finalize(zs_crc64xz_t crc)
+{
+    return crc ^ 0xffffffffffffffffULL;
+}
+
+#endif      /* __ZS_CRC64XZ_SLICE8_H__ */
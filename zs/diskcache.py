@@ -0,0 +1,239 @@
+# This file is part of ZS
+# Copyright (C) 2013-2014 Nathaniel Smith <njs@pobox.com>
+# See file LICENSE.txt for license information.
+
+# A persistent on-disk cache of compressed blocks, so that programs which
+# open the same remote ZS file over and over don't have to download the same
+# index blocks every time.
+#
+# Layout: the cache directory contains one subdirectory per ZS file, named by
+# a digest of that file's complete encoded header, and inside that, one file
+# per cached block, named by its offset. Each block file contains exactly
+# the bytes found at that offset in the ZS file (uleb128 length, block,
+# CRC), so it can be checked in exactly the same way as a freshly downloaded
+# block.
+#
+# Why key on the whole header, rather than just the sha256 field? Because
+# the sha256 is a hash of the *uncompressed* data. Two files with the same
+# contents but different codecs or block sizes have the same sha256, but
+# completely different blocks at any given offset. The header covers the
+# sha256, codec, root location, total length and metadata, which together
+# pin down the actual bytes on disk.
+#
+# Eviction is approximately-LRU: we bump a file's mtime whenever it's used,
+# and when the directory gets too big we delete the oldest files, until it's
+# comfortably below the limit (so that we don't have to rescan the whole
+# directory again on the very next put). Entries that are left with no
+# blocks at all get deleted once they haven't been used for a while. Writes
+# go to a temporary file which is then renamed into place, so other
+# processes sharing the same directory never see partial blocks.
+#
+# To tell when the directory is too big without walking the whole thing on
+# every open, the total size of the cached blocks is kept in a "usage" file
+# at the top of the cache directory, which every put and discard updates.
+# Processes sharing the directory can race on it, so it's only an estimate,
+# but every eviction recounts everything from scratch and writes the true
+# total back.
+#
+# This is strictly a cache: any problem with the cache directory (missing,
+# read-only, full disk, ...) just means that we fall back on the network.
+
+import os
+import os.path
+import hashlib
+import threading
+import time
+
+_HEADER_NAME = "header"
+_BLOCK_SUFFIX = ".block"
+_USAGE_NAME = "usage"
+
+# When the cache gets too big, we evict down to this fraction of max_bytes.
+_EVICT_TO_FRACTION = 0.9
+
+# Temporary files this old were left behind by a writer that died, and
+# entries with no blocks that haven't been opened for this long aren't
+# coming back; both get cleaned up when we scan the directory.
+_STALE_SECONDS = 60 * 60
+
+class DiskBlockCache(object):
+    def __init__(self, directory, max_bytes, encoded_header):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        digest = hashlib.sha256(encoded_header).hexdigest()
+        self._entry_dir = os.path.join(directory, digest)
+        self._usage_path = os.path.join(directory, _USAGE_NAME)
+        try:
+            if not os.path.isdir(self._entry_dir):
+                os.makedirs(self._entry_dir)
+            header_path = os.path.join(self._entry_dir, _HEADER_NAME)
+            if self._read(header_path) != encoded_header:
+                self._write(header_path, encoded_header)
+            else:
+                # mark as recently used (see _scan)
+                os.utime(header_path, None)
+            if self._read_usage() is None:
+                with self._lock:
+                    self._evict()
+        except EnvironmentError:
+            self._entry_dir = None
+
+    def _block_path(self, offset):
+        return os.path.join(self._entry_dir, "%s%s" % (offset, _BLOCK_SUFFIX))
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except EnvironmentError:
+            return None
+
+    def _write(self, path, data):
+        tmp_path = "%s.tmp-%s-%s" % (path, os.getpid(),
+                                     threading.current_thread().ident)
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except EnvironmentError:
+            try:
+                os.unlink(tmp_path)
+            except EnvironmentError:
+                pass
+            return False
+        return True
+
+    # The total size of the cached blocks according to the usage file, or
+    # None if it's missing or unreadable.
+    def _read_usage(self):
+        data = self._read(self._usage_path)
+        try:
+            return int(data.decode("ascii"))
+        except (AttributeError, ValueError):
+            return None
+
+    def _write_usage(self, total):
+        self._write(self._usage_path, str(max(total, 0)).encode("ascii"))
+
+    # Returns a list of (mtime, path, size) for every cached block in the
+    # cache directory (including other files' entries). Headers don't count
+    # towards the limit. Stale temporary files are deleted, and so are
+    # other files' entries that have no blocks and haven't been opened
+    # recently.
+    def _scan(self):
+        found = []
+        stale_time = time.time() - _STALE_SECONDS
+        for entry in os.listdir(self._directory):
+            entry_dir = os.path.join(self._directory, entry)
+            if not os.path.isdir(entry_dir):
+                continue
+            have_blocks = False
+            for name in os.listdir(entry_dir):
+                is_block = name.endswith(_BLOCK_SUFFIX)
+                if not is_block and ".tmp-" not in name:
+                    continue
+                path = os.path.join(entry_dir, name)
+                try:
+                    stat = os.stat(path)
+                    if not is_block:
+                        if stat.st_mtime < stale_time:
+                            os.unlink(path)
+                        continue
+                except EnvironmentError:
+                    continue
+                have_blocks = True
+                found.append((stat.st_mtime, path, stat.st_size))
+            if not have_blocks and entry_dir != self._entry_dir:
+                self._remove_stale_entry(entry_dir, stale_time)
+        return found
+
+    def _remove_stale_entry(self, entry_dir, stale_time):
+        header_path = os.path.join(entry_dir, _HEADER_NAME)
+        try:
+            if os.path.exists(header_path):
+                if os.stat(header_path).st_mtime >= stale_time:
+                    return
+                os.unlink(header_path)
+            elif os.stat(entry_dir).st_mtime >= stale_time:
+                return
+            # (fails if someone is writing a block into it right now, which
+            # is fine)
+            os.rmdir(entry_dir)
+        except EnvironmentError:
+            pass
+
+    # Recounts everything, evicts blocks if we're over the limit, and
+    # updates the usage file. Must be called with self._lock held.
+    def _evict(self):
+        try:
+            found = sorted(self._scan())
+        except EnvironmentError:
+            return
+        total = sum(size for (_, _, size) in found)
+        if total > self._max_bytes:
+            for (_, path, size) in found:
+                if total <= self._max_bytes * _EVICT_TO_FRACTION:
+                    break
+                try:
+                    os.unlink(path)
+                except EnvironmentError:
+                    continue
+                total -= size
+        self._write_usage(total)
+
+    # Adds delta to the total in the usage file, evicting if that puts us
+    # over the limit.
+    def _update_usage(self, delta):
+        with self._lock:
+            total = self._read_usage()
+            if total is None or total + delta > self._max_bytes:
+                self._evict()
+            else:
+                self._write_usage(total + delta)
+
+    # Returns the raw bytes for the block at 'offset', or None if it isn't
+    # cached. The caller is responsible for checking the CRC (and calling
+    # discard() if it's bad).
+    def get(self, offset, block_length):
+        if self._entry_dir is None:
+            return None
+        path = self._block_path(offset)
+        data = self._read(path)
+        if data is None or len(data) != block_length:
+            return None
+        try:
+            # mark as recently used
+            os.utime(path, None)
+        except EnvironmentError:
+            pass
+        return data
+
+    # 'data' must be the raw bytes of the block at 'offset', and must
+    # already have been checked.
+    def put(self, offset, data):
+        if self._entry_dir is None or len(data) > self._max_bytes:
+            return
+        path = self._block_path(offset)
+        old_size = self._size(path)
+        if not self._write(path, data):
+            return
+        self._update_usage(len(data) - old_size)
+
+    def discard(self, offset):
+        if self._entry_dir is None:
+            return
+        path = self._block_path(offset)
+        old_size = self._size(path)
+        try:
+            os.unlink(path)
+        except EnvironmentError:
+            return
+        self._update_usage(-old_size)
+
+    # Size of the file at 'path', or 0 if there isn't one.
+    def _size(self, path):
+        try:
+            return os.stat(path).st_size
+        except EnvironmentError:
+            return 0
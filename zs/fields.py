@@ -0,0 +1,119 @@
+# This file is part of ZS
+# Copyright (C) 2013-2014 Nathaniel Smith <njs@pobox.com>
+# See file LICENSE.txt for license information.
+
+# Parsing records made up of delimited fields (e.g. tab-separated n-gram
+# counts) into columns.
+#
+# The actual splitting and number parsing happens in Cython
+# (_zs.parse_fields_packed), directly on the packed block, so there's never a
+# bytes object created for any record (or any numeric field). If numpy is
+# installed, numeric columns come out as numpy arrays; otherwise they're
+# array.array objects. Either way they can be pickled cheaply, so this is
+# meant to be run in the worker processes -- see ZS.search_columns.
+
+from collections import OrderedDict
+from array import array
+
+from ._zs import (parse_fields_packed,
+                  FIELD_BYTES, FIELD_INT, FIELD_FLOAT, FIELD_SKIP)
+from .packed import PackedRecords
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+_FIELD_KINDS = {
+    "bytes": FIELD_BYTES,
+    "int": FIELD_INT,
+    "float": FIELD_FLOAT,
+    None: FIELD_SKIP,
+}
+
+_NUMPY_DTYPES = {
+    FIELD_INT: "int64",
+    FIELD_FLOAT: "float64",
+}
+
+def _field_kinds(fields):
+    kinds = []
+    for (name, field_type) in fields:
+        if field_type not in _FIELD_KINDS:
+            raise ValueError("unknown type %r for field %r (expected "
+                             "\"bytes\", \"int\", \"float\", or None)"
+                             % (field_type, name))
+        kinds.append(_FIELD_KINDS[field_type])
+    return kinds
+
+def parse_fields(records, fields, delimiter=b"\t"):
+    """Split delimited records into fields, and parse them into columns.
+
+    :arg records: Either a list of records (bytes objects), or a
+      :class:`PackedRecords` object (see ``block_map(..., packed=True)``).
+
+    :arg fields: A list of ``(name, type)`` pairs, one for each field in
+      each record. ``type`` is one of ``"bytes"``, ``"int"`` (64-bit signed
+      integers), ``"float"``, or ``None`` to skip this field.
+
+    :arg delimiter: The single byte that separates fields.
+
+    Returns an :class:`~collections.OrderedDict` mapping field names to
+    columns. Columns of ints and floats are numpy arrays if numpy is
+    installed, and :class:`array.array` objects otherwise; columns of bytes
+    are lists. Skipped fields are left out.
+
+    Every record has to have exactly as many fields as there are entries in
+    ``fields``, and int and float fields have to be valid numbers, or else
+    :class:`ValueError` is raised.
+
+    For example, for a file of Google Books n-gram counts::
+
+      fields = [("ngram", "bytes"), ("year", "int"),
+                ("match_count", "int"), ("volume_count", "int")]
+      for columns in zs_obj.search_columns(fields, prefix=b"hello "):
+          ...
+    """
+    kinds = _field_kinds(fields)
+    if isinstance(records, PackedRecords):
+        block = records.buf
+        offsets, lengths = records.offsets, records.lengths
+    elif records:
+        block = b"".join(records)
+        offsets = array("Q")
+        lengths = array("Q")
+        pos = 0
+        for record in records:
+            offsets.append(pos)
+            lengths.append(len(record))
+            pos += len(record)
+    else:
+        block = b""
+        offsets = lengths = array("Q")
+    columns = parse_fields_packed(block, offsets, lengths, kinds, delimiter)
+    result = OrderedDict()
+    for ((name, _), kind, column) in zip(fields, kinds, columns):
+        if kind == FIELD_SKIP:
+            continue
+        if np is not None and kind in _NUMPY_DTYPES:
+            column = np.frombuffer(column, dtype=_NUMPY_DTYPES[kind])
+        result[name] = column
+    return result
+
+# Concatenates several results from parse_fields into one.
+def concat_columns(chunks):
+    result = OrderedDict()
+    for name in chunks[0]:
+        parts = [chunk[name] for chunk in chunks]
+        if isinstance(parts[0], list):
+            column = []
+            for part in parts:
+                column += part
+        elif np is not None and isinstance(parts[0], np.ndarray):
+            column = np.concatenate(parts)
+        else:
+            column = array(parts[0].typecode)
+            for part in parts:
+                column.extend(part)
+        result[name] = column
+    return result
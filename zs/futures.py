@@ -3,8 +3,8 @@
 # See file LICENSE.txt for license information.
 
 # A tiny shim to let zs.reader pretend to use
-# concurrent.futures.ProcessPoolExecutor on any version of Python, and whether
-# or not we're actually using parallelism.
+# concurrent.futures.ProcessPoolExecutor (or ThreadPoolExecutor) on any
+# version of Python, and whether or not we're actually using parallelism.
 #
 # We prefer to use concurrent.futures to raw multiprocessing, when available,
 # because concurrent.futures is more robust against things like the user
@@ -24,9 +24,12 @@
 # - Executor.submit()
 # - Future.result()
 # - Future.cancel()
+# - waiting for whichever of several futures finishes first (see
+#   first_completed())
 
 try:
-    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from concurrent.futures import wait, FIRST_COMPLETED
     have_process_pool_executor = True  # pragma: no cover
 except ImportError:
     have_process_pool_executor = False
@@ -55,10 +58,23 @@ class SerialExecutor(object):
     def shutdown(self):
         pass  # pragma: no cover
 
+# Returns one of the given futures that has finished, waiting for one to
+# finish if necessary. Futures that can't be waited on -- e.g. serial ones,
+# which don't run until .result() is called -- count as finished.
+def first_completed(futures):
+    waitable = []
+    for future in futures:
+        if not hasattr(future, "done") or future.done():
+            return future
+        waitable.append(future)
+    done, _ = wait(waitable, return_when=FIRST_COMPLETED)
+    return done.pop()
+
 if not have_process_pool_executor:
     # then fake it!
 
     import multiprocessing
+    import multiprocessing.pool
 
     class _MultiprocessingFuture(object):
         def __init__(self, async_result):
@@ -71,10 +87,7 @@ if not have_process_pool_executor:
             # Can't be done!
             pass
 
-    class ProcessPoolExecutor(object):
-        def __init__(self, num_workers):
-            self._pool = multiprocessing.Pool(num_workers)
-
+    class _PoolExecutor(object):
         def submit(self, fn, *args, **kwargs):
             async_result = self._pool.apply_async(fn, args, kwargs)
             return _MultiprocessingFuture(async_result)
@@ -82,3 +95,11 @@ if not have_process_pool_executor:
         def shutdown(self):
             self._pool.terminate()
             self._pool.join()
+
+    class ProcessPoolExecutor(_PoolExecutor):
+        def __init__(self, num_workers):
+            self._pool = multiprocessing.Pool(num_workers)
+
+    class ThreadPoolExecutor(_PoolExecutor):
+        def __init__(self, num_workers):
+            self._pool = multiprocessing.pool.ThreadPool(num_workers)
@@ -0,0 +1,100 @@
+# This file is part of ZS
+# Copyright (C) 2013-2014 Nathaniel Smith <njs@pobox.com>
+# See file LICENSE.txt for license information.
+
+# A view of the records in a data block that doesn't copy them.
+#
+# Normally, unpacking a data block creates one bytes object for every record
+# in it, which for blocks full of short records is most of the cost of
+# reading them. A PackedRecords object instead keeps the decompressed block
+# as a single buffer, plus arrays saying where each record starts and how
+# long it is. Records are only pulled out (as memoryview slices) when you ask
+# for them, and code that can work on the whole buffer at once (e.g. with
+# numpy) never has to create any per-record objects at all.
+
+from array import array
+
+from ._zs import unpack_data_record_offsets, packed_bisect_left
+
+class PackedRecords(object):
+    """The records from a data block, stored packed together in a single
+    buffer.
+
+    This acts like a read-only sequence of records, except that the records
+    are :class:`memoryview` objects pointing into the buffer, rather than
+    bytes objects. (Use ``bytes(record)`` or :meth:`tolist` if you need
+    copies.)
+
+    .. attribute:: buf
+
+       A :class:`memoryview` of the decompressed data block.
+
+    .. attribute:: offsets
+
+       An :class:`array.array` of unsigned 64-bit integers, giving the
+       position of each record in :attr:`buf`.
+
+    .. attribute:: lengths
+
+       An :class:`array.array` of unsigned 64-bit integers, giving the length
+       of each record.
+
+    To get these as numpy arrays without copying, use e.g.
+    ``np.frombuffer(packed.offsets, dtype=np.uint64)``.
+
+    The buffer may point into memory that ZS reuses once the function that
+    was passed the :class:`PackedRecords` returns, so don't hold onto it (or
+    any of the records) past that point; copy out anything you need.
+    """
+
+    def __init__(self, buf, offsets, lengths):
+        self.buf = memoryview(buf)
+        self.offsets = offsets
+        self.lengths = lengths
+
+    @classmethod
+    def from_block(cls, payload):
+        offsets, lengths = unpack_data_record_offsets(payload)
+        return cls(payload, offsets, lengths)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return PackedRecords(self.buf, self.offsets[i], self.lengths[i])
+        offset = self.offsets[i]
+        return self.buf[offset:offset + self.lengths[i]]
+
+    def __iter__(self):
+        buf = self.buf
+        for offset, length in zip(self.offsets, self.lengths):
+            yield buf[offset:offset + length]
+
+    def tolist(self):
+        """Return the records as a list of bytes objects."""
+        return [record.tobytes() for record in self]
+
+    # memoryviews can't be pickled, so we send a copy of the buffer instead
+    # -- but only the part that our records are in, in case we're a small
+    # slice of a big block.
+    def __reduce__(self):
+        if not len(self):
+            return (PackedRecords, (b"", self.offsets, self.lengths))
+        lo = min(self.offsets)
+        hi = max(offset + length
+                 for (offset, length) in zip(self.offsets, self.lengths))
+        offsets = array("Q", [offset - lo for offset in self.offsets])
+        return (PackedRecords,
+                (self.buf[lo:hi].tobytes(), offsets, self.lengths))
+
+# Same as zs.reader._trim_records, but for PackedRecords.
+def trim_packed(packed, start, stop):
+    buf, offsets, lengths = packed.buf, packed.offsets, packed.lengths
+    lo = packed_bisect_left(buf, offsets, lengths, start)
+    hi = len(packed)
+    if stop is not None:
+        hi = packed_bisect_left(buf, offsets, lengths, stop, lo)
+    if lo == 0 and hi == len(packed):
+        return packed
+    return packed[lo:hi]
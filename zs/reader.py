@@ -5,19 +5,22 @@
 import sys
 import struct
 import json
-from bisect import bisect_left
+from bisect import bisect_left, bisect_right
 from contextlib import closing, contextmanager
-from collections import namedtuple, OrderedDict
+from collections import namedtuple, OrderedDict, deque
 import multiprocessing
 import threading
+import time
+import atexit
 import weakref
 import hashlib
 import binascii
 
 from six import Iterator, BytesIO, indexbytes, int2byte, reraise
-from six.moves import queue
+from six.moves import queue, cPickle as pickle
 
-from .futures import SerialExecutor, ProcessPoolExecutor
+from .futures import (SerialExecutor, ProcessPoolExecutor,
+                      ThreadPoolExecutor, _SerialFuture, first_completed)
 from .common import (ZSError,
                      ZSCorrupt,
                      MAGIC,
@@ -31,8 +34,15 @@ from .common import (ZSError,
                      read_n,
                      read_format,
                      write_length_prefixed)
-from ._zs import (unpack_data_records, unpack_index_records, read_uleb128)
+from ._zs import (unpack_data_records, unpack_index_records, read_uleb128,
+                  split_block_frames, data_block_contains,
+                  data_block_contains_many)
 from .transport import FileTransport, HTTPTransport
+from .diskcache import DiskBlockCache
+from .packed import PackedRecords, trim_packed
+from .fields import parse_fields, concat_columns
+from .sharedmem import (have_shared_memory, SharedMemoryRing, attach,
+                        prepare_for_workers)
 
 # How much data to read from the header on our first request on slow
 # transports. If the header is shorter than this, then we waste a bit of
@@ -42,6 +52,13 @@ from .transport import FileTransport, HTTPTransport
 # be larger than the magic + header length field, which is currently 16.)
 HEADER_SIZE_GUESS = 8192
 
+# On remote transports, we also speculatively fetch this much data from the
+# end of the file, in parallel with reading the header. The root index is
+# always the last block in the file, and the last blocks of the other index
+# levels come just before it, so this usually saves a round trip per index
+# level on the first search.
+TAIL_SIZE_GUESS = 256 * 2 ** 10
+
 # for testing
 @contextmanager
 def _lower_header_size_guess():
@@ -51,6 +68,44 @@ def _lower_header_size_guess():
     yield
     HEADER_SIZE_GUESS = was
 
+# The readahead thread reads its stream in chunks, which it then splits into
+# block frames in bulk (see _BlockFrameReader). We start with small chunks, so
+# that short searches don't read much more than they need, and then double
+# the size on each read until it reaches READAHEAD_MAX_CHUNK_SIZE.
+READAHEAD_MIN_CHUNK_SIZE = 64 * 2 ** 10
+READAHEAD_MAX_CHUNK_SIZE = 8 * 2 ** 20
+
+# Blocks are handed to the executor in batches, to amortize the per-job
+# overhead. This is the most raw block data we put into one batch (though a
+# batch always contains at least one block, however large).
+MAX_BATCH_BYTES = 2 ** 20
+
+# How far the readahead thread gets ahead of its consumer is limited by
+# memory: it stops submitting jobs once the raw blocks in flight, plus our
+# estimate of their decompressed payloads, add up to READAHEAD_MAX_BYTES.
+# (Though there's always at least one job in flight, however big.) Until
+# we've seen some payloads, we guess that they're READAHEAD_GUESS_EXPANSION
+# times bigger than the raw blocks.
+READAHEAD_MAX_BYTES = 64 * 2 ** 20
+READAHEAD_GUESS_EXPANSION = 4
+# Within that budget, the number of jobs in flight adapts to how the workers
+# are keeping up (see _ReadaheadWindow): it goes up by one whenever the
+# consumer spends more than 1/READAHEAD_WAIT_RATIO as long waiting for a job
+# as it does processing it, and otherwise drifts back down.
+READAHEAD_WAIT_RATIO = 16
+
+# When using worker processes, batches are passed to and from them through
+# shared memory slots (see zs/sharedmem.py), which are this big. A batch is
+# never much bigger than MAX_BATCH_BYTES, but its decompressed payloads can
+# be several times bigger. Anything that doesn't fit gets pickled instead.
+SHARED_MEMORY_INPUT_SIZE = 2 * MAX_BATCH_BYTES
+SHARED_MEMORY_OUTPUT_SIZE = 4 * MAX_BATCH_BYTES
+
+# Starting up a pool of worker processes is slow, so we don't do it until a
+# single scan has gotten through this many blocks. Before that, work is done
+# serially in the main thread.
+LAZY_POOL_BLOCKS = 3
+
 def _decode_header_data(encoded):
     fields = {}
     f = BytesIO(encoded)
@@ -90,6 +145,101 @@ def test__get_raw_block_unchecked():
     f_partial2 = BytesIO(b"\x05" + b"\x01" * 5 + b"\x02" * 3)
     assert_raises(ZSCorrupt, _get_raw_block_unchecked, f_partial2)
 
+# Reads a stream of blocks in big chunks, and returns them as lists of frames
+# in the format produced by split_block_frames. This avoids the per-byte
+# reads that _get_raw_block_unchecked does.
+#
+# If the stream returns memoryviews (see transport._BufferStream), then the
+# frames are memoryviews too, and no data is copied. Such streams must also
+# support seek().
+class _BlockFrameReader(object):
+    def __init__(self, stream):
+        self._stream = stream
+        self._offset = stream.tell()
+        self._buf = b""
+        self._chunk_size = READAHEAD_MIN_CHUNK_SIZE
+
+    # Returns a non-empty list of frames, or an empty list on EOF.
+    def read_frames(self):
+        while True:
+            frames, consumed = split_block_frames(self._buf, self._offset)
+            if frames:
+                self._buf = self._buf[consumed:]
+                self._offset += consumed
+                return frames
+            data = self._stream.read(self._chunk_size)
+            self._chunk_size = min(2 * self._chunk_size,
+                                   READAHEAD_MAX_CHUNK_SIZE)
+            if not data:
+                if self._buf:
+                    # There's a partial block left over. This is guaranteed
+                    # to raise an appropriate error.
+                    _get_raw_block_unchecked(BytesIO(self._buf))
+                    assert False  # pragma: no cover
+                return []
+            if not self._buf:
+                self._buf = data
+            elif isinstance(data, memoryview):
+                # Rather than copying the partial frame and the new data
+                # together, go back and get them as a single slice.
+                self._stream.seek(self._offset)
+                self._buf = self._stream.read(len(self._buf) + len(data))
+            else:
+                self._buf += data
+
+def test__BlockFrameReader():
+    from .transport import _BufferStream
+    block1 = b"\x05" + b"\x01" * 5 + b"\x02" * 8
+    block2 = b"\x01" + b"\x03" + b"\x04" * 8
+    frame1 = (10, 14, b"\x01" * 5, b"\x02" * 8)
+    frame2 = (24, 10, b"\x03", b"\x04" * 8)
+    def read_all(stream, chunk_size):
+        global READAHEAD_MIN_CHUNK_SIZE
+        was = READAHEAD_MIN_CHUNK_SIZE
+        READAHEAD_MIN_CHUNK_SIZE = chunk_size
+        try:
+            reader = _BlockFrameReader(stream)
+        finally:
+            READAHEAD_MIN_CHUNK_SIZE = was
+        got = []
+        while True:
+            frames = reader.read_frames()
+            if not frames:
+                return got
+            got += frames
+    for chunk_size in [1, 3, 100]:
+        f = BytesIO(b"\x00" * 10 + block1 + block2)
+        f.seek(10)
+        assert read_all(f, chunk_size) == [frame1, frame2]
+
+        # zero-copy streams give zero-copy frames
+        buf = memoryview(b"\x00" * 10 + block1 + block2)
+        got = read_all(_BufferStream(buf, 10), chunk_size)
+        assert got == [frame1, frame2]
+        for frame in got:
+            assert isinstance(frame[2], memoryview)
+            assert frame[2].obj is buf.obj
+
+    from nose.tools import assert_raises
+    for partial in [block1[:1], block1[:-1], block1 + b"\x80"]:
+        reader = _BlockFrameReader(BytesIO(partial))
+        frames = []
+        with assert_raises(ZSCorrupt):
+            while True:
+                frames += reader.read_frames()
+        # the complete block in front of the broken one is still returned
+        if len(partial) > len(block1):
+            assert frames == [(0, 14, b"\x01" * 5, b"\x02" * 8)]
+
+# Splits a chunk containing exactly one block (as found via an index block)
+# into (raw_block, checksum).
+def _split_single_block(offset, chunk):
+    frames, _ = split_block_frames(chunk, offset)
+    if not frames:
+        raise ZSCorrupt("unexpected EOF in block @ %s" % (offset,))
+    _, _, raw_block, checksum = frames[0]
+    return raw_block, checksum
+
 def _check_block(offset, raw_block, checksum):
     if encoded_crc64xz(raw_block) != checksum:
         raise ZSCorrupt("checksum mismatch at %s" % (offset,))
@@ -97,29 +247,344 @@ def _check_block(offset, raw_block, checksum):
     zpayload = raw_block[1:]
     return (block_level, zpayload)
 
+# Flow control for a map_raw readahead thread. Keeps track of the jobs that
+# have been submitted but not yet consumed, and decides whether there's room
+# for another one. The readahead thread calls submitted() for each job, and
+# finished() when the consumer reports back that it's done with one (which
+# is the oldest one, unless the consumer is taking results out of order).
+class _ReadaheadWindow(object):
+    def __init__(self, min_depth):
+        self._min_depth = min_depth
+        # max number of jobs in flight
+        self.depth = min_depth
+        self.jobs_done = 0
+        # job -> (raw bytes, estimated total bytes) for each job in flight
+        self._jobs = {}
+        self._bytes = 0
+        self._raw_seen = 0
+        self._payload_seen = 0
+
+    def _cost(self, batch):
+        raw = sum(len(frame[2]) for frame in batch)
+        if self._raw_seen:
+            payload = raw * self._payload_seen // self._raw_seen
+        else:
+            payload = raw * READAHEAD_GUESS_EXPANSION
+        return raw, raw + payload
+
+    def has_room(self, batch):
+        if not self._jobs:
+            return True
+        if len(self._jobs) >= self.depth:
+            return False
+        return self._bytes + self._cost(batch)[1] <= READAHEAD_MAX_BYTES
+
+    def submitted(self, job, batch):
+        raw, cost = self._cost(batch)
+        self._jobs[job] = (raw, cost)
+        self._bytes += cost
+
+    # waited is how long the consumer had to wait for this job's results,
+    # and consumed is how long it then spent on them.
+    def finished(self, job, payload_bytes, waited, consumed):
+        raw, cost = self._jobs.pop(job)
+        self._bytes -= cost
+        self.jobs_done += 1
+        self._raw_seen += raw
+        self._payload_seen += payload_bytes
+        if waited * READAHEAD_WAIT_RATIO > consumed:
+            # The workers (or the IO) are falling behind, so give them more
+            # to do -- but only if that's what was holding them back.
+            if len(self._jobs) + 1 >= self.depth:
+                self.depth += 1
+        else:
+            self.depth = max(self.depth - 1, self._min_depth)
+
+# Transports may hand us memoryviews, which can't be pickled, so anything
+# that's bound for a worker process has to be converted to bytes first.
+def _to_bytes(buf):
+    if isinstance(buf, memoryview):
+        return buf.tobytes()
+    return buf
+
+# Returns a SharedMemoryRing big enough to keep all the workers busy, or None
+# if shared memory isn't available. The slots are only created as they're
+# needed, and there are never more of them than fit in READAHEAD_MAX_BYTES
+# (which limits how much the jobs in flight can hold anyway); past that, jobs
+# get pickled.
+def _make_shared_memory_ring(parallelism):
+    if not have_shared_memory:  # pragma: no cover
+        return None
+    slot_size = SHARED_MEMORY_INPUT_SIZE + SHARED_MEMORY_OUTPUT_SIZE
+    # one job per worker in flight, plus one being consumed, plus one being
+    # filled
+    num_slots = min(parallelism + 2, READAHEAD_MAX_BYTES // slot_size)
+    try:
+        return SharedMemoryRing(max(num_slots, 1),
+                                SHARED_MEMORY_INPUT_SIZE,
+                                SHARED_MEMORY_OUTPUT_SIZE,
+                                lazy=True)
+    except EnvironmentError:
+        return None
+
+def _resolve_parallelism(parallelism):
+    if parallelism == "guess":
+        # XX put an upper bound on this
+        parallelism = multiprocessing.cpu_count()
+    if parallelism < 0:
+        raise ValueError("parallelism must be >= 0 or \"guess\"")
+    return parallelism
+
+def _start_process_pool(parallelism):
+    prepare_for_workers()
+    return (ProcessPoolExecutor(parallelism),
+            _make_shared_memory_ring(parallelism))
+
+# The process-wide worker pool used by ZS objects that were created with
+# executor="shared". Like any other pool, it's only started once it's
+# needed.
+_shared_pool_lock = threading.Lock()
+_shared_pool_parallelism = "guess"
+# (executor, shared memory ring), once started
+_shared_pool = None
+_shared_pool_atexit_registered = False
+
+def set_shared_pool_size(parallelism):
+    """Set the number of worker processes in the shared worker pool.
+
+    The shared pool is used by all :class:`ZS` objects opened with
+    ``executor="shared"``, which is handy when you have lots of .zs files
+    open at once: otherwise each one would get its own set of worker
+    processes. ``parallelism`` has the same meaning as for :class:`ZS`
+    (except that 0 is not allowed); the default is ``"guess"``.
+
+    If the shared pool is already running, then it is shut down (see
+    :func:`shutdown_shared_pool`), and a new one of the requested size will
+    be started the next time it's needed.
+    """
+    global _shared_pool_parallelism
+    if _resolve_parallelism(parallelism) == 0:
+        raise ValueError("shared pool size must be >= 1")
+    shutdown_shared_pool()
+    with _shared_pool_lock:
+        _shared_pool_parallelism = parallelism
+
+def shutdown_shared_pool():
+    """Shut down the shared worker pool, if it's running.
+
+    This is done automatically at exit, so you only need it if you want the
+    worker processes to go away sooner. Any :class:`ZS` objects which use
+    the shared pool should not be in the middle of any operations when this
+    is called. If they are used again afterwards, then a new pool is
+    started.
+    """
+    global _shared_pool
+    with _shared_pool_lock:
+        pool = _shared_pool
+        _shared_pool = None
+    if pool is not None:
+        executor, ring = pool
+        executor.shutdown()
+        if ring is not None:
+            ring.close()
+
+def _get_shared_pool():
+    global _shared_pool, _shared_pool_atexit_registered
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = _start_process_pool(
+                _resolve_parallelism(_shared_pool_parallelism))
+            if not _shared_pool_atexit_registered:
+                atexit.register(shutdown_shared_pool)
+                _shared_pool_atexit_registered = True
+        return _shared_pool
+
+def _is_thread_pool(executor):
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:  # pragma: no cover
+        return False
+    return isinstance(executor, ThreadPoolExecutor)
+
 # exception that can be raised by map_raw_block callback functions
 class _ZSMapStop(Exception):
     pass
 
-# sentinel used for communication between _map_raw_helper and main process,
-# and also between _block_map_helper and main process.
+# sentinel used for communication between _block_map_helper and
+# _map_raw_helper.
 class _ZS_MAP_SKIP(object):
     pass
 
-def _map_raw_helper(offset, block_length, raw_block, checksum,
-                    skip_index, start, stop, fn, args, kwargs):
-    block_level, zpayload = _check_block(offset, raw_block, checksum)
-    if block_level >= FIRST_EXTENSION_LEVEL:
-        return _ZS_MAP_SKIP
-    if skip_index and block_level > 0:
-        return _ZS_MAP_SKIP
-    return fn(offset, block_length, block_level, zpayload, start, stop,
-              *args, **kwargs)
+# sentinel used for communication between _map_raw_helper and main process.
+class _ZS_MAP_STOP(object):
+    pass
 
-def _decompress_helper(offset, block_length,
-                       block_level, zpayload, start, stop, decompress_fn):
+# Processes a batch of frames, and returns (results, payload_bytes), where
+# results is a list of the callback's return values, terminated by
+# _ZS_MAP_STOP if the callback asked to stop, and payload_bytes is the total
+# size of the decompressed payloads (which the readahead thread uses to
+# estimate how much memory its jobs tie up).
+#
+# A frame whose checksum is None is a data block that was found in the data
+# block cache; its raw_block is the already-decompressed payload.
+def _map_raw_helper(frames, skip_index, start, stop, decompress_fn,
+                    fn, args, kwargs):
+    results = []
+    payload_bytes = 0
+    for (offset, block_length, raw_block, checksum) in frames:
+        if checksum is None:
+            block_level, payload = 0, raw_block
+        else:
+            block_level, zpayload = _check_block(offset, raw_block, checksum)
+            if block_level >= FIRST_EXTENSION_LEVEL:
+                continue
+            if skip_index and block_level > 0:
+                continue
+            payload = decompress_fn(zpayload)
+        payload_bytes += len(payload)
+        try:
+            result = fn(offset, block_length, block_level, payload,
+                        start, stop, *args, **kwargs)
+        except _ZSMapStop:
+            results.append(_ZS_MAP_STOP)
+            break
+        if result is not _ZS_MAP_SKIP:
+            results.append(result)
+    fold_results = getattr(fn, "fold_results", None)
+    if fold_results is not None:
+        results = fold_results(results)
+    return results, payload_bytes
+
+def _payload_helper(offset, block_length, block_level, payload, start, stop):
     # stopping has to be left to the next level up
-    return decompress_fn(zpayload)
+    return (offset, payload)
+
+# Copies a batch of frames into the input half of a shared memory slot, and
+# returns a description of where they went, or None if they don't fit.
+def _fill_shared_slot(slot, frames):
+    layout = []
+    pos = 0
+    for (offset, block_length, raw_block, checksum) in frames:
+        raw_length = len(raw_block)
+        checksum_length = 0 if checksum is None else len(checksum)
+        if pos + raw_length + checksum_length > slot.input_size:
+            return None
+        slot.buf[pos:pos + raw_length] = raw_block
+        if checksum is not None:
+            slot.buf[pos + raw_length:pos + raw_length + checksum_length] = (
+                checksum)
+        layout.append((offset, block_length, pos, raw_length,
+                       checksum is not None))
+        pos += raw_length + checksum_length
+    return layout
+
+# A payload that was left in a shared memory slot, at
+# slot.buf[slot.input_size + start:slot.input_size + start + length].
+_SharedPayload = namedtuple("_SharedPayload", ["start", "length"])
+
+# The worker side of _fill_shared_slot. Runs _map_raw_helper on the frames
+# found in shared memory. If payload_index is not None, then the results
+# should be tuples with a payload at that index (see _payload_helper), and as
+# many of the payloads as will fit are written back into the slot and
+# replaced by _SharedPayload objects.
+def _map_raw_shared_helper(slot_name, input_size, layout, payload_index,
+                           skip_index, start, stop, decompress_fn,
+                           fn, args, kwargs):
+    buf = attach(slot_name)
+    frames = []
+    for (offset, block_length, pos, raw_length, has_checksum) in layout:
+        if has_checksum:
+            checksum = buf[pos + raw_length:pos + raw_length + CRC_LENGTH]
+        else:
+            checksum = None
+        frames.append((offset, block_length, buf[pos:pos + raw_length],
+                       checksum))
+    try:
+        results, payload_bytes = _map_raw_helper(frames, skip_index,
+                                                 start, stop, decompress_fn,
+                                                 fn, args, kwargs)
+        if payload_index is not None:
+            out_pos = 0
+            out_size = len(buf) - input_size
+            for i, result in enumerate(results):
+                if result is _ZS_MAP_STOP:
+                    continue
+                payload = result[payload_index]
+                length = len(payload)
+                if out_pos + length <= out_size:
+                    out_start = input_size + out_pos
+                    buf[out_start:out_start + length] = payload
+                    payload = _SharedPayload(out_pos, length)
+                    out_pos += length
+                else:
+                    # (payloads can be views onto the input, e.g. with the
+                    # "none" codec)
+                    payload = _to_bytes(payload)
+                results[i] = (result[:payload_index] + (payload,)
+                              + result[payload_index + 1:])
+        return results, payload_bytes
+    finally:
+        for frame in frames:
+            frame[2].release()
+            if frame[3] is not None:
+                frame[3].release()
+
+# Wraps the future for a _map_raw_shared_helper job, and hands the slot back
+# to the ring once it's no longer needed.
+class _SharedMemoryFuture(object):
+    def __init__(self, future, ring, slot, payload_index):
+        self._future = future
+        self._ring = ring
+        self._slot = slot
+        self._payload_index = payload_index
+        self._views = []
+
+    # The returned payloads point into the slot, so they're only valid until
+    # release() is called.
+    def result(self):
+        results, payload_bytes = self._future.result()
+        i = self._payload_index
+        if i is not None:
+            view = self._slot.buf[self._slot.input_size:]
+            self._views.append(view)
+            for j, result in enumerate(results):
+                if result is _ZS_MAP_STOP:
+                    continue
+                payload = result[i]
+                if isinstance(payload, _SharedPayload):
+                    payload = view[payload.start:
+                                   payload.start + payload.length]
+                    self._views.append(payload)
+                    results[j] = result[:i] + (payload,) + result[i + 1:]
+        return results, payload_bytes
+
+    def release(self):
+        # Anyone who hangs onto a payload past this point gets an error
+        # instead of whatever ends up in the slot next. (This also means
+        # that stray references can't stop the ring from being closed.)
+        for view in self._views:
+            try:
+                view.release()
+            except BufferError:  # pragma: no cover
+                pass
+        self._views = []
+        self._ring.release(self._slot)
+
+    def cancel(self):
+        self._future.cancel()
+        # If the job is already running, then we can't reuse the slot until
+        # it's finished with it.
+        self._future.add_done_callback(lambda _: self.release())
+
+# Returns whichever of the given map_raw futures finishes first.
+def _first_completed_map_future(futures):
+    inner = {}
+    for future in futures:
+        if isinstance(future, _SharedMemoryFuture):
+            inner[future._future] = future
+        else:
+            inner[future] = future
+    return inner[first_completed(list(inner))]
 
 def _trim_records(records, start, stop):
     if records[0] < start:
@@ -128,10 +593,8 @@ def _trim_records(records, start, stop):
         records = records[:bisect_left(records, stop)]
     return records
 
-def _block_map_helper(offset, block_length, block_level, zpayload,
-                      start, stop, decompress_fn,
-                      user_fn, user_args, user_kwargs):
-    payload = decompress_fn(zpayload)
+def _block_map_helper(offset, block_length, block_level, payload,
+                      start, stop, user_fn, user_args, user_kwargs):
     records = unpack_data_records(payload)
     if stop is not None and records[0] >= stop:
         raise _ZSMapStop()
@@ -140,6 +603,153 @@ def _block_map_helper(offset, block_length, block_level, zpayload,
         return _ZS_MAP_SKIP
     return user_fn(records, *user_args, **user_kwargs)
 
+def _block_map_packed_helper(offset, block_length, block_level, payload,
+                             start, stop, user_fn, user_args, user_kwargs):
+    records = PackedRecords.from_block(payload)
+    if stop is not None and records[0].tobytes() >= stop:
+        raise _ZSMapStop()
+    records = trim_packed(records, start, stop)
+    if not records:
+        return _ZS_MAP_SKIP
+    return user_fn(records, *user_args, **user_kwargs)
+
+def _search_filter_helper(offset, block_length, block_level, payload,
+                          start, stop, where, project):
+    records = unpack_data_records(payload)
+    if stop is not None and records[0] >= stop:
+        raise _ZSMapStop()
+    records = _trim_records(records, start, stop)
+    if where is not None:
+        records = [record for record in records if where(record)]
+    if project is not None:
+        records = [project(record) for record in records]
+    if not records:
+        return _ZS_MAP_SKIP
+    return records
+
+# Used by block_reduce(). Each call works like _block_map_helper, and then
+# _map_raw_helper uses fold_results to combine all the results for a batch
+# into one, so only that one has to be sent back to the main process. If
+# 'pickled' is true, then the partial results that get passed around are
+# pickled, so that the main process can hand them from one combine job to the
+# next (see ZS._combine_partials) without having to unpickle them itself.
+class _BlockReduceHelper(object):
+    def __init__(self, map_fn, combine_fn, user_args, user_kwargs,
+                 pickled):
+        self.map_fn = map_fn
+        self.combine_fn = combine_fn
+        self.user_args = user_args
+        self.user_kwargs = user_kwargs
+        self.pickled = pickled
+
+    def wrap(self, value):
+        if self.pickled:
+            return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        return value
+
+    def unwrap(self, partial):
+        if self.pickled:
+            return pickle.loads(partial)
+        return partial
+
+    def combine(self, left, right):
+        return self.wrap(self.combine_fn(self.unwrap(left),
+                                         self.unwrap(right)))
+
+    def __call__(self, offset, block_length, block_level, payload,
+                 start, stop):
+        return _block_map_helper(offset, block_length, block_level, payload,
+                                 start, stop, self.map_fn,
+                                 self.user_args, self.user_kwargs)
+
+    # Folds a list of results into a single result (followed by
+    # _ZS_MAP_STOP, if it was there before).
+    def fold_results(self, results):
+        stopped = results and results[-1] is _ZS_MAP_STOP
+        if stopped:
+            results = results[:-1]
+        folded = []
+        if results:
+            value = results[0]
+            for result in results[1:]:
+                value = self.combine_fn(value, result)
+            folded.append(self.wrap(value))
+        if stopped:
+            folded.append(_ZS_MAP_STOP)
+        return folded
+
+# Runs a combine job for block_reduce.
+def _combine_helper(helper, left, right):
+    return helper.combine(left, right)
+
+# A partial result for block_reduce that's still being combined.
+class _PendingCombine(object):
+    def __init__(self, future):
+        self.future = future
+
+    # (serial futures don't run until .result() is called, so they're always
+    # ready)
+    def ready(self):
+        return not hasattr(self.future, "done") or self.future.done()
+
+def _partial_ready(partial):
+    return not isinstance(partial, _PendingCombine) or partial.ready()
+
+def _partial_value(partial):
+    if isinstance(partial, _PendingCombine):
+        return partial.future.result()
+    return partial
+
+# sentinel for block_reduce's default initial value
+class _NO_INITIAL(object):
+    pass
+
+# Used by get_many(). 'queries' is a sorted list of (key, idx) pairs; returns
+# the idx of each key which is present.
+def _get_many_lookup(payload, queries):
+    found = data_block_contains_many(payload, [key for (key, _) in queries])
+    return [idx for ((_, idx), hit) in zip(queries, found) if hit]
+
+# Used by search_many(). 'queries' is a list of (start, stop, idx) tuples;
+# returns a list of (idx, records) pairs.
+def _search_many_lookup(payload, queries):
+    records = unpack_data_records(payload)
+    results = []
+    for (start, stop, idx) in queries:
+        lo = bisect_left(records, start)
+        if stop is None:
+            hi = len(records)
+        else:
+            hi = bisect_left(records, stop, lo)
+        if lo < hi:
+            results.append((idx, records[lo:hi]))
+    return results
+
+# 'jobs' is a list of (offset, chunk, queries) tuples, where each chunk
+# contains one data block. Returns a list of (offset, payload, result)
+# tuples, where result comes from calling lookup_fn on the block, and payload
+# is the decompressed block if return_payloads is true, or else None.
+def _lookup_helper(jobs, decompress_fn, lookup_fn, return_payloads):
+    results = []
+    for (offset, chunk, queries) in jobs:
+        raw_block, checksum = _split_single_block(offset, chunk)
+        block_level, zpayload = _check_block(offset, raw_block, checksum)
+        if block_level != 0:
+            raise ZSCorrupt("%s: expecting data block but found level %s "
+                            "block" % (offset, block_level))
+        payload = decompress_fn(zpayload)
+        result = lookup_fn(payload, queries)
+        if not return_payloads:
+            payload = None
+        results.append((offset, payload, result))
+    return results
+
+# Same, but for blocks that are already in the data block cache. 'blocks' is
+# a list of (offset, payload, queries) tuples.
+def _lookup_cached_helper(blocks, lookup_fn):
+    return [(offset, None, lookup_fn(payload, queries))
+            for (offset, payload, queries) in blocks]
+
 def _dump_helper(records, terminator, length_prefixed):
     if length_prefixed is None:
         records.append(b"")
@@ -149,9 +759,15 @@ def _dump_helper(records, terminator, length_prefixed):
         write_length_prefixed(out, records, length_prefixed)
         return out.getvalue()
 
-def _validate_helper(offset, block_length, block_level, zpayload, start, stop,
-                 decompress_fn):
-    return (offset, block_length, block_level, decompress_fn(zpayload))
+def _validate_helper(offset, block_length, block_level, payload, start, stop):
+    return (offset, block_length, block_level, payload)
+
+# For the callbacks whose whole point is to return payloads, where to find
+# the payload in their results.
+_PAYLOAD_INDEX = {
+    _payload_helper: 1,
+    _validate_helper: 3,
+}
 
 # A simple LRU cache. This has a somewhat awkward API because we don't want it
 # to ever hold a reference to the ZS object, because that would create a
@@ -206,6 +822,66 @@ def test_LRU():
     assert null_cache.lru_call(f, 3) == 9
     assert calls == [2, 2, 3]
 
+# Like _LRU, but bounded by the total size (in bytes) of the values it holds,
+# rather than by how many there are, and with an explicit get/put API. It is
+# shared between the main thread and readahead threads, so it has a lock.
+class _ByteLRU(object):
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Returns None if key is not present.
+    def get(self, key):
+        with self._lock:
+            value = self._data.pop(key, None)
+            if value is not None:
+                # reinsert to move it to the end
+                self._data[key] = value
+            return value
+
+    def put(self, key, value):
+        if len(value) > self._max_bytes:
+            return
+        # The value might be a view onto memory that's about to be reused
+        value = _to_bytes(value)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._data[key] = value
+            self._bytes += len(value)
+            while self._bytes > self._max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= len(evicted)
+
+def test__ByteLRU():
+    cache = _ByteLRU(10)
+    assert cache.get(1) is None
+    cache.put(1, b"aaaa")
+    cache.put(2, b"bbbb")
+    assert cache.get(1) == b"aaaa"
+    # 2 is now least-recently-used, and 4 + 4 + 3 > 10
+    cache.put(3, b"ccc")
+    assert cache.get(2) is None
+    assert cache.get(1) == b"aaaa"
+    assert cache.get(3) == b"ccc"
+    # replacing a value updates the size accounting
+    cache.put(3, b"cc")
+    cache.put(4, b"dddd")
+    assert cache.get(1) == b"aaaa"
+    assert cache.get(3) == b"cc"
+    assert cache.get(4) == b"dddd"
+    # values that could never fit are not stored, and don't flush the cache
+    cache.put(5, b"x" * 11)
+    assert cache.get(5) is None
+    assert cache.get(1) == b"aaaa"
+
+    null_cache = _ByteLRU(0)
+    null_cache.put(1, b"a")
+    assert null_cache.get(1) is None
+
 class ZS(object):
     """Object representing a .zs file opened for reading.
 
@@ -227,10 +903,39 @@ class ZS(object):
       ``parallelism="guess"`` means to spawn one worker process per available
       CPU.
 
-      Note that if you know that you are going to read just a few records on
-      each search, then parallelism=0 may be slightly faster; this saves the
-      overhead of setting up the worker processes, and they only really help
-      when doing large bulk reads.
+      The workers aren't actually started until some operation reads
+      enough blocks to make them worthwhile, so opening a file and doing a
+      few quick lookups is cheap either way. Still, if you know that you are
+      only going to read a few records on each search, then parallelism=0
+      may be slightly faster, since the workers only really help when doing
+      large bulk reads.
+
+    :arg executor: What kind of workers to use when ``parallelism`` is
+      non-zero. The default, ``"process"``, uses worker processes.
+      ``"thread"`` uses worker threads in the current process
+      instead. Since decompression releases the GIL, threads can
+      decompress in parallel too, and they avoid the cost of pickling every
+      block over to a worker and every decompressed payload back, which
+      often dominates for :meth:`search` calls that only touch a moderate
+      number of blocks. On the other hand, any pure-Python work
+      (e.g. unpacking records, or your :meth:`block_map` callback) still
+      runs one thread at a time. As a bonus, when using threads the
+      callbacks passed to :meth:`block_map` and friends don't need to be
+      pickleable.
+
+      You can also pass in your own executor object, e.g. a
+      :class:`concurrent.futures.ThreadPoolExecutor` which you want to share
+      between several :class:`ZS` objects. In this case ``parallelism`` is
+      only used to decide how much work to keep queued up, and
+      :meth:`close` leaves the executor running. Jobs are submitted in
+      pickleable form unless the executor is a
+      :class:`concurrent.futures.ThreadPoolExecutor`.
+
+      Finally, ``"shared"`` uses a single pool of worker processes shared
+      by all :class:`ZS` objects in this process that ask for it. This is
+      useful if you have many files open at once, which would otherwise
+      each get their own set of workers. With this option, ``parallelism``
+      is ignored; use :func:`set_shared_pool_size` instead.
 
     :arg index_block_cache: The number of index blocks to keep cached in
       memory. This speeds up repeated queries. Larger values provide better
@@ -238,6 +943,34 @@ class ZS(object):
       as large as your file's :attr:`root_index_level`, or else the cache will
       be useless.
 
+    :arg data_block_cache: The number of bytes of decompressed data blocks to
+      keep cached in memory. Repeated :meth:`get`, :meth:`contains`,
+      :meth:`search` etc. calls which land on a cached block skip fetching and
+      decompressing it, which can be a big win when the same part of the
+      file is queried again and again (especially with slow codecs like
+      lzma). :meth:`block_map` and friends use blocks that are already
+      cached, but don't add new blocks to the cache, so that one big bulk
+      job won't flush out all your hot blocks. The default of 0 disables
+      this cache.
+
+    :arg http_connections: When accessing a file by ``url``, the maximum
+      number of keep-alive connections to keep open to the server for
+      reuse. (Ignored for local files.)
+
+    :arg http_cache_dir: When accessing a file by ``url``, a local directory
+      in which to keep copies of the blocks that are fetched by point
+      lookups (:meth:`get`, :meth:`get_many`, etc.) and by walking the
+      index, so that re-opening the same file later doesn't have to
+      download them again. Cached blocks are checked just like downloaded
+      ones, and are tied to the exact file they came from (as identified
+      by its header), so a changed file never picks up stale blocks. The
+      directory can be shared between files, and between processes. The
+      default of None disables this cache. (Ignored for local files.)
+
+    :arg http_cache_size: The maximum size of ``http_cache_dir``, in
+      bytes. When it grows past this, the least recently used blocks are
+      deleted.
+
     This object can be used as a context manager, e.g.::
 
         with ZS("./my/favorite.zs") as zs_obj:
@@ -253,15 +986,29 @@ class ZS(object):
 
     """
     def __init__(self, path=None, url=None,
-                 parallelism="guess", index_block_cache=32):
+                 parallelism="guess", index_block_cache=32,
+                 data_block_cache=0, http_connections=4,
+                 http_cache_dir=None, http_cache_size=2 ** 30,
+                 executor="process"):
         if path is not None and url is None:
             self._transport = FileTransport(path)
         elif path is None and url is not None:
-            self._transport = HTTPTransport(url)
+            self._transport = HTTPTransport(url, http_connections)
         else:
             raise ValueError("exactly one of path= or url= must be given")
 
-        header, self._header_end = self._get_header()
+        use_disk_cache = (self._transport.remote
+                          and http_cache_dir is not None)
+        # With a warm disk cache, the tail would mostly be blocks we already
+        # have.
+        if self._transport.remote and not use_disk_cache:
+            self._transport.prefetch_tail(TAIL_SIZE_GUESS)
+        header, self._header_end, header_encoded = self._get_header()
+        if use_disk_cache:
+            self._disk_cache = DiskBlockCache(http_cache_dir, http_cache_size,
+                                              header_encoded)
+        else:
+            self._disk_cache = None
 
         self.root_index_offset = header["root_index_offset"]
         self.root_index_length = header["root_index_length"]
@@ -284,18 +1031,40 @@ class ZS(object):
         if not isinstance(self.metadata, dict):
             raise ZSCorrupt("bad metadata")
 
-        if parallelism == "guess":
-            # XX put an upper bound on this
-            parallelism = multiprocessing.cpu_count()
-        self._parallelism = parallelism
-        if self._parallelism < 0:
-            raise ValueError("parallelism must be >= 0 or \"guess\"")
-        if parallelism == 0:
-            self._executor = SerialExecutor()
+        if executor == "shared":
+            with _shared_pool_lock:
+                parallelism = _shared_pool_parallelism
+        self._parallelism = _resolve_parallelism(parallelism)
+        # For cheap work that isn't worth shipping off to the worker pool
+        self._serial_executor = SerialExecutor()
+        # Whether jobs get pickled, i.e. can't contain memoryviews
+        self._executor_needs_bytes = False
+        # Whether we should shut down the executor in close()
+        self._owns_executor = True
+        # For passing data to and from worker processes, if possible
+        self._shared_memory = None
+        # Our own pools are started lazily, by _get_pool.
+        self._executor = None
+        self._executor_kind = executor
+        self._executor_lock = threading.Lock()
+        if executor in ("process", "thread", "shared"):
+            if self._parallelism == 0:
+                self._executor = self._serial_executor
+            elif executor == "process":
+                self._executor_needs_bytes = True
+            elif executor == "shared":
+                self._executor_needs_bytes = True
+                self._owns_executor = False
+        elif hasattr(executor, "submit"):
+            self._executor = executor
+            self._owns_executor = False
+            self._executor_needs_bytes = not _is_thread_pool(executor)
         else:
-            self._executor = ProcessPoolExecutor(parallelism)
+            raise ValueError("executor must be \"process\", \"thread\", "
+                             "\"shared\", or an executor object")
 
         self._index_block_lru = _LRU(index_block_cache)
+        self._data_block_cache = _ByteLRU(data_block_cache)
 
         self._mrbs = weakref.WeakKeyDictionary()
         self._closed = False
@@ -304,6 +1073,29 @@ class ZS(object):
         if self._closed:
             raise ZSError("attemped operation on closed ZS file")
 
+    # Returns (executor, shared memory ring or None) to use for an operation
+    # that's waiting on about its 'progress'th block. Until it gets
+    # far enough to make it worth starting up a worker pool, we use the
+    # serial executor.
+    def _get_pool(self, progress):
+        if self._executor_kind == "shared" and self._parallelism > 0:
+            if _shared_pool is None and progress <= LAZY_POOL_BLOCKS:
+                return self._serial_executor, None
+            # (Not cached, in case someone calls shutdown_shared_pool.)
+            return _get_shared_pool()
+        if self._executor is None:
+            if progress <= LAZY_POOL_BLOCKS:
+                return self._serial_executor, None
+            with self._executor_lock:
+                if self._executor is None:
+                    if self._executor_kind == "process":
+                        executor, self._shared_memory = _start_process_pool(
+                            self._parallelism)
+                    else:
+                        executor = ThreadPoolExecutor(self._parallelism)
+                    self._executor = executor
+        return self._executor, self._shared_memory
+
     def _get_header(self):
         chunk = self._transport.chunk_read(0, HEADER_SIZE_GUESS)
         stream = BytesIO(chunk)
@@ -330,7 +1122,7 @@ class ZS(object):
             raise ZSCorrupt("%s: header checksum mismatch"
                              % (self._transport.name,))
 
-        return _decode_header_data(header_encoded), header_end
+        return _decode_header_data(header_encoded), header_end, header_encoded
 
     @property
     def root_index_level(self):
@@ -354,13 +1146,40 @@ class ZS(object):
         return self._index_block_lru.lru_call(self._get_index_block_impl,
                                               offset, block_length)
 
+    # Fetches and checks a single block whose location we already know (from
+    # the header or from an index block). Returns (block_level, zpayload).
+    def _get_block(self, offset, block_length, kind):
+        chunk = self._disk_cached_chunk(offset, block_length)
+        from_cache = chunk is not None
+        if not from_cache:
+            chunk = self._transport.chunk_read(offset, block_length)
+            if len(chunk) != block_length:
+                raise ZSCorrupt("partial read on %s block @ %s, length %s"
+                                 % (kind, offset, block_length))
+        raw_block, checksum = _split_single_block(offset, chunk)
+        result = _check_block(offset, raw_block, checksum)
+        if self._disk_cache is not None and not from_cache:
+            self._disk_cache.put(offset, chunk)
+        return result
+
+    # Returns the raw bytes of a block from the on-disk cache, or None if it
+    # isn't there. Damaged cache files are treated as missing (and deleted).
+    def _disk_cached_chunk(self, offset, block_length):
+        if self._disk_cache is None:
+            return None
+        chunk = self._disk_cache.get(offset, block_length)
+        if chunk is None:
+            return None
+        try:
+            raw_block, checksum = _split_single_block(offset, chunk)
+            _check_block(offset, raw_block, checksum)
+        except ZSCorrupt:
+            self._disk_cache.discard(offset)
+            return None
+        return chunk
+
     def _get_index_block_impl(self, offset, block_length):
-        chunk = self._transport.chunk_read(offset, block_length)
-        if len(chunk) != block_length:
-            raise ZSCorrupt("partial read on index block @ %s, length %s"
-                             % (offset, block_length))
-        raw_block, checksum = _get_raw_block_unchecked(BytesIO(chunk))
-        block_level, zpayload = _check_block(offset, raw_block, checksum)
+        block_level, zpayload = self._get_block(offset, block_length, "index")
         if block_level == 0:
             raise ZSCorrupt("%s:%s: "
                              "expecting index block but found data block"
@@ -415,6 +1234,154 @@ class ZS(object):
             if block_level - 1 == 0:
                 return offset
 
+    # Returns (offset, block_length) for the only data block that could
+    # possibly contain a record equal to the needle, or None if the needle
+    # sorts before every record in the file.
+    #
+    # Unlike _find_ge_block(needle, True), this handles the case where the
+    # needle is exactly equal to the first key in a block, e.g. if our blocks
+    # are
+    #    [b c] [d e]
+    # and our needle is "d", then this returns the "d" block, not the "b"
+    # block.
+    def _find_data_block(self, needle):
+        offset = self.root_index_offset
+        block_length = self.root_index_length
+        while True:
+            block_level, values = self._get_index_block(offset, block_length)
+
+            assert block_level > 0
+            keys, offsets, block_lengths = values
+            # The last block whose first entry is <= the needle.
+            idx = bisect_right(keys, needle) - 1
+            if idx < 0:
+                return None
+            offset = offsets[idx]
+            block_length = block_lengths[idx]
+            if block_level - 1 == 0:
+                return offset, block_length
+
+    def _get_data_block(self, offset, block_length):
+        payload = self._data_block_cache.get(offset)
+        if payload is not None:
+            return payload
+        block_level, zpayload = self._get_block(offset, block_length, "data")
+        if block_level != 0:
+            raise ZSCorrupt("%s:%s: "
+                             "expecting data block but found level %s block"
+                             % (self._transport.name, offset, block_level))
+        payload = self._decompress(zpayload)
+        self._data_block_cache.put(offset, payload)
+        return payload
+
+    # Walks the index tree once on behalf of a whole collection of queries.
+    # span_fn(keys, query) should return the (lo, hi) indices (inclusive) of
+    # the entries in an index block whose subtrees might be relevant to the
+    # query. Returns a list of (offset, block_length, queries) tuples, one
+    # for each data block that needs to be looked at, in file order. Queries
+    # are kept in the same relative order that they were passed in.
+    def _route_queries(self, queries, span_fn):
+        routes = []
+        def walk(offset, block_length, queries):
+            block_level, values = self._get_index_block(offset, block_length)
+            assert block_level > 0
+            keys, offsets, block_lengths = values
+            children = {}
+            for query in queries:
+                lo, hi = span_fn(keys, query)
+                for i in range(max(lo, 0), hi + 1):
+                    children.setdefault(i, []).append(query)
+            for i in sorted(children):
+                if block_level - 1 == 0:
+                    routes.append((offsets[i], block_lengths[i], children[i]))
+                else:
+                    walk(offsets[i], block_lengths[i], children[i])
+        if queries:
+            walk(self.root_index_offset, self.root_index_length, queries)
+        return routes
+
+    # Takes the output of _route_queries, fetches each data block exactly
+    # once, and calls lookup_fn(payload, queries) on it in the worker pool.
+    # Yields the results in file order. Runs of adjacent blocks are fetched
+    # with a single read, and handed to a single job. Blocks which are in the
+    # data block cache are looked up directly in this thread, and blocks
+    # which are in the disk cache are read from there.
+    def _lookup_blocks(self, routes, lookup_fn):
+        # Each run is (run_start, run_length, run_blocks, chunk), where
+        # run_length is None for blocks in the data block cache, and chunk
+        # is None if the run still needs to be fetched.
+        runs = []
+        for (offset, block_length, queries) in routes:
+            payload = self._data_block_cache.get(offset)
+            if payload is not None:
+                runs.append((offset, None, [(offset, payload, queries)],
+                             None))
+                continue
+            chunk = self._disk_cached_chunk(offset, block_length)
+            if chunk is not None:
+                runs.append((offset, block_length,
+                             [(offset, block_length, queries)], chunk))
+                continue
+            if runs and runs[-1][1] is not None and runs[-1][3] is None:
+                run_start, run_length, run_blocks, _ = runs[-1]
+                if (run_start + run_length == offset
+                    and run_length + block_length <= MAX_BATCH_BYTES):
+                    run_blocks.append((offset, block_length, queries))
+                    runs[-1] = (run_start, run_length + block_length,
+                                run_blocks, None)
+                    continue
+            runs.append((offset, block_length,
+                         [(offset, block_length, queries)], None))
+
+        # Entries are (future, blocks to add to the disk cache once the
+        # future has checked them)
+        window = deque()
+        max_window = 2 * max(self._parallelism, 1)
+        return_payloads = self._data_block_cache._max_bytes > 0
+        def drain():
+            future, fetched = window.popleft()
+            for (offset, payload, result) in future.result():
+                if payload is not None:
+                    self._data_block_cache.put(offset, payload)
+                yield result
+            for (offset, piece) in fetched:
+                self._disk_cache.put(offset, piece)
+        total_blocks = sum(len(run_blocks) for (_, _, run_blocks, _) in runs)
+        executor, _ = self._get_pool(total_blocks)
+        needs_bytes = (self._executor_needs_bytes
+                       and executor is not self._serial_executor)
+        for (run_start, run_length, run_blocks, chunk) in runs:
+            if len(window) >= max_window:
+                for result in drain():
+                    yield result
+            if run_length is None:
+                window.append((self._serial_executor.submit(
+                    _lookup_cached_helper, run_blocks, lookup_fn), []))
+                continue
+            from_cache = chunk is not None
+            if not from_cache:
+                chunk = self._transport.chunk_read(run_start, run_length)
+                if len(chunk) != run_length:
+                    raise ZSCorrupt("partial read on data block @ %s, "
+                                    "length %s" % (run_start, run_length))
+            if needs_bytes:
+                chunk = _to_bytes(chunk)
+            jobs = []
+            for (offset, block_length, queries) in run_blocks:
+                piece = chunk[offset - run_start:
+                              offset - run_start + block_length]
+                jobs.append((offset, piece, queries))
+            fetched = []
+            if self._disk_cache is not None and not from_cache:
+                fetched = [(offset, piece) for (offset, piece, _) in jobs]
+            window.append((executor.submit(_lookup_helper, jobs,
+                                           self._decompress, lookup_fn,
+                                           return_payloads),
+                           fetched))
+        while window:
+            for result in drain():
+                yield result
+
     def _norm_search_args(self, start, stop, prefix):
         # we intersect start/stop/prefix together
         if start is None:
@@ -485,17 +1452,28 @@ class ZS(object):
     # - shutting down the readahead thread when finished
     # - providing finished results on demand to user code (when they call
     #   next())
-    # - communicating flow control information to the readahead thread, so
-    #   that the workers are kept busy, but not too busy.
+    # - telling the readahead thread each time it's done with a job, along
+    #   with how big the job's payloads were, how long it had to wait for
+    #   the job, and how long it spent on it. This is the flow control
+    #   information that the readahead thread uses to keep the workers busy,
+    #   but not too busy (see _ReadaheadWindow).
     #
     # The readahead thread is responsible for:
     # - performing IO on the actual ZS file (this ensures that it is done in
     #   a serial manner, but without blocking the main thread).
-    # - taking the bytes read from the ZS file, and dispatching them to
-    #   workers to unpack and process.
+    # - deciding how many jobs to keep in flight, within a memory budget.
+    # - taking the bytes read from the ZS file, splitting them into blocks,
+    #   and dispatching them to workers to unpack and process. Blocks are
+    #   dispatched in batches (each batch is one job, and produces a list of
+    #   results), which keeps the per-block overhead in this thread low. When
+    #   the workers are processes, batches (and any payloads coming back) go
+    #   through shared memory slots if possible, rather than being pickled;
+    #   the generator hands each slot back once it's done with the results.
     # - sending the work handles ('futures') back to the main thread. Again,
     #   this is done serially, ensuring that the main thread will get results
-    #   in order (regardless of what order the actual work finishes).
+    #   in order (regardless of what order the actual work finishes) -- unless
+    #   it asked not to, in which case it waits on all the futures it has
+    #   and takes whichever finishes first.
     #
     # When a map_raw generator finishes, is garbage collected, or is ended by
     # an explicit call to its .close() method, then it tells the readahead
@@ -514,9 +1492,6 @@ class ZS(object):
 
     # Sentinels used for communication between the readahead thread and the
     # main thread.
-    class _MAP_CONTINUE(object):
-        pass
-
     class _MAP_QUIT(object):
         pass
 
@@ -537,37 +1512,124 @@ class ZS(object):
                           fn, args, kwargs,
                           command_queue, future_queue):
         try:
-            while command_queue.get() is not self._MAP_QUIT:
-                try:
-                    offset = stream.tell()
-                    (raw_block, checksum) = _get_raw_block_unchecked(stream)
-                    block_length = stream.tell() - offset
-                    if raw_block is None:
-                        future_queue.put(self._MAP_EOF)
+            reader = _BlockFrameReader(stream)
+            pending = deque()
+            window = _ReadaheadWindow(self._parallelism + 1)
+            # The first few jobs (one per worker) get one block each, so
+            # short searches don't decompress lots of blocks they'll never
+            # look at. After that, each job we submit is twice as big as
+            # the last, up to MAX_BATCH_BYTES.
+            batch_frames = 1
+            initial_jobs = self._parallelism + 1
+            if getattr(fn, "fold_results", None) is not None:
+                # (but block_reduce always goes through the whole range)
+                initial_jobs = 0
+            # The batch we've read but haven't submitted yet, because it
+            # doesn't fit in the window.
+            batch = None
+            while True:
+                while batch is None or window.has_room(batch):
+                    if batch is not None:
+                        # The consumer has finished jobs_done jobs, and is
+                        # waiting on the next one; this is how we tell
+                        # whether the scan is getting long enough to be
+                        # worth starting the worker pool. (Counting the
+                        # jobs we've submitted wouldn't work, because we
+                        # always run ahead of the consumer.)
+                        f = self._submit_map_raw_batch(
+                            batch, window.jobs_done + 1,
+                            skip_index, start, stop, fn, args, kwargs)
+                        window.submitted(f, batch)
+                        future_queue.put(f)
+                        batch = None
+                    try:
+                        if not pending:
+                            frames = reader.read_frames()
+                            if not frames:
+                                future_queue.put(self._MAP_EOF)
+                                return
+                            if skip_index:
+                                # Swap in any data blocks that we already
+                                # have decompressed. (We don't do this when
+                                # iterating over index blocks too, i.e. in
+                                # validate(), which is supposed to check
+                                # what's on disk.)
+                                frames = [self._cached_frame(frame)
+                                          for frame in frames]
+                            pending.extend(frames)
+                    # This can happen if, e.g., read_frames errors out in a
+                    # corrupt file.
+                    except Exception:
+                        future_queue.put(self._MapErrorFuture(sys.exc_info()))
                         return
-                    f = self._executor.submit(_map_raw_helper,
-                                              offset, block_length,
-                                              raw_block, checksum,
-                                              skip_index, start, stop,
-                                              fn, args, kwargs)
-                    future_queue.put(f)
-                # This can happen if, e.g., _get_raw_block_unchecked errors
-                # out in a corrupt file.
-                except Exception:
-                    future_queue.put(self._MapErrorFuture(sys.exc_info()))
-            else:
-                # we got a QUIT, which means our consumer has disappeared, so
-                # it would be polite to try and cancel any outstanding jobs.
-                try:
-                    while True:
-                        f = future_queue.get_nowait()
-                        assert f is not self._MAP_EOF
-                        f.cancel()
-                except queue.Empty:
-                    pass
+                    batch = [pending.popleft()]
+                    batch_bytes = len(batch[0][2])
+                    while (pending
+                           and len(batch) < batch_frames
+                           and batch_bytes < MAX_BATCH_BYTES):
+                        batch.append(pending.popleft())
+                        batch_bytes += len(batch[-1][2])
+                    if initial_jobs > 0:
+                        initial_jobs -= 1
+                    else:
+                        batch_frames *= 2
+                command = command_queue.get()
+                if command is self._MAP_QUIT:
+                    break
+                window.finished(*command)
+            # we got a QUIT, which means our consumer has disappeared, so
+            # it would be polite to try and cancel any outstanding jobs.
+            try:
+                while True:
+                    f = future_queue.get_nowait()
+                    assert f is not self._MAP_EOF
+                    f.cancel()
+            except queue.Empty:
+                pass
         finally:
             stream.close()
 
+    def _submit_map_raw_batch(self, batch, jobs_wanted, skip_index,
+                              start, stop, fn, args, kwargs):
+        executor, ring = self._get_pool(jobs_wanted)
+        slot = None
+        if ring is not None:
+            slot = ring.acquire()
+        if slot is not None:
+            layout = _fill_shared_slot(slot, batch)
+            if layout is None:
+                ring.release(slot)
+                slot = None
+        if slot is not None:
+            # Only worth copying payloads back through shared memory if
+            # they're what we're after; otherwise the results are generally
+            # small.
+            payload_index = _PAYLOAD_INDEX.get(fn)
+            f = executor.submit(_map_raw_shared_helper, slot.name,
+                                slot.input_size, layout,
+                                payload_index,
+                                skip_index, start, stop,
+                                self._decompress, fn, args, kwargs)
+            return _SharedMemoryFuture(f, ring, slot, payload_index)
+        if (self._executor_needs_bytes
+            and executor is not self._serial_executor):
+            batch = [(offset, block_length,
+                      _to_bytes(raw_block), _to_bytes(checksum))
+                     for (offset, block_length, raw_block, checksum)
+                     in batch]
+        return executor.submit(_map_raw_helper, batch,
+                               skip_index, start, stop,
+                               self._decompress,
+                               fn, args, kwargs)
+
+    # See _map_raw_helper for the format of the frames this returns.
+    def _cached_frame(self, frame):
+        offset, block_length, _, _ = frame
+        payload = self._data_block_cache.get(offset)
+        if payload is None:
+            return frame
+        return (offset, block_length, payload, None)
+
     def _map_raw_block(self, *args, **kwargs):
         """This is a low-level function with somewhat fiddly semantics.
 
@@ -576,9 +1638,11 @@ class ZS(object):
         It finds all blocks which may contain records that are >= start, and
         then for each such block it calls::
 
-          fn(offset, block_length, block_level, zpayload, start, stop,
+          fn(offset, block_length, block_level, payload, start, stop,
              *args, **kwargs)
 
+        where payload is the decompressed contents of the block.
+
         Key points:
 
         * If skip_index is true, then it skips over index blocks (i.e.,
@@ -587,43 +1651,109 @@ class ZS(object):
         * It unconditionally skips over "extension blocks" (those with level
           >= 64).
 
+        * If skip_index is true, then data blocks found in the data block
+          cache are passed to fn without being decompressed again. Putting
+          blocks into the cache is left to the caller.
+
         * These calls are performed in parallel in however many worker
           processes were configured when this ZS object was created;
           therefore, fn, args, and kwargs must all be pickleable (unless you
-          use parallelism=0).
+          use parallelism=0 or executor="thread").
 
         * The iteration may or may not stop when the 'stop' key is reached. If
           you want it to stop for sure at any point, you must either (a) raise
           a _ZSMapStop from your callback function, or (b) call .close() on
           this generator.
         """
-        gen = self._map_raw_block_gen(*args, **kwargs)
+        gen = self._map_raw_block_gen(True, *args, **kwargs)
+        self._mrbs[gen] = 1
+        return gen
+
+    def _map_raw_block_unordered(self, *args, **kwargs):
+        """Like :meth:`_map_raw_block`, except that results are yielded as
+        soon as they're ready, rather than in file order.
+
+        Results from any one block still come out together and in order. If
+        fn raises _ZSMapStop, then we still wait for the results from all the
+        blocks before that one, but not from any of the blocks after it.
+        """
+        gen = self._map_raw_block_gen(False, *args, **kwargs)
         self._mrbs[gen] = 1
         return gen
 
-    def _map_raw_block_gen(self, start, stop, skip_index, fn, *args, **kwargs):
+    def _map_raw_block_gen(self, ordered, start, stop, skip_index, fn,
+                           *args, **kwargs):
         stream = self._span_stream(start, stop)
         command_queue = queue.Queue()
         future_queue = queue.Queue()
-        for i in range(self._parallelism):
-            command_queue.put(self._MAP_CONTINUE)
         rt = threading.Thread(target=self._readahead_thread,
                               args=(stream,
                                     start, stop, skip_index, fn, args, kwargs,
                                     command_queue, future_queue))
+        # Futures that we've taken off the future_queue but haven't consumed
+        # yet, mapped to their position in the scan. When ordered, there's
+        # never more than one of these.
+        in_flight = {}
         try:
             rt.start()
+            next_seq = 0
+            eof = False
+            # Once some job asks to stop, we don't need any results from the
+            # jobs after it.
+            stop_seq = None
             while True:
-                command_queue.put(self._MAP_CONTINUE)
-                future = future_queue.get()
-                if future is self._MAP_EOF:
+                asked = time.time()
+                while (not eof and stop_seq is None
+                       and not (ordered and in_flight)):
+                    try:
+                        if in_flight:
+                            future = future_queue.get_nowait()
+                        else:
+                            future = future_queue.get()
+                    except queue.Empty:
+                        break
+                    if future is self._MAP_EOF:
+                        eof = True
+                        break
+                    in_flight[future] = next_seq
+                    next_seq += 1
+                if not in_flight:
                     return
-                value = future.result()
-                if value is not _ZS_MAP_SKIP:
-                    yield value
-        except _ZSMapStop:
-            # Some job requested early termination of the loop
-            return
+                if ordered:
+                    future, = in_flight
+                else:
+                    future = _first_completed_map_future(in_flight)
+                seq = in_flight.pop(future)
+                got = time.time()
+                try:
+                    results, payload_bytes = future.result()
+                    # When running serially, result() is where the work
+                    # happens, so that counts as consumer time, not waiting.
+                    if not isinstance(future, _SerialFuture):
+                        got = time.time()
+                    waited = got - asked
+                    for value in results:
+                        if value is _ZS_MAP_STOP:
+                            # Some job requested early termination of the
+                            # loop
+                            if ordered:
+                                return
+                            if stop_seq is None or seq < stop_seq:
+                                stop_seq = seq
+                            break
+                        yield value
+                finally:
+                    if isinstance(future, _SharedMemoryFuture):
+                        future.release()
+                # Tell the readahead thread that this job's memory is free,
+                # and how the workers are keeping up.
+                command_queue.put((future, payload_bytes, waited,
+                                   time.time() - got))
+                if stop_seq is not None:
+                    for (other, other_seq) in list(in_flight.items()):
+                        if other_seq > stop_seq:
+                            other.cancel()
+                            del in_flight[other]
         finally:
             # We can reach this point in a number of situations:
             # - regular exit from above loop
@@ -632,8 +1762,22 @@ class ZS(object):
             # - generator is garbage collected
             command_queue.put(self._MAP_QUIT)
             rt.join()
+            for future in in_flight:
+                future.cancel()
+            # The readahead thread cancels any leftover jobs when it gets our
+            # QUIT -- unless it had already hit EOF and exited, in which case
+            # it's up to us. (This matters because cancelling is what gives
+            # their shared memory slots back.)
+            while True:
+                try:
+                    future = future_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if future is not self._MAP_EOF:
+                    future.cancel()
 
-    def search(self, start=None, stop=None, prefix=None):
+    def search(self, start=None, stop=None, prefix=None,
+               where=None, project=None):
         """Iterate over all records matching the given query.
 
         A record is considered to "match" if:
@@ -653,25 +1797,193 @@ class ZS(object):
         .zs file.
 
         Records are always returned in sorted order.
+
+        :arg where: If given, a function which is called on each record that
+          matches the query, and only those records for which it returns a
+          true value are returned.
+
+        :arg project: If given, a function which is called on each record
+          that would otherwise be returned, and whatever it returns is
+          returned instead.
+
+        ``where`` and ``project`` are called in the worker processes, so if
+        you are going to throw away most of the records, or only need some
+        piece of each one, then this can be much faster than doing it
+        yourself as you iterate. Like with :meth:`block_map`, they have to
+        be pickleable (unless you used ``parallelism=0`` or
+        ``executor="thread"``).
+
+        If you can process records in bulk, then :meth:`search_batches` is
+        faster still.
+        """
+        self._check_closed()
+        with closing(self.search_batches(start, stop, prefix,
+                                         where, project)) as it:
+            for records in it:
+                for record in records:
+                    yield record
+
+    def search_batches(self, start=None, stop=None, prefix=None,
+                       where=None, project=None):
+        """Iterate over all records matching the given query, a batch at a
+        time.
+
+        This takes the same arguments as :meth:`search`, and returns the
+        same records in the same order, except that instead of yielding one
+        record at a time, it yields lists of records (one list per data
+        block, though you shouldn't count on that). None of the lists are
+        empty. This saves a lot of per-record overhead if you can handle a
+        whole list at once -- e.g., by passing it to ``file.writelines()``.
         """
-        # This does decompression in the worker, and unpacking in the main
-        # process (because no point in unpacking, then pickling, then
-        # unpickling)
         self._check_closed()
         start, stop = self._norm_search_args(start, stop, prefix)
         mrb = self._map_raw_block
-        with closing(mrb(start, stop, True,
-                         _decompress_helper, self._decompress)) as it:
-            for data in it:
+        if where is not None or project is not None:
+            # Everything happens in the worker, and only the records we're
+            # going to return come back. (This means that blocks don't get
+            # added to the data block cache, though.)
+            with closing(mrb(start, stop, True, _search_filter_helper,
+                             where, project)) as it:
+                for records in it:
+                    yield records
+            return
+        # This does decompression in the worker, and unpacking in the main
+        # process (because no point in unpacking, then pickling, then
+        # unpickling). And since the decompressed data ends up here anyway,
+        # this is also where it gets added to the data block cache.
+        with closing(mrb(start, stop, True, _payload_helper)) as it:
+            for offset, data in it:
+                self._data_block_cache.put(offset, data)
                 records = unpack_data_records(data)
                 if stop is not None and records[0] >= stop:
                     break
                 records = _trim_records(records, start, stop)
-                for record in records:
-                    yield record
+                if records:
+                    yield records
+
+    def contains(self, key):
+        """Check whether this file contains a record exactly equal to
+        ``key``.
+
+        This is the fastest way to look up a single record: it walks the
+        index to find the one data block that could possibly hold ``key``,
+        and then decompresses and scans just that block, directly in the
+        calling thread. (Unlike :meth:`search`, it doesn't start a readahead
+        thread or use any worker processes.)
+
+        ``key in zs_obj`` is equivalent to ``zs_obj.contains(key)``.
+        """
+        self._check_closed()
+        location = self._find_data_block(key)
+        if location is None:
+            return False
+        payload = self._get_data_block(*location)
+        return data_block_contains(payload, key)
+
+    def __contains__(self, key):
+        return self.contains(key)
+
+    def get(self, key, default=None):
+        """Look up a single record.
+
+        Returns ``key`` if this file contains a record exactly equal to it,
+        and otherwise returns ``default``. Equivalent to (but much faster
+        than)::
+
+          next(zs_obj.search(start=key, stop=key + b"\\x00"), default)
+
+        See :meth:`contains` for details.
+        """
+        if self.contains(key):
+            return key
+        else:
+            return default
+
+    def get_many(self, keys, default=None):
+        """Look up many records at once.
+
+        Returns a list with one entry for each of the given ``keys``, in the
+        same order. Equivalent to::
+
+          [zs_obj.get(key, default) for key in keys]
+
+        but much faster when there are many keys: the keys are sorted and
+        routed through the index together, so each index block is visited
+        at most once, and each data block that might contain any of the
+        keys is fetched and decompressed exactly once. The decompression and
+        lookup work is spread across the worker processes.
+        """
+        self._check_closed()
+        keys = list(keys)
+        queries = sorted(zip(keys, range(len(keys))))
+        def span(index_keys, query):
+            # same logic as _find_data_block
+            idx = bisect_right(index_keys, query[0]) - 1
+            return idx, idx
+        results = [default] * len(keys)
+        routes = self._route_queries(queries, span)
+        for found in self._lookup_blocks(routes, _get_many_lookup):
+            for idx in found:
+                results[idx] = keys[idx]
+        return results
+
+    def search_many(self, ranges):
+        """Run many searches at once.
+
+        Each entry in ``ranges`` is a tuple of arguments that would be passed
+        to :meth:`search`, i.e. ``(start,)``, ``(start, stop)`` or ``(start,
+        stop, prefix)``, with ``None`` allowed anywhere. Returns a list with
+        one entry for each range, in the same order, which is the list of
+        records matching that range. In other words, this is equivalent to::
+
+          [list(zs_obj.search(*r)) for r in ranges]
+
+        but, like :meth:`get_many`, it visits each index block at most once
+        and fetches and decompresses each data block exactly once, no matter
+        how many of the ranges overlap it.
+        """
+        self._check_closed()
+        ranges = list(ranges)
+        # Identical ranges are only looked up once; this maps each distinct
+        # (start, stop) to the indices of the ranges that asked for it.
+        wanted = {}
+        for idx, search_args in enumerate(ranges):
+            search_args = tuple(search_args)
+            if len(search_args) > 3:
+                raise ValueError("each range must have at most 3 entries "
+                                 "(start, stop, prefix), not %r"
+                                 % (search_args,))
+            search_args += (None,) * (3 - len(search_args))
+            start, stop = self._norm_search_args(*search_args)
+            if stop is not None and start >= stop:
+                continue
+            wanted.setdefault((start, stop), []).append(idx)
+        # Sorted by start, then stop (with None, meaning "no limit", last).
+        def range_key(start_stop):
+            start, stop = start_stop
+            return (start, stop is None, stop or b"")
+        distinct = sorted(wanted, key=range_key)
+        queries = [(start, stop, i)
+                   for (i, (start, stop)) in enumerate(distinct)]
+        def span(index_keys, query):
+            # same logic as _find_ge_block
+            start, stop, _ = query
+            lo = bisect_left(index_keys, start) - 1
+            if stop is None:
+                hi = len(index_keys) - 1
+            else:
+                hi = bisect_left(index_keys, stop) - 1
+            return lo, hi
+        results = [[] for _ in ranges]
+        routes = self._route_queries(queries, span)
+        for block_results in self._lookup_blocks(routes, _search_many_lookup):
+            for i, records in block_results:
+                for idx in wanted[distinct[i]]:
+                    results[idx] += records
+        return results
 
     def block_map(self, fn, start=None, stop=None, prefix=None,
-                  args=(), kwargs={}):
+                  args=(), kwargs={}, ordered=True, packed=False):
         """Apply a given function -- in parallel -- to records matching a
         given query. This function is lazy -- if you don't iterate over the
         results, then the function might not be called on all of them.
@@ -704,6 +2016,9 @@ class ZS(object):
         a named module. (Sorry, I didn't make the rules. Feel free to submit
         patches to use a more featureful serialization library like 'dill',
         esp. if you can demonstrate that they don't add too much overhead.)
+        The exception is if you created your :class:`ZS` object with
+        ``executor="thread"``, in which case nothing is pickled -- but then
+        ``fn`` only runs in parallel to the extent that it releases the GIL.
 
         This will be most efficient if ``fn`` performs non-trivial work, and
         especially if it can avoid returning large/complicated structures from
@@ -716,6 +2031,17 @@ class ZS(object):
         database or something), then you can use :meth:`block_exec` instead to
         save a bit of boilerplate.
 
+        By default, results are yielded in the same order as the records
+        they came from, which means that one slow chunk holds up all the
+        results behind it. If you don't care about the order (e.g. you're
+        just adding up counts), then pass ``ordered=False``, and results will
+        be yielded as soon as they're ready instead.
+
+        If you pass ``packed=True``, then instead of a list of bytes objects,
+        ``fn`` gets a :class:`PackedRecords` object, which lets it get at the
+        records without ZS having to copy each one into its own bytes
+        object first.
+
         If you pass ``parallelism=0`` when creating your :class:`ZS` object,
         then this method will perform all work within the main process. This
         makes debugging a lot easier, because it will let you get real
@@ -724,27 +2050,172 @@ class ZS(object):
         """
         self._check_closed()
         start, stop = self._norm_search_args(start, stop, prefix)
-        mrb = self._map_raw_block
-        with closing(mrb(start, stop, True, _block_map_helper,
-                         self._decompress, fn, args, kwargs)) as it:
+        if ordered:
+            mrb = self._map_raw_block
+        else:
+            mrb = self._map_raw_block_unordered
+        if packed:
+            helper = _block_map_packed_helper
+        else:
+            helper = _block_map_helper
+        with closing(mrb(start, stop, True, helper,
+                         fn, args, kwargs)) as it:
             for result in it:
-                if result is not _ZS_MAP_SKIP:
-                    yield result
+                yield result
 
     def block_exec(self, fn, start=None, stop=None, prefix=None,
-                   args=(), kwargs={}):
+                   args=(), kwargs={}, ordered=True, packed=False):
         """Eager version of :meth:`block_map`.
 
         This is equivalent to calling :meth:`block_map`, iterating over the
-        results, and throwing them all away.
+        results, and throwing them all away. (Since the results are thrown
+        away, ``ordered=False`` only changes the order in which calls to
+        ``fn`` are waited for, and can be a bit faster.)
 
         """
         self._check_closed()
         with closing(self.block_map(fn, start, stop, prefix,
-                                    args, kwargs)) as it:
+                                    args, kwargs, ordered, packed)) as it:
             for _ in it:
                 pass
 
+    def block_reduce(self, map_fn, combine_fn, start=None, stop=None,
+                     prefix=None, initial=_NO_INITIAL, args=(), kwargs={}):
+        """Compute a single value from the records matching a given query,
+        in parallel.
+
+        This is like :meth:`block_map`, except that instead of handing the
+        result for each chunk of records back to you, they get combined
+        together, and you just get the final value. Roughly::
+
+            value = initial
+            for result in zs_obj.block_map(map_fn, start, stop, prefix,
+                                           args, kwargs):
+                value = combine_fn(value, result)
+            return value
+
+        (Except that if no ``initial`` is given, then it is left out.)
+
+        The difference is where the combining happens: each job that the
+        worker processes run covers many chunks, and the worker combines the
+        results for all of them into a single value. Then those values are
+        combined pairwise, in a tree, by more jobs in the worker processes,
+        and only the final value is unpickled in the main process. So, for
+        example, if you are adding up counts in dicts, then the main process
+        never has to merge (or unpickle) any dicts except the final one.
+
+        The results are always combined in order, so ``combine_fn`` doesn't
+        have to be commutative (e.g., it can be ``operator.add`` on lists),
+        but it does have to be associative. Like ``map_fn``, it has to be
+        pickleable, and so do the results.
+
+        If no records match, then returns ``initial`` (or None, if no
+        ``initial`` was given).
+
+        """
+        self._check_closed()
+        start, stop = self._norm_search_args(start, stop, prefix)
+        helper = _BlockReduceHelper(map_fn, combine_fn, args, kwargs,
+                                    self._executor_needs_bytes)
+        partials = []
+        with closing(self._map_raw_block(start, stop, True, helper)) as it:
+            for i, partial in enumerate(it):
+                partials.append(partial)
+                self._combine_partials(helper, partials, i + 1, False)
+        self._combine_partials(helper, partials, len(partials), True)
+        if not partials:
+            if initial is _NO_INITIAL:
+                return None
+            return initial
+        value = helper.unwrap(_partial_value(partials[0]))
+        if initial is not _NO_INITIAL:
+            value = combine_fn(initial, value)
+        return value
+
+    # Used by block_reduce. partials is a list of partial results (some of
+    # which may be _PendingCombines), in file order. Replaces each adjacent
+    # pair of them that's ready with a job to combine them. If wait is true,
+    # then keeps going until there's only one left; otherwise, makes just one
+    # pass, so the main thread never waits on a combine job while there are
+    # still map jobs to collect.
+    def _combine_partials(self, helper, partials, progress, wait):
+        while len(partials) > 1:
+            combined = []
+            i = 0
+            while i < len(partials):
+                if (i + 1 < len(partials)
+                    and _partial_ready(partials[i])
+                    and _partial_ready(partials[i + 1])):
+                    executor, _ = self._get_pool(progress)
+                    future = executor.submit(_combine_helper, helper,
+                                             _partial_value(partials[i]),
+                                             _partial_value(partials[i + 1]))
+                    combined.append(_PendingCombine(future))
+                    i += 2
+                else:
+                    combined.append(partials[i])
+                    i += 1
+            stuck = len(combined) == len(partials)
+            partials[:] = combined
+            if not wait:
+                return
+            if stuck:
+                first_completed([partial.future for partial in partials
+                                 if isinstance(partial, _PendingCombine)
+                                 and not partial.ready()])
+
+    def search_columns(self, fields, start=None, stop=None, prefix=None,
+                       delimiter=b"\t", ordered=True):
+        """Iterate over the records matching a given query, split into
+        fields and parsed into columns.
+
+        Each record is split at ``delimiter``, and the fields are parsed
+        according to ``fields``; see :func:`zs.fields.parse_fields` for
+        details. This is done in the worker processes, a data block at a
+        time, so what this yields is one
+        :class:`~collections.OrderedDict` of columns per data block.
+
+        This is equivalent to (but much faster than)::
+
+          for records in zs_obj.search_batches(start, stop, prefix):
+              yield parse_fields(records, fields, delimiter)
+
+        ``ordered`` has the same meaning as for :meth:`block_map`.
+        """
+        self._check_closed()
+        # (parse_fields raises an error if the fields are bad, but better
+        # to do that here than in a worker.)
+        parse_fields([], fields, delimiter)
+        with closing(self.block_map(parse_fields, start, stop, prefix,
+                                    args=(fields, delimiter),
+                                    ordered=ordered, packed=True)) as it:
+            for columns in it:
+                yield columns
+
+    def search_dataframes(self, fields, start=None, stop=None, prefix=None,
+                          delimiter=b"\t", chunksize=100000, ordered=True):
+        """Like :meth:`search_columns`, but yields :class:`pandas.DataFrame`
+        objects of (at least) ``chunksize`` rows each, except perhaps for
+        the last one.
+
+        Requires pandas. Bytes fields are left as bytes objects.
+        """
+        import pandas
+        self._check_closed()
+        chunks = []
+        rows = 0
+        with closing(self.search_columns(fields, start, stop, prefix,
+                                         delimiter, ordered)) as it:
+            for columns in it:
+                chunks.append(columns)
+                rows += len(next(iter(columns.values()), ()))
+                if rows >= chunksize:
+                    yield pandas.DataFrame(concat_columns(chunks))
+                    chunks = []
+                    rows = 0
+        if chunks:
+            yield pandas.DataFrame(concat_columns(chunks))
+
     def __iter__(self):
         """Equivalent to ``zs_obj.search()``."""
         self._check_closed()
@@ -853,8 +2324,7 @@ class ZS(object):
                            block_length))
 
         mrb = self._map_raw_block
-        with closing(mrb(b"", None, False,
-                         _validate_helper, self._decompress)) as it:
+        with closing(mrb(b"", None, False, _validate_helper)) as it:
             for offset, block_length, block_level, data in it:
                 if block_level == 0:
                     hasher.update(data)
@@ -929,8 +2399,17 @@ class ZS(object):
                 self._mrbs.pop(mrb)
                 mrb.close()
                 break
+            else:
+                # The dict can still count entries whose keys are already
+                # dead (this happens e.g. during interpreter shutdown), in
+                # which case there's nothing left to close.
+                break
         self._transport.close()
-        self._executor.shutdown()
+        if self._owns_executor:
+            if self._executor is not None:
+                self._executor.shutdown()
+            if self._shared_memory is not None:
+                self._shared_memory.close()
         self._closed = True
 
     def __del__(self):
@@ -0,0 +1,225 @@
+# This file is part of ZS
+# Copyright (C) 2013-2014 Nathaniel Smith <njs@pobox.com>
+# See file LICENSE.txt for license information.
+
+# Shared memory "slots" for passing blocks to and from worker processes.
+#
+# Normally, every block that zs.reader sends to a worker process gets
+# pickled, pushed through a pipe, and unpickled on the other side -- and
+# then the decompressed payload makes the same trip back. For bulk reads,
+# that's several extra copies of every byte in the file. Instead, the reader
+# owns a small ring of shared memory segments. The readahead thread copies a
+# batch of raw blocks into a free slot and sends the worker just the slot's
+# name; the worker reads the blocks in place, and (when the caller wants the
+# payloads back) writes the decompressed payloads into the second half of
+# the same slot, where the main process can read them as memoryviews. A slot
+# goes back into the ring once the main process is done with its results.
+#
+# This is purely an optimization: if shared memory isn't available (py2, old
+# py3, no /dev/shm, ...), if the ring is empty, or if something doesn't fit,
+# then the reader just falls back on pickling.
+
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    from multiprocessing import shared_memory
+    have_shared_memory = True  # pragma: no cover
+except ImportError:
+    have_shared_memory = False
+
+class SharedMemorySlot(object):
+    def __init__(self, segment, input_size, output_size):
+        self._segment = segment
+        self.name = segment.name
+        self.buf = segment.buf
+        self.input_size = input_size
+        self.output_size = output_size
+
+# If lazy is true, then only the first slot is created up front, and the rest
+# are created as they're needed, up to num_slots.
+class SharedMemoryRing(object):
+    def __init__(self, num_slots, input_size, output_size, lazy=False):
+        self._lock = threading.Lock()
+        self._num_slots = num_slots
+        self._input_size = input_size
+        self._output_size = output_size
+        self._slots = []
+        self._free = []
+        try:
+            for i in range(1 if lazy else num_slots):
+                self._free.append(self._new_slot())
+        except EnvironmentError:
+            self.close()
+            raise
+
+    def _new_slot(self):
+        size = self._input_size + self._output_size
+        segment = shared_memory.SharedMemory(create=True, size=size)
+        # Shared memory lives in a tmpfs, and writing to a page that the
+        # tmpfs doesn't have room for kills the process with SIGBUS. So we
+        # claim all the space up front, which gives us a nice clean error
+        # instead if there isn't enough.
+        fd = getattr(segment, "_fd", -1)
+        if fd >= 0 and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except EnvironmentError:
+                segment.close()
+                segment.unlink()
+                raise
+        slot = SharedMemorySlot(segment, self._input_size, self._output_size)
+        self._slots.append(slot)
+        return slot
+
+    @property
+    def slots(self):
+        return list(self._slots)
+
+    # Returns a free slot, or None if they're all in use.
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            if 0 < len(self._slots) < self._num_slots:
+                try:
+                    return self._new_slot()
+                except EnvironmentError:
+                    pass
+            return None
+
+    # True if none of the slots are in use.
+    def idle(self):
+        with self._lock:
+            return len(self._free) == len(self._slots)
+
+    # It's safe to release a slot more than once.
+    def release(self, slot):
+        with self._lock:
+            if slot not in self._free:
+                self._free.append(slot)
+
+    def close(self):
+        with self._lock:
+            self._free = []
+            for slot in self._slots:
+                slot.buf = None
+                try:
+                    slot._segment.close()
+                except BufferError:
+                    # someone still has a view onto it; it'll be unmapped
+                    # once they let go
+                    pass
+                try:
+                    slot._segment.unlink()
+                except EnvironmentError:
+                    pass
+            self._slots = []
+
+# Must be called before starting any worker processes that might use shared
+# memory. Workers need to share the main process's resource tracker (the
+# helper process that unlinks leftover segments if we crash): a worker that
+# was started before the tracker was running would start its own, which
+# would then "clean up" our segments as soon as that worker exited.
+def prepare_for_workers():
+    if have_shared_memory:
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+
+# Worker processes keep the segments they've seen mapped, so they don't have
+# to re-open them for every job.
+_MAX_ATTACHED = 64
+_attached = OrderedDict()
+
+def attach(name):
+    segment = _attached.pop(name, None)
+    if segment is None:
+        segment = shared_memory.SharedMemory(name=name)
+        while len(_attached) >= _MAX_ATTACHED:
+            _, old = _attached.popitem(last=False)
+            try:
+                old.close()
+            except BufferError:  # pragma: no cover
+                pass
+    _attached[name] = segment
+    return segment.buf
+
+# For data that doesn't fit in a slot: puts a copy of 'data' into a new
+# segment of its own, and returns the segment's name, or None if that isn't
+# possible. The receiving process must call take_segment on it exactly once.
+def put_segment(data):
+    if not have_shared_memory:  # pragma: no cover
+        return None
+    length = max(len(data), 1)
+    try:
+        segment = shared_memory.SharedMemory(create=True, size=length)
+    except EnvironmentError:
+        return None
+    try:
+        # see SharedMemoryRing for why we fallocate
+        fd = getattr(segment, "_fd", -1)
+        if fd >= 0 and hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, length)
+        segment.buf[:len(data)] = data
+    except EnvironmentError:
+        segment.close()
+        segment.unlink()
+        return None
+    name = segment.name
+    segment.close()
+    return name
+
+# Yields a view of the first 'length' bytes of a segment made by
+# put_segment, and then deletes the segment.
+@contextmanager
+def take_segment(name, length):
+    segment = shared_memory.SharedMemory(name=name)
+    try:
+        view = segment.buf[:length]
+        try:
+            yield view
+        finally:
+            view.release()
+    finally:
+        segment.close()
+        segment.unlink()
+
+def test_SharedMemoryRing():
+    if not have_shared_memory:  # pragma: no cover
+        return
+    ring = SharedMemoryRing(2, 10, 20)
+    a = ring.acquire()
+    assert not ring.idle()
+    b = ring.acquire()
+    assert ring.acquire() is None
+    assert len(a.buf) >= 30
+    a.buf[:3] = b"abc"
+    assert attach(a.name)[:3] == b"abc"
+    attach(a.name)[10:13] = b"xyz"
+    assert a.buf[10:13] == b"xyz"
+    ring.release(a)
+    ring.release(a)
+    assert ring.acquire() is a
+    assert ring.acquire() is None
+    ring.release(b)
+    assert not ring.idle()
+    ring.release(a)
+    assert ring.idle()
+    ring.close()
+    assert ring.acquire() is None
+
+    ring = SharedMemoryRing(3, 10, 20, lazy=True)
+    assert len(ring.slots) == 1
+    a = ring.acquire()
+    assert len(ring.slots) == 1
+    b = ring.acquire()
+    c = ring.acquire()
+    assert len(ring.slots) == 3
+    assert len(set([a, b, c])) == 3
+    assert ring.acquire() is None
+    ring.release(b)
+    assert ring.acquire() is b
+    ring.close()
+    assert ring.acquire() is None
@@ -8,6 +8,7 @@ import six
 
 import zs
 from .._zs import *
+from .._zs import _crc64xz_reference
 from nose.tools import assert_raises
 
 def test_crc64xz():
@@ -17,6 +18,20 @@ def test_crc64xz():
         print(repr(data))
         print(hex(crc64xz(data)))
         assert result == crc64xz(data)
+        assert result == _crc64xz_reference(data)
+
+def test_crc64xz_matches_reference():
+    import random
+    r = random.Random(0)
+    data = bytes(bytearray(r.randrange(256) for _ in range(10000)))
+    # Every length around the 8-byte stride, at every alignment, plus some
+    # big enough to release the GIL.
+    for start in range(8):
+        for length in list(range(40)) + [4095, 4096, 4097, 9000]:
+            chunk = data[start:start + length]
+            assert crc64xz(chunk) == _crc64xz_reference(chunk)
+            view = memoryview(data)[start:start + length]
+            assert crc64xz(view) == _crc64xz_reference(chunk)
 
 def test_buf_write_uleb128():
     cython_test_buf_write_uleb128()
@@ -52,9 +67,15 @@ def test_data_records():
         assert pack_data_records(records, alloc_hint) == expected
     assert pack_data_records(records) == expected
     assert unpack_data_records(expected) == records
+    offsets, lengths = unpack_data_record_offsets(expected)
+    assert list(offsets) == [1, 2, 19, 21]
+    assert list(lengths) == [0, 16, 1, 1]
     # Second record extends past end of block
     assert_raises(zs.ZSCorrupt,
                   unpack_data_records, b"\x03aaa\x04aaa")
+    assert_raises(zs.ZSCorrupt,
+                  unpack_data_record_offsets, b"\x03aaa\x04aaa")
+    assert_raises(zs.ZSCorrupt, unpack_data_record_offsets, b"")
     # Second uleb128 extends past end of block
     assert_raises(zs.ZSCorrupt,
                   unpack_data_records, b"\x03aaa\x80")
@@ -64,6 +85,58 @@ def test_data_records():
     assert_raises(zs.ZSError,
                   pack_data_records, [b"a\x00", b"a"], 100)
 
+def test_pack_chunk():
+    for terminator in [b"\n", b"\x00", b"\r\n", b"ab"]:
+        for records in [[b""], [b"", b""], [b"a"],
+                        [b"", b"\x00" * 16, b"a", b"b", b"b", b"c" * 200]]:
+            if any(terminator in r for r in records):
+                continue
+            chunk = terminator.join(records)
+            expected = (pack_data_records(records), records[0], records[-1])
+            for alloc_hint in [0, 1, 5, 100]:
+                assert pack_chunk(chunk, terminator, alloc_hint) == expected
+            assert pack_chunk(memoryview(chunk), terminator) == expected
+            assert pack_chunk(bytearray(chunk), terminator) == expected
+    # partial terminator at the end is part of the record
+    assert pack_chunk(b"a\r\nb\r", b"\r\n") == (b"\x01a\x02b\r", b"a", b"b\r")
+    assert_raises(zs.ZSError, pack_chunk, b"z\na", b"\n")
+    assert_raises(zs.ZSError, pack_chunk, b"a\x00\na", b"\n")
+    assert_raises(ValueError, pack_chunk, b"a", b"")
+
+def test_length_prefixed_chunks():
+    from six import BytesIO
+    from zs.common import write_length_prefixed
+    records = [b"", b"\x00" * 16, b"a", b"b", b"b", b"c" * 200]
+    for mode in ["uleb128", "u64le"]:
+        f = BytesIO()
+        write_length_prefixed(f, records, mode)
+        chunk = f.getvalue()
+        expected = (pack_data_records(records), records[0], records[-1])
+        for alloc_hint in [0, 1, 5, 100]:
+            assert (pack_length_prefixed_chunk(chunk, mode, alloc_hint)
+                    == expected)
+        assert pack_length_prefixed_chunk(memoryview(chunk), mode) == expected
+        assert length_prefixed_boundary(chunk, mode) == len(chunk)
+        # every prefix of the chunk stops at the last complete record
+        ends = [0]
+        for record in records:
+            f = BytesIO()
+            write_length_prefixed(f, [record], mode)
+            ends.append(ends[-1] + len(f.getvalue()))
+        for i in range(len(chunk)):
+            assert (length_prefixed_boundary(chunk[:i], mode)
+                    == max(end for end in ends if end <= i))
+        assert_raises(ValueError,
+                      pack_length_prefixed_chunk, chunk[:-1], mode)
+        assert_raises(ValueError, pack_length_prefixed_chunk, b"", mode)
+        f = BytesIO()
+        write_length_prefixed(f, [b"z"], mode)
+        write_length_prefixed(f, [b"a"], mode)
+        assert_raises(zs.ZSError,
+                      pack_length_prefixed_chunk, f.getvalue(), mode)
+    assert_raises(ValueError, length_prefixed_boundary, b"", "foo")
+    assert_raises(ValueError, pack_length_prefixed_chunk, b"\x00", "foo")
+
 def test_index_records():
     records = [b"", b"\x00" * 16, b"a", b"b"]
     offsets = [0, 10, 12345, 10 ** 12]
@@ -102,3 +175,81 @@ def test_index_records():
     # incorrectly sorted offsets
     assert_raises(zs.ZSError,
                   pack_index_records, [b"a", b"z"], [2, 1], [10, 10], 100)
+
+def test_split_block_frames():
+    block1 = b"\x05" + b"\x01" * 5 + b"\x02" * 8
+    block2 = b"\x01" + b"\x03" + b"\x04" * 8
+    frame1 = (100, 14, b"\x01" * 5, b"\x02" * 8)
+    frame2 = (114, 10, b"\x03", b"\x04" * 8)
+    buf = block1 + block2
+    assert split_block_frames(buf, 100) == ([frame1, frame2], len(buf))
+    # partial frames are left alone
+    for i in range(len(block1)):
+        assert split_block_frames(buf[:i], 100) == ([], 0)
+    for i in range(len(block1), len(buf)):
+        assert split_block_frames(buf[:i], 100) == ([frame1], len(block1))
+    # works on any buffer, and slices have the same type as the input
+    frames, consumed = split_block_frames(memoryview(buf), 100)
+    assert consumed == len(buf)
+    assert isinstance(frames[0][2], memoryview)
+    assert [(o, l, bytes(b), bytes(c)) for (o, l, b, c) in frames
+            ] == [frame1, frame2]
+    # a corrupt length is reported only once it reaches the front of the
+    # buffer
+    bad = b"\x80" * 10 + b"\x02"
+    assert split_block_frames(block1 + bad, 100) == ([frame1], len(block1))
+    assert_raises(zs.ZSCorrupt, split_block_frames, bad, 100)
+
+def test_data_block_contains():
+    records = [b"", b"a", b"a", b"ab", b"b\x00", b"b\xff"]
+    block = pack_data_records(records)
+    for key in records:
+        assert data_block_contains(block, key)
+        assert data_block_contains(memoryview(block), key)
+    for key in [b"\x00", b"aa", b"abc", b"b", b"b\x01", b"c"]:
+        assert not data_block_contains(block, key)
+    assert_raises(zs.ZSCorrupt, data_block_contains, b"", b"a")
+    assert_raises(zs.ZSCorrupt, data_block_contains, b"\x01a\x05aa", b"b")
+    assert_raises(zs.ZSCorrupt, data_block_contains, b"\x01a\x80", b"b")
+
+    # Big blocks take a different (GIL-releasing) code path
+    big_records = [("%06i" % (i,)).encode("ascii") for i in range(0, 20000, 2)]
+    big_block = pack_data_records(big_records)
+    assert len(big_block) > 50000
+    for i in [0, 1, 2, 9999, 10000, 19998, 19999, 20000]:
+        key = ("%06i" % (i,)).encode("ascii")
+        assert data_block_contains(big_block, key) == (i % 2 == 0
+                                                       and i < 20000)
+    assert not data_block_contains(big_block, b"")
+    assert not data_block_contains(big_block, b"\xff")
+    for bad_tail in [b"\x05aa", b"\x80", b"\x80\x00"]:
+        assert_raises(zs.ZSCorrupt,
+                      data_block_contains, big_block + bad_tail, b"\xff")
+        # but if we find the key before reaching the corruption, then fine
+        assert data_block_contains(big_block + bad_tail, b"000000")
+
+def test_data_block_contains_many():
+    records = [b"", b"a", b"a", b"ab", b"b\x00", b"b\xff"]
+    block = pack_data_records(records)
+    keys = sorted(records + [b"\x00", b"aa", b"abc", b"b", b"b\x01", b"c",
+                             b"a", b"c"])
+    assert (data_block_contains_many(block, keys)
+            == [data_block_contains(block, key) for key in keys])
+    assert data_block_contains_many(block, []) == []
+    assert_raises(zs.ZSCorrupt, data_block_contains_many, b"", [b"a"])
+    assert_raises(zs.ZSCorrupt,
+                  data_block_contains_many, b"\x01a\x05aa", [b"b"])
+
+    # Big blocks release the GIL here too
+    big_records = [("%06i" % (i,)).encode("ascii") for i in range(0, 20000, 2)]
+    big_block = pack_data_records(big_records)
+    keys = [("%06i" % (i,)).encode("ascii") for i in range(0, 20001, 7)]
+    assert (data_block_contains_many(big_block, keys)
+            == [data_block_contains(big_block, key) for key in keys])
+    assert_raises(zs.ZSCorrupt,
+                  data_block_contains_many, big_block + b"\x05aa", [b"\xff"])
+    offsets, lengths = unpack_data_record_offsets(big_block)
+    assert [big_block[o:o + l] for (o, l) in zip(offsets, lengths)] == big_records
+    for bad_tail in [b"\x05aa", b"\x80", b"\x80\x00"]:
+        assert_raises(zs.ZSCorrupt,
+                      unpack_data_record_offsets, big_block + bad_tail)
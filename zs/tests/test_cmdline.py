@@ -100,6 +100,32 @@ def test_dump():
                      "--prefix=\\x01"]).stdout
                 == b"\x01\x01\x02\x01a")
 
+def test_lookup():
+    with simple_zs() as p:
+        def lookup(input, *args):
+            return run(["lookup", "--keys-from=-"] + list(args) + [p],
+                       input=input).stdout
+        # output is in key order, missing keys are skipped, and a missing
+        # final terminator is fine
+        assert lookup(b"c\nzzz\na\nb") == b"c\na\nb\n"
+        assert lookup(b"b\n", "--prefixes") == b"b\nbb\n"
+        assert lookup(b"c\x00bb\x00", "--terminator=\\x00") == b"c\x00bb\x00"
+        assert (lookup(b"\x01b\x01a\x01z", "--length-prefixed=uleb128",
+                       "--prefixes")
+                == b"\x01b\x02bb\x01a")
+        assert lookup(b"") == b""
+
+        with tempname(".txt") as keys_path:
+            with open(keys_path, "wb") as f:
+                f.write(b"bb\nc\n")
+            with tempname(".txt") as out_path:
+                assert run(["lookup", "--keys-from", keys_path,
+                            "-j", "2", "-o", out_path, p]).stdout == b""
+                assert open(out_path, "rb").read() == b"bb\nc\n"
+
+        run(["lookup", "--keys-from=-", "--length-prefixed=asdf", p],
+            expected_returncode=2)
+
 def test_validate():
     run(["validate", test_data_path("letters-none.zs")])
 
@@ -0,0 +1,152 @@
+# This file is part of ZS
+# Copyright (C) 2013-2014 Nathaniel Smith <njs@pobox.com>
+# See file LICENSE.txt for license information.
+
+import os
+import os.path
+import time
+
+from .util import tempdir
+from ..diskcache import DiskBlockCache
+
+def cache_files(path):
+    found = set()
+    for (dirpath, _, filenames) in os.walk(path):
+        for filename in filenames:
+            found.add(filename)
+    return found
+
+def test_DiskBlockCache():
+    with tempdir() as path:
+        cache = DiskBlockCache(path, 100, b"header 1")
+        assert cache.get(10, 3) is None
+        cache.put(10, b"abc")
+        assert cache.get(10, 3) == b"abc"
+        # length mismatch means it's not the block we want
+        assert cache.get(10, 4) is None
+        cache.discard(10)
+        assert cache.get(10, 3) is None
+        # discarding something that isn't there is fine
+        cache.discard(10)
+
+        cache.put(10, b"abc")
+        # a second object for the same file sees the same blocks
+        assert DiskBlockCache(path, 100, b"header 1").get(10, 3) == b"abc"
+        # but a different file (even one with a similar header) doesn't
+        other = DiskBlockCache(path, 100, b"header 2")
+        assert other.get(10, 3) is None
+        other.put(10, b"xyz")
+        assert cache.get(10, 3) == b"abc"
+        assert other.get(10, 3) == b"xyz"
+        # no temporary files left lying around
+        assert not [f for f in cache_files(path) if "tmp" in f]
+
+def test_DiskBlockCache_eviction():
+    with tempdir() as path:
+        cache = DiskBlockCache(path, 50, b"header")
+        for offset in [0, 10, 20, 30, 40]:
+            cache.put(offset, b"x" * 10)
+        for offset in [0, 10, 20, 30, 40]:
+            assert cache.get(offset, 10) == b"x" * 10
+        # make 0 and 20 the least recently used
+        now = time.time()
+        for offset, age in [(0, 100), (10, 50), (20, 100), (30, 50),
+                            (40, 50)]:
+            block_path = os.path.join(cache._entry_dir, "%s.block" % offset)
+            os.utime(block_path, (now - age, now - age))
+        header_path = os.path.join(cache._entry_dir, "header")
+        os.utime(header_path, (now, now))
+        # evicts down to 90% of the limit
+        cache.put(50, b"x" * 15)
+        assert cache._read_usage() == 45
+        assert cache.get(0, 10) is None
+        assert cache.get(20, 10) is None
+        for offset in [10, 30, 40]:
+            assert cache.get(offset, 10) == b"x" * 10
+        assert cache.get(50, 15) == b"x" * 15
+
+        # blocks that could never fit aren't stored at all
+        cache.put(60, b"x" * 1000)
+        assert cache.get(60, 1000) is None
+        assert cache.get(50, 15) == b"x" * 15
+
+def test_DiskBlockCache_accounting():
+    with tempdir() as path:
+        cache = DiskBlockCache(path, 100, b"header")
+        # overwriting a block doesn't count it twice
+        cache.put(0, b"x" * 10)
+        cache.put(0, b"x" * 10)
+        assert cache._read_usage() == 10
+        cache.discard(0)
+        assert cache._read_usage() == 0
+        # leftover temporary files don't count, and old ones get cleaned up
+        fresh_tmp = os.path.join(cache._entry_dir, "1.block.tmp-1-1")
+        stale_tmp = os.path.join(cache._entry_dir, "2.block.tmp-1-1")
+        for tmp_path in [fresh_tmp, stale_tmp]:
+            with open(tmp_path, "wb") as f:
+                f.write(b"x" * 1000)
+        old = time.time() - 2 * 60 * 60
+        os.utime(stale_tmp, (old, old))
+        # (the usage file is missing, so this has to recount)
+        os.unlink(os.path.join(path, "usage"))
+        cache = DiskBlockCache(path, 100, b"header")
+        assert cache._read_usage() == 0
+        assert os.path.exists(fresh_tmp)
+        assert not os.path.exists(stale_tmp)
+
+def test_DiskBlockCache_lazy_scan():
+    with tempdir() as path:
+        cache = DiskBlockCache(path, 100, b"header 1")
+        cache.put(0, b"x" * 10)
+        def no_scan():
+            raise AssertionError("shouldn't scan")
+        # opening again just reads the usage file
+        cache = DiskBlockCache.__new__(DiskBlockCache)
+        cache._scan = no_scan
+        cache.__init__(path, 100, b"header 1")
+        # and so do puts that stay under the limit
+        cache.put(10, b"x" * 10)
+        assert cache._read_usage() == 20
+        # other processes' puts count too
+        other = DiskBlockCache(path, 100, b"header 2")
+        other.put(0, b"x" * 30)
+        assert cache._read_usage() == 50
+        # if the usage file gets out of date, the next eviction fixes it
+        with open(os.path.join(path, "usage"), "wb") as f:
+            f.write(b"95")
+        other.put(10, b"x" * 10)
+        assert other._read_usage() == 60
+        assert cache.get(0, 10) == b"x" * 10
+
+def test_DiskBlockCache_stale_entries():
+    with tempdir() as path:
+        old = time.time() - 2 * 60 * 60
+        # an entry whose blocks were all evicted long ago, and one that was
+        # opened recently but never got any blocks
+        stale = DiskBlockCache(path, 100, b"stale")
+        fresh = DiskBlockCache(path, 100, b"fresh")
+        stale_header = os.path.join(stale._entry_dir, "header")
+        os.utime(stale_header, (old, old))
+        # and an old empty one
+        empty_dir = os.path.join(path, "0" * 64)
+        os.mkdir(empty_dir)
+        os.utime(empty_dir, (old, old))
+        cache = DiskBlockCache(path, 10, b"header")
+        # an eviction scan cleans up the old ones
+        cache.put(0, b"x" * 10)
+        cache.put(10, b"x" * 10)
+        assert not os.path.exists(stale._entry_dir)
+        assert not os.path.exists(empty_dir)
+        assert os.path.exists(fresh._entry_dir)
+        assert os.path.exists(cache._entry_dir)
+
+def test_DiskBlockCache_broken_dir():
+    with tempdir() as path:
+        # a regular file where the cache directory should be
+        not_a_dir = os.path.join(path, "not-a-dir")
+        with open(not_a_dir, "wb"):
+            pass
+        cache = DiskBlockCache(not_a_dir, 100, b"header")
+        cache.put(0, b"abc")
+        assert cache.get(0, 3) is None
+        cache.discard(0)
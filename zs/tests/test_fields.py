@@ -0,0 +1,105 @@
+# This file is part of ZS
+# Copyright (C) 2013-2014 Nathaniel Smith <njs@pobox.com>
+# See file LICENSE.txt for license information.
+
+from nose.tools import assert_raises
+
+from zs import ZS, ZSWriter
+from zs._zs import pack_data_records
+from zs.packed import PackedRecords
+from zs.fields import parse_fields, concat_columns
+from .util import tempname
+
+NGRAM_FIELDS = [("ngram", "bytes"), ("year", "int"),
+                ("match_count", "int"), ("volume_count", "int")]
+
+ngram_records = []
+for word in [b"a", b"b b", b"c"]:
+    for year in range(1990, 2000):
+        ngram_records.append(b"%s\t%d\t%d\t%d"
+                             % (word, year, year - 2000, year % 7))
+
+def test_parse_fields():
+    for records in [ngram_records,
+                    PackedRecords.from_block(
+                        pack_data_records(ngram_records))]:
+        columns = parse_fields(records, NGRAM_FIELDS)
+        assert list(columns) == ["ngram", "year", "match_count",
+                                 "volume_count"]
+        assert columns["ngram"] == [r.split(b"\t")[0] for r in ngram_records]
+        assert list(columns["year"]) == [int(r.split(b"\t")[1])
+                                         for r in ngram_records]
+        assert list(columns["match_count"]) == [int(r.split(b"\t")[2])
+                                                for r in ngram_records]
+        columns = parse_fields(records,
+                               [("ngram", None), ("year", "float"),
+                                ("match_count", None),
+                                ("volume_count", None)])
+        assert list(columns) == ["year"]
+        assert list(columns["year"]) == [float(r.split(b"\t")[1])
+                                         for r in ngram_records]
+
+    long_float = b"1" * 100 + b".5"
+    columns = parse_fields([b"a\t-2.5e3", b"b\tinf", b"c\t" + long_float],
+                           [("a", "bytes"), ("b", "float")])
+    assert list(columns["b"]) == [-2500.0, float("inf"), float(long_float)]
+
+    columns = parse_fields([b"a,1"], [("a", "bytes"), ("b", "int")],
+                           delimiter=b",")
+    assert columns["a"] == [b"a"]
+    assert list(columns["b"]) == [1]
+    assert list(parse_fields([], NGRAM_FIELDS)["year"]) == []
+
+    t = lambda records, fields: assert_raises(ValueError, parse_fields,
+                                               records, fields)
+    t([b"a\t1"], [("a", "bytes")])
+    t([b"a"], [("a", "bytes"), ("b", "bytes")])
+    t([b"a\tx"], [("a", "bytes"), ("b", "int")])
+    t([b"a\t"], [("a", "bytes"), ("b", "int")])
+    t([b"a\t99999999999999999999"], [("a", "bytes"), ("b", "int")])
+    t([b"a\tx"], [("a", "bytes"), ("b", "float")])
+    t([b"a\t"], [("a", "bytes"), ("b", "float")])
+    t([b"a\t1.5x"], [("a", "bytes"), ("b", "float")])
+    t([b"a\t1\x002"], [("a", "bytes"), ("b", "float")])
+    t([b"a"], [("a", "str")])
+    assert_raises(ValueError, parse_fields, [b"a"], [("a", "bytes")],
+                  b"\t\t")
+
+def test_concat_columns():
+    a = parse_fields(ngram_records[:5], NGRAM_FIELDS)
+    b = parse_fields(ngram_records[5:], NGRAM_FIELDS)
+    both = concat_columns([a, b])
+    expected = parse_fields(ngram_records, NGRAM_FIELDS)
+    for name in expected:
+        assert list(both[name]) == list(expected[name])
+
+def test_search_columns():
+    with tempname(".zs", unlink_first=True) as p:
+        with ZSWriter(p, {}, 2, show_spinner=False) as zw:
+            for i in range(0, len(ngram_records), 4):
+                zw.add_data_block(ngram_records[i:i + 4])
+            zw.finish()
+        for parallelism in [0, 2]:
+            with ZS(p, parallelism=parallelism) as z:
+                chunks = list(z.search_columns(NGRAM_FIELDS,
+                                               prefix=b"b b\t"))
+                assert len(chunks) > 1
+                columns = concat_columns(chunks)
+                assert columns["ngram"] == [b"b b"] * 10
+                assert list(columns["year"]) == list(range(1990, 2000))
+                assert_raises(ValueError, list,
+                              z.search_columns([("a", "str")]))
+                try:
+                    import pandas
+                except ImportError:
+                    continue
+                frames = list(z.search_dataframes(NGRAM_FIELDS,
+                                                  chunksize=7))
+                assert all(len(f) >= 7 for f in frames[:-1])
+                assert list(frames[0].columns) == [name for (name, _)
+                                                   in NGRAM_FIELDS]
+                assert sum(len(f) for f in frames) == len(ngram_records)
+                frames = list(z.search_dataframes(NGRAM_FIELDS,
+                                                  chunksize=7,
+                                                  ordered=False))
+                assert sum(len(f) for f in frames) == len(ngram_records)
@@ -3,7 +3,8 @@
 # See file LICENSE.txt for license information.
 
 from nose.tools import assert_raises
-from ..futures import ProcessPoolExecutor, SerialExecutor
+from ..futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                       SerialExecutor)
 
 def square(x):
     return x ** 2
@@ -26,4 +27,5 @@ def _do_executor_test(executor):
 def test_futures():
     _do_executor_test(ProcessPoolExecutor(3))
     _do_executor_test(ProcessPoolExecutor(1))
+    _do_executor_test(ThreadPoolExecutor(3))
     _do_executor_test(SerialExecutor())
@@ -0,0 +1,37 @@
+# This file is part of ZS
+# Copyright (C) 2013-2014 Nathaniel Smith <njs@pobox.com>
+# See file LICENSE.txt for license information.
+
+import pickle
+
+from zs._zs import pack_data_records
+from zs.packed import PackedRecords, trim_packed
+
+def test_PackedRecords():
+    records = [b"", b"a", b"bb", b"c" * 200, b"d"]
+    p = PackedRecords.from_block(pack_data_records(records))
+    assert len(p) == len(records)
+    assert p.tolist() == records
+    assert [bytes(r) for r in p] == records
+    assert isinstance(p[1], memoryview)
+    assert p[2] == b"bb"
+    assert p[-1] == b"d"
+    assert p[1:3].tolist() == records[1:3]
+    assert list(p.lengths) == [len(r) for r in records]
+    assert pickle.loads(pickle.dumps(p)).tolist() == records
+    # pickling a slice only sends the records in it
+    piece = pickle.loads(pickle.dumps(p[1:3]))
+    assert piece.tolist() == records[1:3]
+    assert len(piece.buf) == len(b"a") + 1 + len(b"bb")
+    assert pickle.loads(pickle.dumps(p[2:2])).tolist() == []
+
+def test_trim_packed():
+    records = [b"b", b"d", b"f", b"h"]
+    p = PackedRecords.from_block(pack_data_records(records))
+    assert trim_packed(p, b"", None) is p
+    assert trim_packed(p, b"c", None).tolist() == [b"d", b"f", b"h"]
+    assert trim_packed(p, b"d", b"h").tolist() == [b"d", b"f"]
+    assert trim_packed(p, b"a", b"b").tolist() == []
+    assert trim_packed(p, b"z", None).tolist() == []
+    assert trim_packed(p, b"b\x00", b"f\x00").tolist() == [b"d", b"f"]
+    assert trim_packed(p[1:], b"", b"g").tolist() == [b"d", b"f"]
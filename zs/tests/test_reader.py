@@ -6,13 +6,15 @@ import os
 import os.path
 import sys
 import hashlib
+import time
+import operator
 
 from six import int2byte, byte2int, BytesIO, integer_types
 from nose.tools import assert_raises
 
 from .util import test_data_path
 from .http_harness import web_server
-from zs import ZS, ZSError, ZSCorrupt
+from zs import ZS, ZSError, ZSCorrupt, PackedRecords
 from zs._zs import pack_data_records
 from zs.common import read_length_prefixed, codec_shorthands
 
@@ -33,6 +35,13 @@ def _check_map_helper(records, arg1, arg2):
     assert arg2 == 2
     return records
 
+def _packed_to_list(packed):
+    assert isinstance(packed, PackedRecords)
+    return packed.tolist()
+
+def _is_doubled(record):
+    return len(record) == 2
+
 def _check_raise_helper(records, exc):
     raise exc
 
@@ -60,6 +69,8 @@ def check_letters_zs(z, codec_shorthand):
         chars = "m"
     else:
         chars = "abcdefghijklmnopqrstuvwxyz"
+    all_ranges = []
+    all_expected = []
     for char in chars:
         byte = char.encode("ascii")
         for (start, stop, prefix) in [
@@ -85,6 +96,15 @@ def check_letters_zs(z, codec_shorthand):
                 expected = [r for r in expected if r.startswith(prefix)]
             assert list(z.search(start=start, stop=stop, prefix=prefix)
                         ) == expected
+            assert list(z.search(start=start, stop=stop, prefix=prefix,
+                                 where=_is_doubled, project=len)
+                        ) == [len(r) for r in expected if _is_doubled(r)]
+            batches = list(z.search_batches(start=start, stop=stop,
+                                            prefix=prefix))
+            assert all(batches)
+            assert sum(batches, []) == expected
+            all_ranges.append((start, stop, prefix))
+            all_expected.append(expected)
 
             map_blocks = list(z.block_map(
                 _check_map_helper,
@@ -92,6 +112,19 @@ def check_letters_zs(z, codec_shorthand):
                 args=(1,), kwargs={"arg2": 2},
                 start=start, stop=stop, prefix=prefix))
             assert sum(map_blocks, []) == expected
+            unordered_blocks = list(z.block_map(
+                _check_map_helper, args=(1,), kwargs={"arg2": 2},
+                start=start, stop=stop, prefix=prefix, ordered=False))
+            assert sorted(unordered_blocks) == map_blocks
+            packed_blocks = list(z.block_map(
+                _packed_to_list, start=start, stop=stop, prefix=prefix,
+                packed=True))
+            assert packed_blocks == map_blocks
+
+            assert z.block_reduce(
+                _check_map_helper, operator.add, args=(1,),
+                kwargs={"arg2": 2}, start=start, stop=stop, prefix=prefix,
+                initial=[]) == expected
 
             for term in [b"\n", b"\x00"]:
                 expected_dump = term.join(expected + [b""])
@@ -112,10 +145,39 @@ def check_letters_zs(z, codec_shorthand):
 
     assert list(z.search(stop=b"bb", prefix=b"b")) == [b"b"]
 
+    assert z.search_many(all_ranges) == all_expected
+    assert z.search_many([(b"c",), (None, b"c"), (b"q", b"d")]) == [
+        letters_records[2:], letters_records[:2], []]
+    # unsorted, overlapping, and repeated ranges
+    assert z.search_many([(b"c",), (b"b", b"c"), (None, b"bb"), (b"c",),
+                          (None, None, b"b")]) == [
+        letters_records[2:], letters_records[:2], letters_records[:1],
+        letters_records[2:], letters_records[:2]]
+    assert z.search_many([]) == []
+    assert_raises(ValueError, z.search_many, [(None, None, None, None)])
+
+    for record in letters_records:
+        assert z.contains(record)
+        assert record in z
+        assert z.get(record) == record
+    for missing in [b"", b"a", b"bbb", b"c", b"zz\x00", b"zzz", b"\xff"]:
+        assert not z.contains(missing)
+        assert missing not in z
+        assert z.get(missing) is None
+        assert z.get(missing, 10) == 10
+
+    keys = [b"zz", b"a", b"b", b"zzz", b"b", b"mm", b"", b"n", b"mmm"]
+    assert z.get_many(keys) == [z.get(key) for key in keys]
+    assert z.get_many(keys, 0) == [z.get(key, 0) for key in keys]
+    assert z.get_many(letters_records) == letters_records
+    assert z.get_many([]) == []
+
     assert_raises(ValueError, list,
                   z.block_map(_check_raise_helper, args=(ValueError,)))
     assert_raises(ValueError, z.block_exec,
                   _check_raise_helper, args=(ValueError,))
+    assert_raises(ValueError, z.block_exec,
+                  _check_raise_helper, args=(ValueError,), ordered=False)
 
     z.validate()
 
@@ -125,6 +187,223 @@ def test_zs():
         for parallelism in [0, 2, "guess"]:
             with ZS(path=p, parallelism=parallelism) as z:
                 check_letters_zs(z, codec)
+            with ZS(path=p, parallelism=parallelism,
+                    data_block_cache=2 ** 20) as z:
+                check_letters_zs(z, codec)
+            with ZS(path=p, parallelism=parallelism,
+                    executor="thread") as z:
+                check_letters_zs(z, codec)
+
+def test_zs_shared_memory():
+    from .. import reader
+    if not reader.have_shared_memory:  # pragma: no cover
+        return
+    p = test_data_path("letters-deflate.zs")
+    sizes = (reader.SHARED_MEMORY_INPUT_SIZE, reader.SHARED_MEMORY_OUTPUT_SIZE)
+    # normal, plus everything falling back on pickling one way or the other
+    for input_size, output_size in [sizes, (10, sizes[1]), (sizes[0], 10)]:
+        reader.SHARED_MEMORY_INPUT_SIZE = input_size
+        reader.SHARED_MEMORY_OUTPUT_SIZE = output_size
+        try:
+            with ZS(path=p, parallelism=2) as z:
+                check_letters_zs(z, "deflate")
+                ring = z._shared_memory
+                assert ring is not None
+                # slots are handed back once their results are consumed (or,
+                # for abandoned jobs, once the workers finish with them)
+                assert list(z.search()) == letters_records
+                for i in range(100):
+                    if len(ring._free) == len(ring._slots):
+                        break
+                    time.sleep(0.1)
+                assert len(ring._free) == len(ring._slots)
+                # slots are only made as they're needed, and never more than
+                # fit in the readahead budget
+                assert 1 <= len(ring.slots) <= min(
+                    2 + 2,
+                    reader.READAHEAD_MAX_BYTES // (input_size + output_size))
+        finally:
+            reader.SHARED_MEMORY_INPUT_SIZE = sizes[0]
+            reader.SHARED_MEMORY_OUTPUT_SIZE = sizes[1]
+
+def test_zs_lazy_pool():
+    from .. import reader
+    p = test_data_path("letters-deflate.zs")
+    for executor in ["process", "thread"]:
+        with ZS(path=p, parallelism=2, executor=executor) as z:
+            # point lookups and short scans don't start the pool
+            assert z.get(b"n") == b"n"
+            assert z.get_many([b"n", b"r"]) == [b"n", b"r"]
+            it = z.search()
+            assert next(it) == letters_records[0]
+            it.close()
+            assert z._executor is None
+            # but long ones do
+            assert list(z.search()) == letters_records
+            assert z._executor is not None
+    # closing a ZS object that never started its pool is fine
+    ZS(path=p, parallelism=2).close()
+
+def test_readahead_window():
+    from ..reader import _ReadaheadWindow, READAHEAD_MAX_BYTES
+    def batch(size):
+        return [(0, size, b"x" * size, b"")]
+    w = _ReadaheadWindow(2)
+    # a job always fits in an empty window, however big
+    assert w.has_room(batch(READAHEAD_MAX_BYTES))
+    w.submitted("a", batch(10))
+    assert w.has_room(batch(10))
+    # but otherwise big jobs have to wait
+    assert not w.has_room(batch(READAHEAD_MAX_BYTES // 2))
+    w.submitted("b", batch(10))
+    # full up
+    assert not w.has_room(batch(10))
+    # a consumer that has to wait makes the window deeper...
+    w.finished("a", 100, 1.0, 0.0)
+    assert w.jobs_done == 1
+    assert w.depth == 3
+    w.submitted("c", batch(10))
+    w.submitted("d", batch(10))
+    assert not w.has_room(batch(10))
+    # (jobs can finish out of order)
+    w.finished("d", 100, 1.0, 0.0)
+    assert w.depth == 4
+    # ...but only if it was full
+    w.finished("b", 100, 1.0, 0.0)
+    assert w.depth == 4
+    # once it's seen some payloads, it estimates job sizes from them (here
+    # 10x expansion)
+    assert w.has_room(batch(READAHEAD_MAX_BYTES // 12))
+    assert not w.has_room(batch(READAHEAD_MAX_BYTES // 10))
+    w.finished("c", 100, 1.0, 0.0)
+    # a consumer that's slower than the workers makes it shallower, but
+    # never below the minimum
+    for i in range(10):
+        w.submitted(i, batch(10))
+        w.finished(i, 100, 0.0, 1.0)
+    assert w.depth == 2
+
+def test_zs_small_readahead_budget():
+    from .. import reader
+    p = test_data_path("letters-deflate.zs")
+    was = reader.READAHEAD_MAX_BYTES
+    reader.READAHEAD_MAX_BYTES = 1
+    try:
+        for parallelism in [0, 2]:
+            with ZS(path=p, parallelism=parallelism) as z:
+                assert list(z.search()) == letters_records
+                assert (sum(z.block_map(identity), [])
+                        == letters_records)
+    finally:
+        reader.READAHEAD_MAX_BYTES = was
+
+def test_zs_shared_pool():
+    from .. import reader
+    p = test_data_path("letters-deflate.zs")
+    assert_raises(ValueError, reader.set_shared_pool_size, 0)
+    reader.set_shared_pool_size(2)
+    try:
+        z1 = ZS(path=p, executor="shared")
+        z2 = ZS(path=p, executor="shared")
+        assert z1._parallelism == 2
+        # nothing started yet
+        assert reader._shared_pool is None
+        check_letters_zs(z1, "deflate")
+        pool = reader._shared_pool
+        assert pool is not None
+        check_letters_zs(z2, "deflate")
+        assert reader._shared_pool is pool
+        # closing one doesn't affect the other
+        z1.close()
+        assert list(z2.search()) == letters_records
+        assert reader._shared_pool is pool
+        # after a shutdown, a new pool gets started on demand
+        reader.shutdown_shared_pool()
+        assert reader._shared_pool is None
+        assert list(z2.search()) == letters_records
+        assert reader._shared_pool is not None
+        z2.close()
+    finally:
+        reader.set_shared_pool_size("guess")
+    assert reader._shared_pool is None
+
+def test_zs_user_executor():
+    from ..futures import ThreadPoolExecutor
+    p = test_data_path("letters-deflate.zs")
+    executor = ThreadPoolExecutor(2)
+    try:
+        for i in range(2):
+            # the executor can be shared, and is still usable after close()
+            with ZS(path=p, executor=executor) as z:
+                check_letters_zs(z, "deflate")
+        assert executor.submit(identity, 1).result() == 1
+    finally:
+        executor.shutdown()
+
+def test_block_map_unordered():
+    from ..futures import ThreadPoolExecutor
+    def slow_first(records):
+        if records[0] == letters_records[0]:
+            time.sleep(0.5)
+        return records
+    executor = ThreadPoolExecutor(2)
+    try:
+        with ZS(test_data_path("letters-none.zs"), executor=executor) as z:
+            ordered = list(z.block_map(slow_first))
+            assert ordered[0][0] == letters_records[0]
+            # the slow block doesn't hold up the others
+            unordered = list(z.block_map(slow_first, ordered=False))
+            assert unordered[0][0] != letters_records[0]
+            assert sorted(unordered) == ordered
+            # stopping early still gets everything before the stop
+            assert (sorted(z.block_map(slow_first, stop=b"n",
+                                       ordered=False))
+                    == list(z.block_map(slow_first, stop=b"n")))
+    finally:
+        executor.shutdown()
+
+def test_zs_thread_executor_unpickleable_fn():
+    p = test_data_path("letters-none.zs")
+    seen = []
+    with ZS(path=p, parallelism=2, executor="thread") as z:
+        z.block_exec(lambda records: seen.extend(records))
+    assert sorted(seen) == letters_records
+
+def test_data_block_cache():
+    p = test_data_path("letters-lzma.zs")
+    for cache_size in [0, 2 ** 20]:
+        with ZS(path=p, parallelism=0, data_block_cache=cache_size) as z:
+            decompressed = []
+            real_decompress = z._decompress
+            def counting_decompress(zpayload):
+                decompressed.append(zpayload)
+                return real_decompress(zpayload)
+            z._decompress = counting_decompress
+            # prime the index block cache, so that from here on we only
+            # count data block decompressions
+            assert z.get(b"n") == b"n"
+            del decompressed[:]
+
+            for i in range(3):
+                assert z.get(b"n") == b"n"
+                assert z.get_many([b"nn", b"r"]) == [b"nn", b"r"]
+                assert list(z.search(prefix=b"n")) == [b"n", b"nn"]
+            if cache_size:
+                # Once a block has been seen, it's served from the cache
+                so_far = len(decompressed)
+                for i in range(3):
+                    assert z.get(b"n") == b"n"
+                    assert list(z.search(prefix=b"n")) == [b"n", b"nn"]
+                    assert list(z.block_map(identity, prefix=b"n")) == [
+                        [b"n", b"nn"]]
+                assert len(decompressed) == so_far
+            else:
+                assert len(decompressed) > 6
+
+            # validate() always reads the file itself
+            del decompressed[:]
+            z.validate()
+            assert decompressed
 
 # This is much slower, and the above test will have already exercised most of
 # the tricky code, so we make this test less exhaustive.
@@ -136,6 +415,24 @@ def test_http_zs():
             with ZS(url=url, parallelism=parallelism) as z:
                 check_letters_zs(z, codec)
 
+def test_http_disk_cache():
+    from .util import tempdir
+    with web_server(test_data_path()) as root_url:
+        url = "%s/letters-deflate.zs" % (root_url,)
+        with tempdir() as cache_dir:
+            with ZS(url=url, parallelism=0, http_cache_dir=cache_dir) as z:
+                assert z.get_many(letters_records) == letters_records
+                assert z.get(b"n") == b"n"
+            # Reopening only needs the header; all the index and data
+            # blocks we looked at before come out of the cache.
+            with ZS(url=url, parallelism=2, http_cache_dir=cache_dir) as z:
+                def no_network(*args, **kwargs):
+                    raise AssertionError("should be cached")
+                z._transport.chunk_read = no_network
+                assert z.get_many(letters_records) == letters_records
+                assert z.get(b"n") == b"n"
+                assert z.get(b"a") is None
+
 def test_http_notices_lack_of_range_support():
     with web_server(test_data_path(), range_support=False) as root_url:
         codec = "deflate"
@@ -148,6 +445,8 @@ def test_zs_args():
     assert_raises(ValueError, ZS, path=p, url="x")
     # parallelism must be >= 0
     assert_raises(ValueError, ZS, path=p, parallelism=-1)
+    assert_raises(ValueError, ZS, path=p, executor="fibers")
+    assert_raises(ValueError, ZS, path=p, executor="thread", parallelism=-1)
 
 def test_zs_close():
     z = ZS(test_data_path("letters-none.zs"))
@@ -158,6 +457,10 @@ def test_zs_close():
                  [list, z],
                  [z.dump, BytesIO()],
                  [z.validate],
+                 [z.contains, b"b"],
+                 [z.get, b"b"],
+                 [z.get_many, [b"b"]],
+                 [z.search_many, [(b"b",)]],
                  ]:
         print(repr(call))
         assert_raises(ZSError, *call)
@@ -189,6 +492,46 @@ def test_block_exec():
     assert count_blocks.count > 1
     assert count_blocks.count == len(list(z.block_map(identity)))
 
+def _count_records(records):
+    return len(records)
+
+def test_block_reduce():
+    p = test_data_path("letters-none.zs")
+    # (with worker processes, the partial results go around pickled)
+    for parallelism, executor in [(0, "process"), (2, "process"),
+                                  (2, "thread")]:
+        with ZS(p, parallelism=parallelism, executor=executor) as z:
+            assert (z.block_reduce(_count_records, operator.add)
+                    == len(letters_records))
+            assert (z.block_reduce(_count_records, operator.add, initial=10)
+                    == len(letters_records) + 10)
+            assert z.block_reduce(_count_records, operator.add,
+                                  prefix=b"q") is None
+            assert z.block_reduce(_count_records, operator.add,
+                                  prefix=b"q", initial=0) == 0
+            # order is preserved
+            assert (z.block_reduce(identity, operator.add)
+                    == letters_records)
+            # None is a real initial value, not "no initial value"
+            assert_raises(TypeError,
+                          z.block_reduce, identity, operator.add,
+                          initial=None)
+
+def test_block_reduce_combine_partials():
+    from zs.reader import _BlockReduceHelper, _partial_value
+    p = test_data_path("letters-none.zs")
+    for pickled in [False, True]:
+        with ZS(p, parallelism=2, executor="thread") as z:
+            helper = _BlockReduceHelper(identity, operator.add, (), {},
+                                        pickled)
+            partials = [helper.wrap([i]) for i in range(20)]
+            z._combine_partials(helper, partials, 10, False)
+            assert 1 < len(partials) < 20
+            z._combine_partials(helper, partials, 10, True)
+            assert len(partials) == 1
+            assert (helper.unwrap(_partial_value(partials[0]))
+                    == list(range(20)))
+
 def test_big_headers():
     from zs.reader import _lower_header_size_guess
     with _lower_header_size_guess():
@@ -6,7 +6,7 @@ from nose.tools import assert_raises
 from requests import HTTPError
 
 from zs import ZSError
-from .util import test_data_path
+from .util import test_data_path, tempname
 from .http_harness import web_server, simplehttpserver
 from ..transport import FileTransport, HTTPTransport
 
@@ -17,6 +17,14 @@ def check_transport(t):
 
     assert t.length() == len(contents)
 
+    # streams and chunk reads don't interfere with each other
+    s = t.stream_read(10)
+    assert t.chunk_read(0, 2) == contents[0:2]
+    assert s.read(2) == contents[10:12]
+    assert t.chunk_read(20, 2) == contents[20:22]
+    assert s.read(2) == contents[12:14]
+    s.close()
+
     assert t.chunk_read(0, 2) == contents[0:2]
     assert t.chunk_read(2, 2) == contents[2:4]
     # partial reads are okay
@@ -49,12 +57,48 @@ def check_transport(t):
 
 def test_FileTransport():
     check_transport(FileTransport(test_data_path("transport-test/alphabet")))
+
+    # reads are served straight out of a memory map when possible, and it's
+    # okay to close the transport while pieces of it are still in use
+    t = FileTransport(test_data_path("transport-test/alphabet"))
+    piece = t.chunk_read(2, 3)
+    s = t.stream_read(4)
+    streamed = s.read(2)
+    if isinstance(piece, memoryview):
+        assert isinstance(streamed, memoryview)
+    t.close()
+    assert piece == contents[2:5]
+    assert streamed == contents[4:6]
     assert_raises(IOError, FileTransport, test_data_path("SDFASDFASDFAS"))
 
+def test_FileTransport_no_mmap():
+    import os
+    with tempname() as path:
+        with open(path, "wb") as f:
+            f.write(contents)
+        def unmapped_transport():
+            t = FileTransport(path)
+            # pretend the mmap failed
+            t.close()
+            t._file = open(path, "rb")
+            return t
+        check_transport(unmapped_transport())
+        # streams keep reading the file we opened, even if something else
+        # gets put at the same path
+        t = unmapped_transport()
+        s = t.stream_read(3)
+        os.unlink(path)
+        with open(path, "wb") as f:
+            f.write(b"x" * len(contents))
+        assert s.read(2) == contents[3:5]
+        s.close()
+        t.close()
+
 def test_HTTPTransport():
     with web_server(test_data_path("transport-test")) as base_url:
         url = base_url + "/alphabet"
         check_transport(HTTPTransport(url))
+        check_transport(HTTPTransport(url, connections=1))
         non_existent = HTTPTransport(url + "ASDFASDFASDF")
         assert_raises(HTTPError, non_existent.chunk_read, 0, 1)
 
@@ -65,21 +109,112 @@ def test_HTTPTransport():
         assert s.read(2) == contents[8:10]
         assert s.read(3) == b""
 
+        # streams are fetched in pieces, which must come back in order
+        from .. import transport
+        was = transport.HTTP_FETCH_MIN_SIZE, transport.HTTP_FETCH_MAX_SIZE
+        transport.HTTP_FETCH_MIN_SIZE = 1
+        transport.HTTP_FETCH_MAX_SIZE = 4
+        try:
+            for connections in [1, 3]:
+                for read_size in [1, 3, 100]:
+                    ht = HTTPTransport(url, connections=connections)
+                    for (start, stop) in [(0, None), (3, None), (3, 20)]:
+                        s = ht.stream_read(start, stop)
+                        got = b""
+                        while True:
+                            data = s.read(read_size)
+                            if not data:
+                                break
+                            got += data
+                            assert s.tell() == start + len(got)
+                        assert got == contents[start:stop]
+                        s.close()
+                    # closing with fetches still in flight is fine
+                    s = ht.stream_read(0)
+                    assert s.read(1) == contents[:1]
+                    s.close()
+                    ht.close()
+        finally:
+            transport.HTTP_FETCH_MIN_SIZE, transport.HTTP_FETCH_MAX_SIZE = was
+
         # check that length() works properly both before and after calling the
         # various methods, to exercise the clever caching logic
         assert HTTPTransport(url).length() == len(contents)
 
+        def no_head(*args, **kwargs):
+            raise AssertionError("length should be known already")
+
         ht = HTTPTransport(url)
         ht.chunk_read(5, 8)
+        ht._session.head = no_head
         assert ht.length() == len(contents)
 
         ht = HTTPTransport(url)
         ht.stream_read(5, 8)
+        ht._session.head = no_head
         assert ht.length() == len(contents)
 
+        # once the tail has been prefetched, reads that it covers don't need
+        # any more requests
+        for tail_size in [10, 100]:
+            ht = HTTPTransport(url)
+            ht.prefetch_tail(tail_size)
+            assert ht.chunk_read(0, 2) == contents[:2]
+            ht._session.get = no_head
+            ht._session.head = no_head
+            assert ht.length() == len(contents)
+            assert ht.chunk_read(len(contents) - 5, 3) == contents[-5:-2]
+            assert ht.chunk_read(len(contents) - 2, 5) == contents[-2:]
+            if tail_size > len(contents):
+                assert ht.chunk_read(0, 3) == contents[:3]
+
     with web_server(test_data_path("transport-test"),
                     range_support=False) as base_url:
         url = base_url + "/alphabet"
         ht = HTTPTransport(url)
         assert_raises(ZSError, ht.chunk_read, 10, 1)
         assert_raises(ZSError, ht.stream_read, 10)
+
+        # the tail prefetch is best-effort
+        ht = HTTPTransport(url)
+        ht.prefetch_tail(10)
+        assert ht.chunk_read(0, 2) == contents[:2]
+        assert_raises(ZSError, ht.chunk_read, len(contents) - 5, 3)
+
+        # a full-file response also tells us the length
+        ht = HTTPTransport(url)
+        ht.chunk_read(0, 1)
+        ht._session.head = no_head
+        assert ht.length() == len(contents)
+
+def test_HTTPTransport_tail_ignored_range():
+    # If the server ignores the Range: on the tail prefetch, then we hang up
+    # without reading the body (which would be the whole file).
+    class FakeResponse(object):
+        def __init__(self, status_code, headers):
+            self.status_code = status_code
+            self.headers = headers
+            self.closed = False
+
+        @property
+        def content(self):
+            assert self.status_code == 206
+            return b"xyz"
+
+        def close(self):
+            self.closed = True
+
+    responses = []
+    def fake_get(url, headers, stream=False):
+        assert stream
+        responses.append(FakeResponse(*next(replies)))
+        return responses[-1]
+
+    ht = HTTPTransport("http://example.invalid/x.zs")
+    ht._session.get = fake_get
+    replies = iter([(200, {"Content-Length": "1000000"}),
+                    (206, {"Content-Range": "bytes 97-99/100"})])
+    assert ht._suffix_read(3) is None
+    assert ht._suffix_read(3) == (97, b"xyz")
+    assert ht._length == 100
+    assert [r.closed for r in responses] == [True, True]
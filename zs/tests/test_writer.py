@@ -83,6 +83,25 @@ def test_write_add_file_contents_length_prefixed():
                 assert list(z) == records
                 assert len(list(z.block_map(identity))) > len(records) / 5.0
 
+def test_from_file_length_prefixed_long_record_and_truncation():
+    long_records = [b"a" * 100, b"b" * 1000, b"c"]
+    for mode in ["uleb128", "u64le"]:
+        f = BytesIO()
+        write_length_prefixed(f, long_records, mode)
+        with temp_writer() as (p, zw):
+            # records longer than the approx_block_size
+            zw.add_file_contents(BytesIO(f.getvalue()), 10,
+                                 length_prefixed=mode)
+            zw.finish()
+
+            with ok_zs(p) as z:
+                assert list(z) == long_records
+
+        with temp_writer() as (p, zw):
+            assert_raises(ValueError, zw.add_file_contents,
+                          BytesIO(f.getvalue()[:-1]), 10,
+                          length_prefixed=mode)
+
 def test_write_mixed():
     with temp_writer() as (p, zw):
         zw.add_data_block([b"a", b"b"])
@@ -140,6 +159,104 @@ def test_from_file_terminator_long_record():
         with ok_zs(p) as z:
             assert list(z) == records
 
+def test_from_file_terminator_shared_chunks():
+    from zs.writer import SHARED_CHUNK_SLACK
+    with temp_writer(parallelism=2, codec="none") as (p, zw):
+        # lots more chunks than there are shared memory slots
+        records = [(u"%08i" % (i,)).encode("ascii") for i in range(1000)]
+        zw.add_file_contents(BytesIO(b"\n".join(records + [b""])), 50)
+        # a chunk too big for its slot gets pickled instead
+        big = [b"x" * (2 * SHARED_CHUNK_SLACK)]
+        zw.add_file_contents(BytesIO(b"\n".join(big + [b""])), 50)
+        # and bigger chunks get bigger slots
+        more = [b"y" * 1000, b"z" * 1000]
+        zw.add_file_contents(BytesIO(b"\n".join(more + [b""])),
+                             2 * SHARED_CHUNK_SLACK)
+        zw.finish()
+
+        with ok_zs(p) as z:
+            assert list(z) == records + big + more
+
+def test_sha256():
+    import hashlib
+    from zs._zs import pack_data_records
+    with temp_writer(parallelism=3, codec="none") as (p, zw):
+        zw.add_data_block([b"", b"A"])
+        f = BytesIO(b"\n".join(records[1:] + [b""]))
+        zw.add_file_contents(f, 100)
+        zw.finish()
+
+        with ZS(p) as z:
+            hasher = hashlib.sha256()
+            for block in z.block_map(pack_data_records):
+                hasher.update(block)
+            assert z.data_sha256 == hasher.digest()
+
+def test_max_in_flight_bytes():
+    import zs.writer
+    orig_max_in_flight_bytes = zs.writer.MAX_IN_FLIGHT_BYTES
+    zs.writer.MAX_IN_FLIGHT_BYTES = 100
+    try:
+        with temp_writer(parallelism=2) as (p, zw):
+            zw.add_file_contents(BytesIO(b"\n".join(records + [b""])), 30)
+            assert zw._in_flight_bytes <= 100
+            # a single block bigger than the limit still goes through
+            zw.add_data_block([b"ZZZZ" * 100])
+            zw.add_data_block([b"zzzz"])
+            assert zw._in_flight_bytes <= 100
+            zw.finish()
+            # finish() collected the last done messages
+            assert not zw._in_flight
+            assert zw._in_flight_bytes == 0
+
+            with ok_zs(p) as z:
+                assert list(z) == records + [b"ZZZZ" * 100, b"zzzz"]
+    finally:
+        zs.writer.MAX_IN_FLIGHT_BYTES = orig_max_in_flight_bytes
+
+def test_chunk_slots_bounded():
+    import zs.writer
+    from zs.writer import SHARED_CHUNK_SLACK
+    orig_max_in_flight_bytes = zs.writer.MAX_IN_FLIGHT_BYTES
+    zs.writer.MAX_IN_FLIGHT_BYTES = 2 ** 20
+    try:
+        with temp_writer(parallelism=2) as (p, zw):
+            zw.add_file_contents(BytesIO(b"\n".join(records + [b""])), 30)
+            ring = zw._chunk_slots
+            if ring is None:  # pragma: no cover
+                return
+            slot_size = 3 * (30 + SHARED_CHUNK_SLACK) + SHARED_CHUNK_SLACK
+            # fewer than the usual SHARED_SLOTS_PER_COMPRESSOR * parallelism
+            assert len(ring.slots) == 2 ** 20 // slot_size < 8
+            # bigger chunks get a new ring, and the old one is freed once
+            # nothing is using it anymore
+            zw.add_file_contents(BytesIO(b"zzzz\n"), 2 ** 17)
+            assert zw._chunk_slots is not ring
+            assert len(zw._chunk_slots.slots) == 1
+            zw.finish()
+            assert not ring.slots
+            assert not zw._old_chunk_slots
+
+            with ok_zs(p) as z:
+                assert list(z) == records + [b"zzzz"]
+    finally:
+        zs.writer.MAX_IN_FLIGHT_BYTES = orig_max_in_flight_bytes
+
+def test_big_payloads():
+    from zs.writer import SHARED_PAYLOAD_MIN_SIZE
+    # big payloads from add_data_block, and ones that don't fit in their
+    # chunk's shared memory slot, get to the hasher through shared memory
+    # segments of their own
+    big = b"x" * SHARED_PAYLOAD_MIN_SIZE
+    with temp_writer(parallelism=2, codec="none") as (p, zw):
+        zw.add_data_block([b"a", b"b" + big])
+        zw.add_file_contents(BytesIO(b"c" + big + b"\nd\n"), 10)
+        zw.add_data_block([b"e"])
+        zw.finish()
+
+        with ok_zs(p) as z:
+            assert list(z) == [b"a", b"b" + big, b"c" + big, b"d", b"e"]
+
 def test_from_file_length_prefixed_exactly_one_block():
     with temp_writer() as (p, zw):
         zw.add_file_contents(BytesIO(b"\x08aaaaaaaa\x04bbbb"), 10,
@@ -4,8 +4,9 @@
 
 import os
 import os.path
+import shutil
 from contextlib import contextmanager
-from tempfile import mkstemp
+from tempfile import mkstemp, mkdtemp
 
 def test_data_path(path=""):
     test_data_dir = os.path.join(os.path.dirname(__file__), "data")
@@ -29,6 +30,14 @@ def tempname(suffix="", unlink_first=False):
             # if it was already deleted, then that's okay
             pass
 
+@contextmanager
+def tempdir():
+    path = mkdtemp()
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
 def test_tempname():
     with tempname(".asdf") as name:
         assert os.path.exists(name)
@@ -45,3 +54,10 @@ def test_tempname():
         # securely create the file
         os.close(os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
     assert not os.path.exists(name)
+
+def test_tempdir():
+    with tempdir() as path:
+        assert os.path.isdir(path)
+        with open(os.path.join(path, "x"), "w"):
+            pass
+    assert not os.path.exists(path)
@@ -5,9 +5,13 @@
 # Transports couple the ZS reader to a data source.
 
 import os
+import sys
 import re
+import mmap
+import threading
+from collections import deque
 
-from six import BytesIO
+from six import BytesIO, reraise
 import requests
 
 from .common import ZSError
@@ -19,37 +23,149 @@ class FileTransport(object):
         self._file = open(path, "rb")
         # To include in user-directed error messages etc.
         self.name = path
+        # Whenever possible, we map the whole file into memory, and hand out
+        # memoryviews that point directly into the mapping. This saves a
+        # syscall and a copy on every read. (mmap refuses to map empty
+        # files, and on py2 mmap objects don't support memoryview; in these
+        # cases we fall back on regular reads.)
+        self._mmap = None
+        self._view = None
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+        except (ValueError, TypeError, EnvironmentError):
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
 
     # This allows partial reads (i.e., if EOF falls in the middle of the
     # requested chunk, then we return the part before the EOF). Fortunately,
     # this is how both normal Python read() and how HTTP Range work
     # out-of-the-box.
+    #
+    # Returns a bytes-like object: either bytes or a memoryview.
     def chunk_read(self, offset, length):
+        if self._view is not None:
+            return self._view[offset:offset + length]
         self._file.seek(offset)
         return self._file.read(length)
 
     # Returns a file-like object which will return bytes from the given
     # position. 'stop_offset', if given, is a hint -- the returned file-like
     # object may or may not EOF after reaching this point.
+    #
+    # Streams are read from other threads while chunk_read() is being used,
+    # so each one needs its own file position. os.dup()ing our fd doesn't
+    # give that (dup'ed fds share their position), and opening self.name
+    # again might get a different file if it's been replaced since we opened
+    # it. So we read through our own fd with pread() and keep track of the
+    # position ourselves. (Where pread() isn't available, reopening by name
+    # is the best we can do.)
     def stream_read(self, offset, stop_offset=None):
-        new_file = os.fdopen(os.dup(self._file.fileno()), "rb")
-        new_file.seek(offset)
-        return new_file
+        if self._view is not None:
+            return _BufferStream(self._view, offset)
+        if hasattr(os, "pread"):
+            return _PreadStream(self._file.fileno(), offset)
+        new_file = open(self.name, "rb")  # pragma: no cover
+        new_file.seek(offset)  # pragma: no cover
+        return new_file  # pragma: no cover
 
     def length(self):
         stat = os.fstat(self._file.fileno())
         return stat.st_size
 
     def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Someone is still holding a memoryview into the mapping
+                # (e.g. a cached block); the mapping will be released when
+                # the last one goes away.
+                pass
+            self._mmap = None
         self._file.close()
 
+# A file-like object reading from an in-memory buffer, like BytesIO, except
+# that it returns slices of the buffer rather than copies. Unlike BytesIO, it
+# never copies the underlying buffer, either.
+class _BufferStream(object):
+    def __init__(self, view, offset):
+        self._view = view
+        self._offset = offset
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset):
+        self._offset = offset
+
+    def read(self, length):
+        data = self._view[self._offset:self._offset + length]
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        self._view = None
+
+class _PreadStream(object):
+    def __init__(self, fd, offset):
+        # our own fd, so that the file stays open even if the transport is
+        # closed first
+        self._fd = os.dup(fd)
+        self._offset = offset
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset):
+        self._offset = offset
+
+    def read(self, length):
+        data = os.pread(self._fd, length, self._offset)
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+# HTTP streams are fetched as a series of ranged requests, several at a
+# time. The first one is small, in case only a little data is wanted, and
+# they double in size from there.
+HTTP_FETCH_MIN_SIZE = 64 * 2 ** 10
+HTTP_FETCH_MAX_SIZE = 4 * 2 ** 20
+
 class HTTPTransport(object):
     remote = True
 
-    def __init__(self, url):
+    # 'connections' is the maximum number of connections to the server that
+    # we use at once (and hold on to for reuse).
+    def __init__(self, url, connections=4):
         self._url = url
         self.name = url
         self._length = None
+        self._connections = connections
+        # See prefetch_tail()
+        self._tail_size = None
+        self._tail_fetch = None
+        # No request ever waits on another while holding one of these, so
+        # this can't deadlock; it just makes sure that we never have more
+        # requests outstanding than the connection pool has room for.
+        self._request_slots = threading.BoundedSemaphore(connections)
+        # Reusing connections saves a TCP (and maybe TLS) handshake on every
+        # request, which matters a lot when each index lookup is a separate
+        # small request.
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=connections)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
 
     _crange_re = re.compile(r"^bytes (\d+)-\d+/(\d+|\*)")
     def _check_offset(self, response, desired_offset):
@@ -68,56 +184,184 @@ class HTTPTransport(object):
             offset = int(match.group(1))
         if offset != desired_offset:
             raise ZSError("HTTP server did not respect Range: request")
-        if match and match.group(2) != "*":
-            self._length = int(match.group(2))
+        # Whatever the response, if it tells us the length of the file then
+        # we can skip sending a HEAD request later.
+        if match:
+            if match.group(2) != "*":
+                self._length = int(match.group(2))
+        elif ("Content-Length" in response.headers
+              and "Content-Encoding" not in response.headers):
+            # A plain 200 response, i.e. the whole file
+            self._length = int(response.headers["Content-Length"])
+
+    # Starts fetching the last 'length' bytes of the file in the background,
+    # and from then on uses them to serve any chunk_read()s that they cover.
+    # The point is that when opening a ZS file, this can be done in parallel
+    # with reading the header, and then the root index (which is always at
+    # the end of the file), and often the next few index levels too, are
+    # available without any more round trips. This is purely an
+    # optimization; if anything goes wrong, we just fall back on regular
+    # reads.
+    def prefetch_tail(self, length):
+        self._tail_size = length
+        self._tail_fetch = _BackgroundCall(self._suffix_read, length)
+
+    # Returns (offset, data) or None.
+    def _suffix_read(self, length):
+        headers = {"Range": "bytes=-%s" % (length,)}
+        try:
+            with self._request_slots:
+                # stream=True, so that if the server ignores our Range: and
+                # sends the whole file, we can hang up instead of
+                # downloading it.
+                response = self._session.get(self._url, headers=headers,
+                                             stream=True)
+                try:
+                    match = self._crange_re.match(
+                        response.headers.get("Content-Range", ""))
+                    if (response.status_code != 206
+                        or not match or match.group(2) == "*"):
+                        return None
+                    content = response.content
+                finally:
+                    response.close()
+        except requests.RequestException:
+            return None
+        self._length = int(match.group(2))
+        return (int(match.group(1)), content)
+
+    def _tail_read(self, offset, length):
+        # We can only tell whether the tail will cover this read once we know
+        # the file length -- which we usually learn from the header read.
+        if self._tail_fetch is None or self._length is None:
+            return None
+        if offset < self._length - self._tail_size:
+            return None
+        tail = self._tail_fetch.result()
+        if tail is None:
+            self._tail_fetch = None
+            return None
+        tail_offset, tail_data = tail
+        if offset < tail_offset:
+            return None
+        return tail_data[offset - tail_offset:offset - tail_offset + length]
 
     def chunk_read(self, offset, length):
+        data = self._tail_read(offset, length)
+        if data is not None:
+            return data
         # -1 because Range: is inclusive
         headers = {"Range": "bytes=%s-%s" % (offset, offset + length - 1)}
-        response = requests.get(self._url, headers=headers)
+        with self._request_slots:
+            response = self._session.get(self._url, headers=headers)
         # if we got an error response, raise an exception
         response.raise_for_status()
         self._check_offset(response, offset)
         # .content is the byte (not text) version of the response
         return response.content
 
+    # Rather than making one long streaming request, which would limit us
+    # to the throughput of a single TCP connection, we split the span up
+    # into pieces and fetch several of them at once.
     def stream_read(self, offset, stop_offset=None):
-        if stop_offset is None:
-            stop_offset = ""
-        else:
-            stop_offset -= 1
-            if stop_offset < offset:
-                # server will just return 416, Requested range not satisfiable
-                return BytesIO(b"")
-        # Limited range is "100-200", endless range is "100-".
-        headers = {"Range": "bytes=%s-%s" % (offset, stop_offset)}
-        response = requests.get(self._url, headers=headers, stream=True)
-        response.raise_for_status()
-        self._check_offset(response, offset)
-        return _HTTPStream(offset, response)
+        if stop_offset is not None and stop_offset <= offset:
+            # server will just return 416, Requested range not satisfiable
+            return BytesIO(b"")
+        return _HTTPStream(self, offset, stop_offset)
 
     def length(self):
         if self._length is None:
-            response = requests.head(self._url)
+            with self._request_slots:
+                response = self._session.head(self._url)
             self._length = int(response.headers["Content-Length"])
         return self._length
 
     def close(self):
-        pass
+        self._session.close()
 
+# Calls fn(*args) in a background thread, and lets you pick up the result
+# (or exception) later.
+class _BackgroundCall(object):
+    def __init__(self, fn, *args):
+        self._result = None
+        self._exc_info = None
+        self._done = threading.Event()
+        thread = threading.Thread(target=self._run, args=(fn, args))
+        # Abandoned requests shouldn't keep the interpreter alive.
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, fn, args):
+        try:
+            self._result = fn(*args)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._done.set()
+
+    def result(self):
+        self._done.wait()
+        if self._exc_info is not None:
+            reraise(*self._exc_info)
+        return self._result
+
+# Reads [offset, stop_offset) as a sequence of ranged requests, keeping up
+# to one per connection in flight at a time, and returns the data in
+# order. This holds at most 'connections' pieces in memory at once.
 class _HTTPStream(object):
-    def __init__(self, offset, response):
-        self._response = response
+    def __init__(self, transport, offset, stop_offset):
+        self._transport = transport
         self._offset = offset
+        self._fetch_size = HTTP_FETCH_MIN_SIZE
+        # We do the first fetch right away, so that errors (e.g. a server
+        # that ignores Range:) are reported here, and so that we learn the
+        # file's length if we didn't know it already.
+        first_length = self._fetch_size
+        if stop_offset is not None:
+            first_length = min(first_length, stop_offset - offset)
+        self._buf = transport.chunk_read(offset, first_length)
+        self._buf_pos = 0
+        if stop_offset is None or stop_offset > transport.length():
+            stop_offset = transport.length()
+        self._stop_offset = stop_offset
+        self._next_fetch = offset + len(self._buf)
+        self._fetches = deque()
 
     def tell(self):
         return self._offset
 
+    def _start_fetches(self):
+        while (len(self._fetches) < self._transport._connections
+               and self._next_fetch < self._stop_offset):
+            self._fetch_size = min(2 * self._fetch_size, HTTP_FETCH_MAX_SIZE)
+            length = min(self._fetch_size,
+                         self._stop_offset - self._next_fetch)
+            fetch = _BackgroundCall(self._transport.chunk_read,
+                                    self._next_fetch, length)
+            self._fetches.append((self._next_fetch, length, fetch))
+            self._next_fetch += length
+
     def read(self, length):
-        for chunk in self._response.iter_content(length):
-            self._offset += len(chunk)
-            return chunk
-        return b""
+        if self._buf_pos == len(self._buf):
+            self._start_fetches()
+            if not self._fetches:
+                return b""
+            fetch_offset, fetch_length, fetch = self._fetches.popleft()
+            self._buf = fetch.result()
+            self._buf_pos = 0
+            if len(self._buf) != fetch_length:
+                raise ZSError("got %s bytes from HTTP server when asking "
+                              "for %s at offset %s (file changed?)"
+                              % (len(self._buf), fetch_length, fetch_offset))
+            self._start_fetches()
+        data = self._buf[self._buf_pos:self._buf_pos + length]
+        self._buf_pos += len(data)
+        self._offset += len(data)
+        return data
 
     def close(self):
-        self._response.close()
+        # Any fetches still running will finish in the background, and their
+        # results will be dropped.
+        self._fetches.clear()
+        self._buf = b""
+        self._buf_pos = 0
@@ -29,11 +29,13 @@ from zs.common import (ZSError,
                        header_data_length_format,
                        codec_shorthands,
                        codecs,
-                       read_format,
-                       read_length_prefixed)
-from zs._zs import (pack_data_records, pack_index_records,
+                       read_format)
+from zs._zs import (pack_data_records, pack_index_records, pack_chunk,
+                      pack_length_prefixed_chunk, length_prefixed_boundary,
                       unpack_data_records,
                       write_uleb128)
+from zs.sharedmem import (have_shared_memory, SharedMemoryRing, attach,
+                          prepare_for_workers, put_segment, take_segment)
 
 # how often to poll for pipeline errors while blocking in the main thread, in
 # seconds
@@ -42,6 +44,39 @@ ERROR_CHECK_FREQ = 0.1
 # seconds between spinner updates
 SPIN_UPDATE_TIME = 0.3
 
+# add_file_contents hands chunks to the compressors, and the compressors hand
+# their results to the writer, through shared memory slots (see
+# zs/sharedmem.py), so that only small descriptors go through the queues. The
+# input half of each slot holds a chunk of up to approx_block_size +
+# SHARED_CHUNK_SLACK bytes; the output half holds the packed payload and the
+# compressed payload, which are usually about the same size as the chunk
+# (plus a bit for the length prefixes). Anything that doesn't fit gets
+# pickled instead (except for payloads, see SHARED_PAYLOAD_MIN_SIZE). Slots
+# go back to the main process once the writer and the hasher (see
+# _hash_worker) are done with them, so the number of slots also limits how
+# many chunks are in flight. Every slot is allocated up front, so we never
+# make more of them than fit in MAX_IN_FLIGHT_BYTES.
+SHARED_CHUNK_SLACK = 64 * 2 ** 10
+SHARED_SLOTS_PER_COMPRESSOR = 4
+
+# Uncompressed payloads that don't have a slot to go in (because they came
+# from add_data_block, or didn't fit) are handed to the hasher in a shared
+# memory segment of their own (see zs.sharedmem.put_segment), so that they
+# never get pickled -- except for ones smaller than this, where setting up a
+# segment costs more than pickling, or if shared memory isn't available at
+# all.
+SHARED_PAYLOAD_MIN_SIZE = 64 * 2 ** 10
+
+# The queues between the pipeline stages are bounded by number of jobs, but
+# that doesn't say much about memory when the blocks are big, and the writer
+# and hasher have to hold onto any blocks that arrive out of order until the
+# blocks before them are done. So we also limit the total size of all the
+# jobs that the writer and hasher haven't finished yet -- counting the input,
+# and the payload and compressed payload that it turns into; once it hits
+# this many bytes, we wait for them to catch up before submitting more. (A
+# single job bigger than this is still allowed through on its own.)
+MAX_IN_FLIGHT_BYTES = 256 * 2 ** 20
+
 def _flush_file(f):
     f.flush()
     os.fsync(f.fileno())
@@ -248,12 +283,29 @@ class ZSWriter(object):
         assert parallelism > 0
         self._compress_queue = multiprocessing.Queue(2 * parallelism)
         self._write_queue = multiprocessing.Queue(2 * parallelism)
+        self._hash_queue = multiprocessing.Queue(2 * parallelism)
         self._finish_queue = multiprocessing.Queue(1)
+        self._digest_queue = multiprocessing.Queue(1)
         self._error_queue = multiprocessing.Queue()
+        # The writer and the hasher each send back (job index, None) on the
+        # done queue once they've finished with a job, and the compressor
+        # that handled it sends (job index, size of the payload and
+        # compressed payload). _in_flight maps the index of each unfinished
+        # job to [number of writer/hasher messages seen so far, bytes charged
+        # to it, job input size, (ring, slot) or None].
+        self._done_queue = multiprocessing.Queue()
+        self._in_flight = {}
+        self._in_flight_bytes = 0
+        # Shared memory slots for add_file_contents (created once we know how
+        # big the chunks are).
+        self._chunk_slots = None
+        self._old_chunk_slots = []
+        prepare_for_workers()
         self._compressors = []
         for i in range(parallelism):
             compress_args = (self._compress_fn, self._codec_kwargs,
                              self._compress_queue, self._write_queue,
+                             self._hash_queue, self._done_queue,
                              self._error_queue)
             p = multiprocessing.Process(target=_compress_worker,
                                         args=compress_args)
@@ -263,10 +315,16 @@ class ZSWriter(object):
                        self.branching_factor,
                        self._compress_fn, self._codec_kwargs,
                        self._write_queue, self._finish_queue,
+                       self._done_queue,
                        self._show_spinner, self._error_queue)
         self._writer = multiprocessing.Process(target=_write_worker,
                                                args=writer_args)
         self._writer.start()
+        hasher_args = (self._hash_queue, self._digest_queue,
+                       self._done_queue, self._error_queue)
+        self._hasher = multiprocessing.Process(target=_hash_worker,
+                                               args=hasher_args)
+        self._hasher.start()
 
         self.closed = False
 
@@ -298,8 +356,118 @@ class ZSWriter(object):
     def _safe_join(self, process):
         while process.is_alive():
             self._check_error()
+            # A process that has put things on a queue doesn't exit until
+            # they've all been flushed into the underlying pipe, so if nobody
+            # is reading the done queue, then the writer and hasher can get
+            # stuck on it.
+            self._collect_done()
             process.join(ERROR_CHECK_FREQ)
 
+    # Returns the SharedMemoryRing to use for chunks of about
+    # approx_block_size bytes, or None if shared memory isn't available.
+    def _get_chunk_slots(self, approx_block_size):
+        input_size = approx_block_size + SHARED_CHUNK_SLACK
+        ring = self._chunk_slots
+        if ring is not None and ring.slots[0].input_size >= input_size:
+            return ring
+        if not have_shared_memory:  # pragma: no cover
+            return None
+        # Any slots that are still in use are in use by chunks of a
+        # different size, and are about to get pickled anyway... but we
+        # can't free them until the writer is done with them, so we just
+        # let the old ring go (see _close_idle_rings), and make a new one.
+        output_size = 2 * input_size + SHARED_CHUNK_SLACK
+        num_slots = min(SHARED_SLOTS_PER_COMPRESSOR * self._parallelism,
+                        MAX_IN_FLIGHT_BYTES // (input_size + output_size))
+        try:
+            ring = SharedMemoryRing(max(num_slots, 1),
+                                    input_size, output_size)
+        except EnvironmentError:
+            return None
+        if self._chunk_slots is not None:
+            self._old_chunk_slots.append(self._chunk_slots)
+            self._close_idle_rings()
+        self._chunk_slots = ring
+        return ring
+
+    # Frees the old rings that don't have any slots in use anymore.
+    def _close_idle_rings(self):
+        still_busy = []
+        for ring in self._old_chunk_slots:
+            if ring.idle():
+                ring.close()
+            else:
+                still_busy.append(ring)
+        self._old_chunk_slots = still_busy
+
+    # Handles any messages on the done queue. If wait is true, then first
+    # blocks until there's at least one.
+    def _collect_done(self, wait=False):
+        while True:
+            try:
+                if wait:
+                    msg = self._done_queue.get(timeout=ERROR_CHECK_FREQ)
+                else:
+                    msg = self._done_queue.get_nowait()
+            except six.moves.queue.Empty:
+                if not wait:
+                    return
+                self._check_error()
+                continue
+            wait = False
+            idx, output_bytes = msg
+            job_info = self._in_flight.get(idx)
+            if job_info is None:
+                # the compressor's message can arrive after the writer's and
+                # the hasher's
+                continue
+            if output_bytes is not None:
+                # replace our guess at the output size with the real one
+                charge = job_info[2] + output_bytes
+                self._in_flight_bytes += charge - job_info[1]
+                job_info[1] = charge
+                continue
+            job_info[0] += 1
+            if job_info[0] == 2:
+                # both the writer and the hasher are done with it
+                del self._in_flight[idx]
+                self._in_flight_bytes -= job_info[1]
+                if job_info[3] is not None:
+                    ring, slot = job_info[3]
+                    ring.release(slot)
+                    if self._old_chunk_slots:
+                        self._close_idle_rings()
+
+    # Until the compressor tells us otherwise, we guess that a job's payload
+    # and compressed payload are each about as big as its input.
+    @staticmethod
+    def _initial_charge(nbytes):
+        return 3 * nbytes
+
+    # Waits until there's room in the pipeline for a job of the given input
+    # size.
+    def _wait_for_room(self, nbytes):
+        charge = self._initial_charge(nbytes)
+        self._collect_done()
+        while (self._in_flight
+               and self._in_flight_bytes + charge > MAX_IN_FLIGHT_BYTES):
+            self._collect_done(wait=True)
+
+    # Returns a free slot from the given ring, waiting for the writer and
+    # hasher to give one back if necessary.
+    def _get_free_slot(self, ring):
+        while True:
+            slot = ring.acquire()
+            if slot is not None:
+                return slot
+            self._collect_done(wait=True)
+
+    def _submit(self, job, nbytes, ring_slot=None):
+        charge = self._initial_charge(nbytes)
+        self._in_flight[job[0]] = [0, charge, nbytes, ring_slot]
+        self._in_flight_bytes += charge
+        self._safe_put(self._compress_queue, job)
+
     def add_data_block(self, records):
         """Append the given set of records to the ZS file as a single data
         block.
@@ -314,8 +482,9 @@ class ZSWriter(object):
         with errors_close(self):
             if not records:
                 return
-            self._safe_put(self._compress_queue,
-                           (self._next_job, "list", records))
+            nbytes = sum(len(record) for record in records)
+            self._wait_for_room(nbytes)
+            self._submit((self._next_job, "list", records), nbytes)
             self._next_job += 1
 
     def add_file_contents(self, file_handle, approx_block_size,
@@ -362,6 +531,7 @@ class ZSWriter(object):
         partial_record = b""
         next_job = self._next_job
         read = file_handle.read
+        ring = self._get_chunk_slots(approx_block_size)
         while True:
             buf = file_handle.read(approx_block_size)
             if not buf:
@@ -378,24 +548,51 @@ class ZSWriter(object):
                 partial_record = buf
                 continue
             #print "PUTTING %s" % (next_job,)
-            self._safe_put(self._compress_queue,
-                           (next_job, "chunk-sep", buf, terminator))
+            self._put_chunk(ring, next_job, buf, "sep", terminator)
             next_job += 1
         self._next_job = next_job
 
     def _afc_length_prefixed(self, file_handle, approx_block_size,
                              length_prefixed):
-        records = []
-        this_block_size = 0
-        for record in read_length_prefixed(file_handle, length_prefixed):
-            records.append(record)
-            this_block_size += len(record)
-            if this_block_size >= approx_block_size:
-                self.add_data_block(records)
-                records = []
-                this_block_size = 0
-        if records:
-            self.add_data_block(records)
+        # same idea as _afc_terminator, except that finding the end of the
+        # last complete record in each chunk means walking the length
+        # prefixes (in Cython).
+        if length_prefixed not in ("uleb128", "u64le"):
+            raise ValueError("length-prefix mode must be u64le or uleb128")
+        partial_record = b""
+        next_job = self._next_job
+        ring = self._get_chunk_slots(approx_block_size)
+        while True:
+            buf = file_handle.read(approx_block_size)
+            if not buf:
+                if partial_record:
+                    raise ValueError("%s length-prefixed file ended "
+                                     "mid-record" % (length_prefixed,))
+                break
+            buf = partial_record + buf
+            end = length_prefixed_boundary(buf, length_prefixed)
+            if end == 0:
+                partial_record = buf
+                continue
+            buf, partial_record = buf[:end], buf[end:]
+            self._put_chunk(ring, next_job, buf,
+                            "length-prefixed", length_prefixed)
+            next_job += 1
+        self._next_job = next_job
+
+    # Sends a chunk of records to the compressors, through shared memory if
+    # it fits.
+    def _put_chunk(self, ring, idx, buf, chunk_type, split_arg):
+        self._wait_for_room(len(buf))
+        if ring is not None and len(buf) <= ring.slots[0].input_size:
+            slot = self._get_free_slot(ring)
+            slot.buf[:len(buf)] = buf
+            job = (idx, "chunk-shared", chunk_type, slot.name,
+                   slot.input_size, len(buf), split_arg)
+            self._submit(job, len(buf), (ring, slot))
+        else:
+            job = (idx, "chunk", chunk_type, buf, split_arg)
+            self._submit(job, len(buf))
 
     def finish(self):
         """Declare this file finished.
@@ -424,14 +621,19 @@ class ZSWriter(object):
                 self._safe_join(compressor)
             #sys.stdout.write("All compressors finished; waiting for writer\n")
             # All compressors have now finished their work, and submitted
-            # everything to the write queue.
+            # everything to the write and hash queues.
             self._safe_put(self._write_queue, _QUIT)
+            self._safe_put(self._hash_queue, _QUIT)
             self._safe_join(self._writer)
-        # The writer and compressors have all exited, so any errors they've
-        # encountered have definitely been enqueued.
+            self._safe_join(self._hasher)
+            # And pick up whatever done messages arrived after our last look.
+            self._collect_done()
+        # The writer, hasher, and compressors have all exited, so any errors
+        # they've encountered have definitely been enqueued.
         self._check_error()
         sys.stdout.write("zs: Updating header...\n")
-        root_index_offset, root_index_length, sha256 = self._finish_queue.get()
+        root_index_offset, root_index_length = self._finish_queue.get()
+        sha256 = self._digest_queue.get()
         #sys.stdout.write("zs: Root index offset: %s\n" % (root_index_offset,))
         # Now we have the root offset
         self._header["root_index_offset"] = root_index_offset
@@ -474,9 +676,21 @@ class ZSWriter(object):
             return
         self.closed = True
         self._file.close()
-        for worker in self._compressors + [self._writer]:
+        for worker in self._compressors + [self._writer, self._hasher]:
             worker.terminate()
+        # Terminated workers don't flush their queues, but in case one of them
+        # got out some done messages first, empty the done queue before
+        # joining them (see _safe_join).
+        while True:
+            try:
+                self._done_queue.get_nowait()
+            except six.moves.queue.Empty:
+                break
+        for worker in self._compressors + [self._writer, self._hasher]:
             worker.join()
+        for ring in self._old_chunk_slots + [self._chunk_slots]:
+            if ring is not None:
+                ring.close()
 
     def __enter__(self):
         return self
@@ -489,10 +703,53 @@ class ZSWriter(object):
         if hasattr(self, "closed"):
             self.close()
 
+# Copies 'data' into a shared memory slot's output area at 'pos', and returns
+# (pos, length) -- or returns 'data' itself, if it doesn't fit.
+def _put_shared(buf, output_start, pos, data):
+    length = len(data)
+    if output_start + pos + length > len(buf):
+        return data
+    buf[output_start + pos:output_start + pos + length] = data
+    return (pos, length)
+
+# A payload in a shared memory segment of its own; see
+# SHARED_PAYLOAD_MIN_SIZE.
+class _SegmentPayload(object):
+    def __init__(self, name, length):
+        self.name = name
+        self.length = length
+
+def _put_segment(data):
+    if len(data) < SHARED_PAYLOAD_MIN_SIZE:
+        return data
+    name = put_segment(data)
+    if name is None:  # pragma: no cover
+        return data
+    return _SegmentPayload(name, len(data))
+
+# How the compressors split up and pack each type of chunk sent by
+# add_file_contents.
+_CHUNK_PACKERS = {
+    "sep": pack_chunk,
+    "length-prefixed": pack_length_prefixed_chunk,
+}
+
 # This worker loop compresses data blocks and passes them to the write
-# worker.
+# worker, and their uncompressed payloads to the hash worker.
+#
+# Jobs sent to the write worker are tuples
+#   (idx, first_record, last_record, zpayload, slot)
+# and jobs sent to the hash worker are tuples
+#   (idx, payload, slot)
+# The compressors tell the main process how big payload and zpayload are
+# (see ZSWriter._collect_done), and the writer and hasher each tell it when
+# they're done with a job. If slot is not None, then the job came in through a shared
+# memory slot, and slot is (slot name, input size); payload and zpayload may
+# then be (pos, length) tuples, giving their location in the slot's output
+# area. Otherwise, payload may be a _SegmentPayload.
 def _compress_worker(compress_fn, codec_kwargs,
-                     compress_queue, write_queue, error_queue):
+                     compress_queue, write_queue, hash_queue, done_queue,
+                     error_queue):
     # me = os.getpid()
     # def fyi(msg):
     #     sys.stderr.write("compress_worker:%s: %s\n" % (me, msg))
@@ -502,28 +759,47 @@ def _compress_worker(compress_fn, codec_kwargs,
         get = compress_queue.get
         pdr = pack_data_records
         put = write_queue.put
+        put_hash = hash_queue.put
         while True:
             job = get()
             #fyi("got %r" % (job,))
             if job is _QUIT:
                 #fyi("QUIT")
                 return
-            if job[1] == "chunk-sep":
-                idx, job_type, buf, sep = job
-                records = buf.split(sep)
-                payload = pdr(records, 2 * len(buf))
+            slot = None
+            if job[1] == "chunk":
+                idx, job_type, chunk_type, buf, split_arg = job
+                payload, first, last = _CHUNK_PACKERS[chunk_type](
+                    buf, split_arg, 2 * len(buf))
+            elif job[1] == "chunk-shared":
+                (idx, job_type, chunk_type, slot_name, input_size, length,
+                 split_arg) = job
+                slot = (slot_name, input_size)
+                slot_buf = attach(slot_name)
+                payload, first, last = _CHUNK_PACKERS[chunk_type](
+                    slot_buf[:length], split_arg, 2 * length)
             elif job[1] == "list":
                 idx, job_type, records = job
                 payload = pdr(records)
+                first, last = records[0], records[-1]
             else:  # pragma: no cover
                 assert False
             zpayload = compress_fn(payload, **codec_kwargs)
+            done_queue.put((idx, len(payload) + len(zpayload)))
+            if slot is not None:
+                payload = _put_shared(slot_buf, input_size, 0, payload)
+                if isinstance(payload, tuple):
+                    zpayload = _put_shared(slot_buf, input_size,
+                                           payload[1], zpayload)
+            if not isinstance(payload, tuple):
+                payload = _put_segment(payload)
             #fyi("putting")
-            put((idx, records[0], records[-1], payload, zpayload))
+            put((idx, first, last, zpayload, slot))
+            put_hash((idx, payload, slot))
 
 def _write_worker(path, branching_factor,
                   compress_fn, codec_kwargs,
-                  write_queue, finish_queue,
+                  write_queue, finish_queue, done_queue,
                   show_spinner, error_queue):
     with errors_to(error_queue):
         data_appender = _ZSDataAppender(path, branching_factor,
@@ -544,10 +820,57 @@ def _write_worker(path, branching_factor,
             pending_jobs[job[0]] = job[1:]
             while wanted_job in pending_jobs:
                 #sys.stderr.write("write_worker: writing %s\n" % (wanted_job,))
-                write_block(0, *pending_jobs[wanted_job])
-                del pending_jobs[wanted_job]
+                (first_record, last_record, zpayload,
+                 slot) = pending_jobs.pop(wanted_job)
+                with _shared_view(slot, zpayload) as zpayload:
+                    write_block(0, first_record, last_record, zpayload)
+                done_queue.put((wanted_job, None))
+                wanted_job += 1
+
+# The whole-file SHA-256 covers the data block payloads, in order, so it has
+# to be computed serially -- but it doesn't have to be computed by the writer.
+# This worker does it in parallel with the writing (and the writer never
+# has to see the uncompressed payloads at all).
+def _hash_worker(hash_queue, digest_queue, done_queue, error_queue):
+    with errors_to(error_queue):
+        hasher = hashlib.sha256()
+        pending_jobs = {}
+        wanted_job = 0
+        get = hash_queue.get
+        while True:
+            job = get()
+            if job is _QUIT:
+                assert not pending_jobs
+                digest_queue.put(hasher.digest())
+                return
+            pending_jobs[job[0]] = job[1:]
+            while wanted_job in pending_jobs:
+                payload, slot = pending_jobs.pop(wanted_job)
+                with _shared_view(slot, payload) as payload:
+                    hasher.update(payload)
+                done_queue.put((wanted_job, None))
                 wanted_job += 1
 
+# If data is a (pos, length) tuple pointing into the given slot's output
+# area, or a _SegmentPayload, yields a view of it; otherwise yields data as
+# is.
+@contextmanager
+def _shared_view(slot, data):
+    if isinstance(data, _SegmentPayload):
+        with take_segment(data.name, data.length) as view:
+            yield view
+        return
+    if not isinstance(data, tuple):
+        yield data
+        return
+    slot_name, output_start = slot
+    pos, length = data
+    view = attach(slot_name)[output_start + pos:output_start + pos + length]
+    try:
+        yield view
+    finally:
+        view.release()
+
 # This class coordinates writing actual data blocks to the file, and also
 # handles generating the index. The hope is that indexing has low enough
 # overhead that handling it in serial with the actual writes won't create a
@@ -571,7 +894,6 @@ class _ZSDataAppender(object):
         # them to find shorter keys (XX).
         self._level_entries = []
         self._level_lengths = []
-        self._hasher = hashlib.sha256()
 
         # spinner-related stuff
         self._last_update = 0
@@ -595,13 +917,10 @@ class _ZSDataAppender(object):
                 sys.stdout.write("\n")
             sys.stdout.flush()
 
-    def write_block(self, level, first_record, last_record, payload, zpayload):
+    def write_block(self, level, first_record, last_record, zpayload):
         if not (0 <= level < FIRST_EXTENSION_LEVEL):
             raise ZSError("invalid level %s" % (level,))
 
-        if level == 0:
-            self._hasher.update(payload)
-
         block_offset = self._file.tell()
         block_contents = six.int2byte(level) + zpayload
         write_uleb128(len(block_contents), self._file)
@@ -635,8 +954,7 @@ class _ZSDataAppender(object):
         zpayload = self._compress_fn(payload, **self._codec_kwargs)
         first_record = entries[0][0]
         last_record = entries[-1][1]
-        self.write_block(level + 1, first_record, last_record,
-                         payload, zpayload)
+        self.write_block(level + 1, first_record, last_record, zpayload)
 
     def close_and_get_header_info(self):
         # We need to create index blocks referring to all dangling
@@ -676,5 +994,5 @@ class _ZSDataAppender(object):
         _flush_file(self._file)
         self._file.close()
         root_entry = self._level_entries[-1][0]
-        return root_entry[-2:] + (self._hasher.digest(),)
+        return root_entry[-2:]
         assert False  # pragma: no cover